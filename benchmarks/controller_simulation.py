@@ -0,0 +1,177 @@
+"""
+Benchmark of controller tick scalability
+Seeds N RelMons and runs controller ticks against an in-process fake
+HTCondor schedd until all RelMons are done
+Reports tick duration, submissions per minute and database operations per tick
+With --held, some jobs go on HOLD and simulation stops when only they are
+left, planned delay of the next tick shows how checks of held jobs back off
+RelMons are stored in MongoDB configured via environment, in a separate database,
+or in mongomock if --in-memory is given and mongomock is installed
+Usage: python3 -m benchmarks.controller_simulation --relmons 1000
+"""
+import argparse
+import logging
+import time
+import mongodb_database
+from mongodb_database import Database
+from mongodb_maintenance import create_indexes
+from mongodb_stores import STORES
+from local.controller import Controller
+from local.relmon import RelMon
+from local import metrics
+from benchmarks.fake_condor import FakeSchedd, FakeSSHExecutor
+
+
+def make_relmon(index, relvals):
+    """
+    Return a new RelMon with one category and given number of relvals
+    """
+    return RelMon(
+        {
+            "id": "simulation-%06d" % (index),
+            "name": "Simulation_%06d" % (index),
+            "categories": [
+                {
+                    "name": "Generator",
+                    "reference": ["RelValReference_%s" % (i) for i in range(relvals)],
+                    "target": ["RelValTarget_%s" % (i) for i in range(relvals)],
+                    "hlt": "both",
+                    "automatic_pairing": True,
+                }
+            ],
+        }
+    )
+
+
+def database_operations():
+    """
+    Return number of database method calls made by this process so far
+    """
+    histogram = metrics.DATABASE_QUERY_SECONDS
+    with histogram.lock:
+        return sum(x["count"] for x in histogram.values.values())
+
+
+def percentile(values, fraction):
+    """
+    Return value at given fraction of sorted values
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    """
+    Run the simulation and print results
+    """
+    parser = argparse.ArgumentParser(description="Controller tick simulation")
+    parser.add_argument("--relmons", type=int, default=500)
+    parser.add_argument("--relvals", type=int, default=5, help="Relvals per side")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per SSH command")
+    parser.add_argument("--idle-time", type=float, default=2.0)
+    parser.add_argument("--run-time", type=float, default=5.0)
+    parser.add_argument("--submit-failure-rate", type=float, default=0.0)
+    parser.add_argument("--held", type=int, default=0, help="Jobs that stay on HOLD")
+    parser.add_argument("--query-failure-rate", type=float, default=0.0)
+    parser.add_argument("--tick-interval", type=float, default=1.0)
+    parser.add_argument("--max-ticks", type=int, default=200)
+    parser.add_argument(
+        "--in-memory", action="store_true", help="Use mongomock instead of MongoDB"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.in_memory:
+        import mongomock  # pylint: disable=import-outside-toplevel
+
+        mongodb_database.MongoClient = mongomock.MongoClient
+
+    Database.DATABASE_NAME = "relmons_simulation"
+    database = Database()
+    database.relmons.delete_many({})
+    for store in STORES:
+        store().collection.delete_many({})
+
+    create_indexes()
+    schedd = FakeSchedd(
+        args.idle_time, args.run_time, args.submit_failure_rate, args.held
+    )
+    controller = Controller()
+    controller.set_config()
+    controller.ssh_executor = FakeSSHExecutor(
+        schedd, args.latency, args.query_failure_rate
+    )
+    controller.submission_workers = args.workers
+    # Every tick is a full sweep
+    controller.sweep_interval = 0
+    user_info = {"login": "simulation", "fullname": "Simulation", "email": "sim@localhost"}
+    start = time.time()
+    for index in range(args.relmons):
+        controller.create_relmon(make_relmon(index, args.relvals), database, user_info)
+
+    print("Seeded %s RelMons in %.2fs" % (args.relmons, time.time() - start))
+    print(
+        "%5s %9s %7s %9s %6s %s"
+        % ("tick", "duration", "db ops", "submitted", "next", "statuses")
+    )
+    tick_times = []
+    tick_operations = []
+    start = time.time()
+    for tick in range(args.max_ticks):
+        tick_start = time.time()
+        operations_before = database_operations()
+        submitted_before = len(schedd.jobs)
+        decision = controller.tick()
+        tick_times.append(time.time() - tick_start)
+        tick_operations.append(database_operations() - operations_before)
+        statuses = database.get_relmon_status_counts()
+        print(
+            "%5s %8.2fs %7s %9s %5ss %s"
+            % (
+                tick,
+                tick_times[-1],
+                tick_operations[-1],
+                len(schedd.jobs) - submitted_before,
+                decision["next_tick"],
+                ", ".join("%s: %s" % (x, y) for x, y in sorted(statuses.items())),
+            )
+        )
+        if set(statuses) <= {"done", "failed"}:
+            break
+
+        in_flight = decision["relmons"]
+        if in_flight and all(x["condor_status"] == "HOLD" for x in in_flight):
+            unfinished = sum(y for x, y in statuses.items() if x not in ("done", "failed"))
+            if unfinished == len(in_flight):
+                print(
+                    "Only %s held RelMons are left, next tick in %ss"
+                    % (len(in_flight), decision["next_tick"])
+                )
+                break
+
+        time.sleep(max(0, args.tick_interval - tick_times[-1]))
+
+    elapsed = time.time() - start
+    print("RelMons: %s, workers: %s, SSH latency: %.3fs" % (args.relmons, args.workers, args.latency))
+    print("Ticks: %s in %.2fs" % (len(tick_times), elapsed))
+    print(
+        "Tick duration: mean %.2fs, p95 %.2fs, max %.2fs"
+        % (
+            sum(tick_times) / len(tick_times),
+            percentile(tick_times, 0.95),
+            max(tick_times),
+        )
+    )
+    print("Submissions: %s (%.1f/min)" % (len(schedd.jobs), len(schedd.jobs) / elapsed * 60))
+    print(
+        "DB operations per tick: mean %.1f, max %s"
+        % (sum(tick_operations) / len(tick_operations), max(tick_operations))
+    )
+    print(
+        "SSH commands: %s"
+        % (", ".join("%s: %s" % (x, y) for x, y in sorted(controller.ssh_executor.commands.items())))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of per-request database latency
+Compares a new MongoClient for every Database(), like before the client
+was shared, with the process-wide pooled client
+Each request creates a Database() and does one small query, like an API call
+MongoDB is configured via environment
+Usage: python3 -m benchmarks.database_client --requests 200
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mongodb_database import Database
+
+
+def request():
+    """
+    Do what a typical API request does with the database
+    """
+    Database().get_relmon_status_counts()
+
+
+def fresh_client_request():
+    """
+    Request with a new client, connection setup, authentication and
+    server discovery are part of every request
+    """
+    Database.close_client()
+    request()
+
+
+def measure(function, requests, threads):
+    """
+    Run function given number of times in given number of threads
+    Return list of latencies in seconds
+    """
+
+    def timed_call(_):
+        start = time.time()
+        function()
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(timed_call, range(requests)))
+
+
+def percentile(values, fraction):
+    """
+    Return value at given fraction of sorted values
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    """
+    Run the benchmark and print results
+    """
+    parser = argparse.ArgumentParser(description="Database client benchmark")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Concurrent requests, fresh clients are only measured sequentially",
+    )
+    args = parser.parse_args()
+    # Warm up, e.g. DNS lookup
+    request()
+    results = {
+        "fresh client": measure(fresh_client_request, args.requests, 1),
+        "pooled client": measure(request, args.requests, args.threads),
+    }
+    Database.close_client()
+    print("%14s %9s %9s %9s" % ("", "mean ms", "p50 ms", "p95 ms"))
+    for name, latencies in results.items():
+        print(
+            "%14s %9.2f %9.2f %9.2f"
+            % (
+                name,
+                sum(latencies) / len(latencies) * 1000,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
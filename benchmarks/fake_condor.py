@@ -0,0 +1,239 @@
+"""
+In-process stand-in for the submission host and HTCondor schedd
+FakeSSHExecutor has the same interface as SSHConnectionPool and answers
+commands that controller runs: condor_submit, condor_q, condor_history,
+condor_rm, log packaging and directory cleanup
+"""
+import io
+import random
+import re
+import tarfile
+import threading
+import time
+
+
+class FakeSchedd:
+    """
+    HTCondor schedd that keeps job states in memory
+    Jobs are IDLE for idle_time seconds, RUN for run_time seconds and
+    then DONE, jobs that are not IDLE, RUN or HOLD are only visible in history
+    First held_jobs jobs go on HOLD instead of running and stay there
+    """
+
+    IDLE = "1"
+    RUN = "2"
+    REMOVED = "3"
+    DONE = "4"
+    HOLD = "5"
+
+    def __init__(
+        self, idle_time=1.0, run_time=2.0, submit_failure_rate=0.0, held_jobs=0
+    ):
+        self.idle_time = idle_time
+        self.run_time = run_time
+        self.submit_failure_rate = submit_failure_rate
+        self.held_jobs = held_jobs
+        self.jobs = {}
+        self.next_cluster_id = 1000
+        self.lock = threading.Lock()
+
+    def submit(self):
+        """
+        Submit a job and return it's cluster id or None if submission failed
+        """
+        if random.random() < self.submit_failure_rate:
+            return None
+
+        with self.lock:
+            cluster_id = self.next_cluster_id
+            self.next_cluster_id += 1
+            self.jobs[cluster_id] = {
+                "submitted": time.time(),
+                "removed": None,
+                "held": self.held_jobs > 0,
+            }
+            self.held_jobs -= 1
+
+        return cluster_id
+
+    def remove(self, cluster_id):
+        """
+        Remove job from the queue
+        """
+        with self.lock:
+            job = self.jobs.get(cluster_id)
+            if job and job["removed"] is None:
+                job["removed"] = time.time()
+
+    def status(self, cluster_id, now=None):
+        """
+        Return JobStatus of a job or None if job does not exist
+        """
+        job = self.jobs.get(cluster_id)
+        if not job:
+            return None
+
+        if job["removed"] is not None:
+            return self.REMOVED
+
+        elapsed = (now or time.time()) - job["submitted"]
+        if elapsed < self.idle_time:
+            return self.IDLE
+
+        if job["held"]:
+            return self.HOLD
+
+        if elapsed < self.idle_time + self.run_time:
+            return self.RUN
+
+        return self.DONE
+
+    def query(self, cluster_ids, history):
+        """
+        Return {cluster id: JobStatus} of jobs in the queue, or jobs that
+        left the queue if history is True
+        """
+        now = time.time()
+        result = {}
+        with self.lock:
+            for cluster_id in cluster_ids:
+                status = self.status(cluster_id, now)
+                if status is None:
+                    continue
+
+                in_queue = status in (self.IDLE, self.RUN, self.HOLD)
+                if in_queue != history:
+                    result[cluster_id] = status
+
+        return result
+
+    def count(self):
+        """
+        Return dictionary of JobStatus and number of jobs in it
+        """
+        now = time.time()
+        counts = {}
+        with self.lock:
+            for cluster_id in self.jobs:
+                status = self.status(cluster_id, now)
+                counts[status] = counts.get(status, 0) + 1
+
+        return counts
+
+
+class FakeSSHExecutor:
+    """
+    Drop-in replacement of SSH connection pool that forwards HTCondor
+    commands to a FakeSchedd
+    Every command takes latency seconds and fails with query_failure_rate
+    probability, like an overloaded submission host would
+    """
+
+    def __init__(self, schedd, latency=0.05, query_failure_rate=0.0):
+        self.schedd = schedd
+        self.latency = latency
+        self.query_failure_rate = query_failure_rate
+        self.commands = {}
+        self.lock = threading.Lock()
+        self.log_archive = self.__make_log_archive()
+
+    @staticmethod
+    def __make_log_archive():
+        """
+        Return tar.gz bytes of a small job log
+        """
+        content = b"Simulated job output\n" * 100
+        output = io.BytesIO()
+        with tarfile.open(fileobj=output, mode="w:gz") as tar_file:
+            info = tarfile.TarInfo("validation_matrix.log")
+            info.size = len(content)
+            tar_file.addfile(info, io.BytesIO(content))
+
+        return output.getvalue()
+
+    def __count(self, name):
+        """
+        Count executed command
+        """
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def execute_command(self, command, retry=False):
+        """
+        Execute command and return stdout, stderr and exit code
+        """
+        if isinstance(command, list):
+            command = "; ".join(command)
+
+        time.sleep(self.latency)
+        if "condor_submit" in command:
+            self.__count("condor_submit")
+            cluster_id = self.schedd.submit()
+            if cluster_id is None:
+                return "", "ERROR: Failed to connect to local queue manager", 1
+
+            return (
+                "Submitting job(s).\n1 job(s) submitted to cluster %s." % (cluster_id),
+                "",
+                0,
+            )
+
+        for name in ("condor_q", "condor_history"):
+            if name in command:
+                self.__count(name)
+                if random.random() < self.query_failure_rate:
+                    return "", "Failed to fetch ads from schedd", 1
+
+                cluster_ids = [int(x) for x in re.findall(r"ClusterId == (\d+)", command)]
+                statuses = self.schedd.query(cluster_ids, name == "condor_history")
+                stdout = "\n".join("%s %s" % (x, y) for x, y in statuses.items())
+                return stdout, "", 0
+
+        if "condor_rm" in command:
+            self.__count("condor_rm")
+            for cluster_id in re.findall(r"condor_rm (\d+)", command):
+                self.schedd.remove(int(cluster_id))
+
+            return "", "", 0
+
+        self.__count("other")
+        return "", "", 0
+
+    def execute_command_with_input(
+        self, command, input_data, binary_output=False, retry=False
+    ):
+        """
+        Execute command with given stdin, return logs archive for log packaging
+        """
+        if isinstance(command, list):
+            command = "; ".join(command)
+
+        if "tar -czf -" in command:
+            time.sleep(self.latency)
+            self.__count("collect")
+            return self.log_archive, "", 0
+
+        stdout, stderr, exit_code = self.execute_command(command, retry)
+        if binary_output:
+            stdout = stdout.encode("utf-8")
+
+        return stdout, stderr, exit_code
+
+    def upload_file(self, copy_from, copy_to):
+        """
+        Pretend to upload a file
+        """
+        time.sleep(self.latency)
+        self.__count("upload")
+
+    def download_file(self, copy_from, copy_to):
+        """
+        Pretend to download a file
+        """
+        time.sleep(self.latency)
+        self.__count("download")
+
+    def close_connections(self):
+        """
+        Nothing to close
+        """
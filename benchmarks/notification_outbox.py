@@ -0,0 +1,156 @@
+"""
+Benchmark of email notification throughput
+Runs a local stand-in SMTP server and compares sending notifications with
+a new SMTP session per email against draining the outbox over a kept open
+session
+Outbox is stored in MongoDB configured via environment, in a separate database
+Usage: python3 -m benchmarks.notification_outbox --notifications 200
+"""
+import argparse
+import logging
+import socketserver
+import threading
+import time
+from mongodb_database import Database
+from mongodb_stores import NotificationOutbox
+from local.email_sender import EmailSender
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP server that accepts and counts all messages
+    Every new session is delayed to imitate TLS handshake and authentication
+    """
+
+    def reply(self, text):
+        """
+        Write a reply line to the client
+        """
+        self.wfile.write(("%s\r\n" % (text)).encode("utf-8"))
+
+    def handle(self):
+        self.server.sessions += 1
+        time.sleep(self.server.session_latency)
+        self.reply("220 stand-in ESMTP")
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    in_data = False
+                    self.server.messages += 1
+                    self.reply("250 OK")
+
+                continue
+
+            command = line.strip().split(b" ")[0].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250-stand-in")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                in_data = True
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("250 OK")
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded stand-in SMTP server listening on a random local port
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, session_latency):
+        super().__init__(("127.0.0.1", 0), StandInSMTPHandler)
+        self.session_latency = session_latency
+        self.messages = 0
+        self.sessions = 0
+
+
+def make_notifications(count):
+    """
+    Return list of (subject, body, recipients, files) tuples
+    """
+    attachment = ("logs.tar.gz", b"\0" * 64 * 1024)
+    return [
+        (
+            "RelMon Benchmark_%s is done" % (i),
+            "Hello,\n\nRelMon Benchmark_%s has finished running.\n" % (i),
+            ["benchmark@localhost"],
+            [attachment],
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    """
+    Run the benchmark and print results
+    """
+    parser = argparse.ArgumentParser(description="Notification outbox benchmark")
+    parser.add_argument("--notifications", type=int, default=100)
+    parser.add_argument(
+        "--session-latency",
+        type=float,
+        default=0.2,
+        help="Seconds the stand-in server spends setting up each SMTP session",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    Database.DATABASE_NAME = "relmons_benchmark"
+    outbox = NotificationOutbox()
+    outbox.collection.delete_many({})
+    server = StandInSMTPServer(args.session_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    notifications = make_notifications(args.notifications)
+
+    # Old behaviour - new SMTP session for every email, inline
+    sender = EmailSender(host=host, port=port, use_tls=False)
+    start = time.time()
+    for notification in notifications:
+        sender.send(*notification)
+
+    inline_time = time.time() - start
+    inline_messages = server.messages
+
+    # Outbox - enqueue during the tick, send later over one session
+    server.messages = 0
+    start = time.time()
+    for notification in notifications:
+        sender.enqueue(*notification)
+
+    enqueue_time = time.time() - start
+    start = time.time()
+    sender.send_pending(outbox)
+    drain_time = time.time() - start
+    sender.close()
+    outbox_messages = server.messages
+    server.shutdown()
+
+    print("Notifications: %s" % (args.notifications))
+    print("Session latency: %.3fs" % (args.session_latency))
+    print(
+        "Inline send:    %s sent in %.2fs (%.1f/s)"
+        % (inline_messages, inline_time, inline_messages / max(inline_time, 1e-9))
+    )
+    print(
+        "Outbox enqueue: %.2fs (time spent in the tick)"
+        % (enqueue_time)
+    )
+    print(
+        "Outbox drain:   %s sent in %.2fs (%.1f/s)"
+        % (outbox_messages, drain_time, outbox_messages / max(drain_time, 1e-9))
+    )
+
+
+if __name__ == "__main__":
+    main()
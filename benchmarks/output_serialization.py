@@ -0,0 +1,106 @@
+"""
+Benchmark of API response serialization
+Builds a large RelMon like the ones with many categories and relvals and
+compares previous pretty printed JSON with compact JSON, with and without
+compression, by serialization time and payload size
+No database is needed
+Usage: python3 -m benchmarks.output_serialization --relvals 400
+"""
+import argparse
+import json
+import time
+from local import response_encoding
+from local.relmon import RelMon
+
+
+def make_relval(category, side, index):
+    """
+    Return a downloaded relval like the ones stored in database
+    """
+    name = "RelVal%sProcess%s__CMSSW_14_0_0-140X_mcRun3_2024_realistic_v%s-v1__DQMIO" % (
+        category,
+        index,
+        side,
+    )
+    file_name = "DQM_V0001_R000000001__%s__CMSSW_14_0_0-140X__DQMIO.root" % (name)
+    return {
+        "name": name,
+        "file_name": file_name,
+        "file_url": "https://cmsweb.cern.ch/dqm/relval/data/browse/ROOT/RelVal/%s" % (file_name),
+        "file_size": 123456789 + index,
+        "status": "downloaded",
+        "events": 9000 + index,
+    }
+
+
+def make_relmon(relvals):
+    """
+    Return a RelMon with all categories and given number of relvals per side
+    """
+    categories = []
+    for category in ("Data", "FullSimulation", "FastSimulation", "Generator"):
+        categories.append(
+            {
+                "name": category,
+                "status": "done",
+                "hlt": "both",
+                "automatic_pairing": True,
+                "reference": [make_relval(category, 1, i) for i in range(relvals)],
+                "target": [make_relval(category, 2, i) for i in range(relvals)],
+            }
+        )
+
+    relmon = RelMon({"id": "1700000000", "name": "Benchmark", "categories": categories})
+    data = relmon.get_json()
+    data["summary"] = relmon.get_summary()
+    return data
+
+
+def measure(function, repeat):
+    """
+    Return result of function and mean duration in seconds
+    """
+    start = time.time()
+    for _ in range(repeat):
+        result = function()
+
+    return result, (time.time() - start) / repeat
+
+
+def main():
+    """
+    Run the benchmark and print results
+    """
+    parser = argparse.ArgumentParser(description="Output serialization benchmark")
+    parser.add_argument("--relvals", type=int, default=400, help="Relvals per side")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    data = make_relmon(args.relvals)
+    print(
+        "Serializer: %s, brotli: %s"
+        % (
+            "orjson" if response_encoding.orjson else "json",
+            "yes" if response_encoding.brotli else "no",
+        )
+    )
+    cases = {
+        "previous": lambda: (
+            json.dumps(data, indent=1, sort_keys=True).encode("utf-8"),
+            None,
+        ),
+        "pretty": lambda: (response_encoding.to_json(data, True), None),
+        "compact": lambda: (response_encoding.to_json(data), None),
+    }
+    for encoding in response_encoding.supported_encodings():
+        cases["compact+%s" % (encoding)] = lambda encoding=encoding: response_encoding.compress(
+            response_encoding.to_json(data), encoding
+        )
+
+    print("%14s %10s %10s" % ("", "ms", "KiB"))
+    for name, function in cases.items():
+        (body, _), duration = measure(function, args.repeat)
+        print("%14s %10.2f %10.1f" % (name, duration * 1000, len(body) / 1024))
+
+
+if __name__ == "__main__":
+    main()
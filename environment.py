@@ -28,7 +28,21 @@ Attributes:
         where all RelMon reports are going to be stored. This is the path used by `REPORT_URL`
         application to load the reports static files.
     TICK_INTERNAL (int): Elapsed time in seconds to perform a tick, please see `controller.tick()`
-        for more details.
+        for more details. This is also the interval of full sweeps of all RelMons,
+        ticks in between process only RelMons that were changed via the API.
+        When no jobs are in flight, ticks happen at this interval.
+    MIN_TICK_INTERVAL (int): Shortest interval in seconds between ticks while jobs are in flight.
+        Next tick is scheduled based on how long jobs are idle or running
+        and their expected runtime.
+    CONTROLLER_COALESCE_DELAY (int): Delay in seconds between a RelMon change via the API
+        and a controller tick that processes it. Changes that arrive within this delay
+        are processed in the same tick.
+    NOTIFICATION_INTERVAL (int): Interval in seconds between attempts to send email
+        notifications from the outbox. Outbox is also flushed after every controller tick.
+    LEASE_TTL (int): Time in seconds the controller lease is valid for. Several replicas
+        can serve the API, but only the one that holds the lease runs controller ticks.
+        Lease is renewed every third of this time and if the leader stops renewing it,
+        another replica takes over after it expires.
     MONGO_DB_HOST (str): MongoDB host for opening a client session.
     MONGO_DB_PORT (int): MongoDB port for opening a client session.
     MONGO_DB_USER (str): MongoDB user to authenticate a new client session.
@@ -43,10 +57,17 @@ Attributes:
         or the reverse proxy that provides authentication.
     CALLBACK_CLIENT_ID (str): Client ID for CLI integration application.
     CALLBACK_CLIENT_SECRET (str): Client secret for CLI integration application.
+    SUBMISSION_WORKERS (int): Maximum number of RelMons that are prepared, uploaded and
+        submitted to HTCondor in parallel during a tick. Workers share a pool of SSH connections.
+    MAX_RUNNING_RELMONS (int): Maximum number of RelMons that are submitted, running or
+        finishing at the same time. Free slots are shared fairly among users.
     CMSSW_RELEASE (str): cms-sw version to use for generating the monitoring report.
     HTCONDOR_CAF_POOL (bool): If this environment variable is provided,
         RelMon batch jobs will be configured to run inside the dedicated pool CMS CAF.
         Otherwise, they will run in the public shared pool.
+    HTCONDOR_FANOUT (bool): If this environment variable is provided, RelMons with
+        more than one category are split into a job per category (and per HLT flag)
+        and a job that merges their reports, all submitted as one DAG.
     FILE_CREATOR_GIT_SOURCE (str): RelMonService2 source code to load inside the
         HTCondor batch jobs.
     FILE_CREATOR_GIT_BRANCH (str): Branch to use from `FILE_CREATOR_GIT_SOURCE`.
@@ -69,7 +90,13 @@ SERVICE_ACCOUNT_PASSWORD: str = os.getenv("SERVICE_ACCOUNT_PASSWORD", "")
 EMAIL_AUTH_REQUIRED: bool = bool(os.getenv("EMAIL_AUTH_REQUIRED"))
 WEB_LOCATION_PATH: str = os.getenv("WEB_LOCATION_PATH", "")
 TICK_INTERVAL: int = int(os.getenv("TICK_INTERVAL", "600"))
+MIN_TICK_INTERVAL: int = int(os.getenv("MIN_TICK_INTERVAL", "30"))
+CONTROLLER_COALESCE_DELAY: int = int(os.getenv("CONTROLLER_COALESCE_DELAY", "10"))
+NOTIFICATION_INTERVAL: int = int(os.getenv("NOTIFICATION_INTERVAL", "60"))
+LEASE_TTL: int = int(os.getenv("LEASE_TTL", "30"))
 CMSSW_RELEASE: str = os.getenv("CMSSW_RELEASE", "CMSSW_11_0_4")
+SUBMISSION_WORKERS: int = int(os.getenv("SUBMISSION_WORKERS", "4"))
+MAX_RUNNING_RELMONS: int = int(os.getenv("MAX_RUNNING_RELMONS", "50"))
 
 # MongoDB database
 MONGO_DB_HOST: str = os.getenv("MONGO_DB_HOST", "")
@@ -93,6 +120,7 @@ DISABLE_CALLBACK_CREDENTIALS = bool(os.getenv("DISABLE_CALLBACK_CREDENTIALS"))
 # HTCondor submission pool
 HTCONDOR_CAF_POOL = bool(os.getenv("HTCONDOR_CAF_POOL"))
 HTCONDOR_MODULE = "lxbatch/tzero" if HTCONDOR_CAF_POOL else "lxbatch/share"
+HTCONDOR_FANOUT = bool(os.getenv("HTCONDOR_FANOUT"))
 
 # Repository source for the remote execution in HTCondor.
 FILE_CREATOR_GIT_SOURCE: str = os.getenv("FILE_CREATOR_GIT_SOURCE", "https://github.com/cms-PdmV/relmonservice2.git")
@@ -0,0 +1,217 @@
+"""
+Module for ChangeFeed
+"""
+import logging
+import queue
+import threading
+import time
+from pymongo.errors import OperationFailure
+from mongodb_database import Database
+
+
+class ChangeFeed:
+    """
+    Feed of compact RelMon changes for connected browsers
+    A single background thread follows a MongoDB change stream of RelMons
+    and passes changes to queues of all subscribers
+    Standalone MongoDB does not support change streams, then recently
+    updated RelMons are polled instead
+    """
+
+    # Top level fields of RelMon that are sent to browsers
+    FIELDS = (
+        "name",
+        "status",
+        "condor_status",
+        "condor_id",
+        "last_update",
+        "priority",
+        "summary",
+    )
+    # Error codes of MongoDB that does not support change streams
+    CHANGE_STREAMS_NOT_SUPPORTED = (40573, 40324)
+    # Seconds between polls if change streams are not supported
+    POLL_INTERVAL = 5
+    # Seconds to wait before watching again after an error
+    RETRY_DELAY = 10
+    # Longest delay after repeated errors
+    MAX_RETRY_DELAY = 300
+    # Changes that are kept for a subscriber that does not read them,
+    # if there are more, subscriber is told to fetch everything again
+    QUEUE_SIZE = 1000
+
+    def __init__(self):
+        self.logger = logging.getLogger("logger")
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+
+    def subscribe(self):
+        """
+        Return a new queue that will receive changes
+        """
+        subscriber = queue.Queue(self.QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.__run, name="change-feed", daemon=True
+                )
+                self.thread.start()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Stop passing changes to given queue
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, change):
+        """
+        Pass change to all subscribers
+        """
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(change)
+            except queue.Full:
+                # Subscriber missed some changes, so it has to start over
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+
+                subscriber.put_nowait({"operation": "reset"})
+
+    def __has_subscribers(self):
+        """
+        Return whether anyone is subscribed
+        """
+        with self.lock:
+            return bool(self.subscribers)
+
+    def __run(self):
+        """
+        Follow changes while there are subscribers
+        Thread is cleared on exit, so next subscriber starts a new one even
+        if this one died of an unexpected error
+        """
+        try:
+            self.__follow()
+        finally:
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def __follow(self):
+        """
+        Watch change stream, or poll if it is not supported, and retry
+        after errors with increasing delay
+        """
+        poll = False
+        delay = self.RETRY_DELAY
+        while True:
+            with self.lock:
+                # Checked under the lock, so a new subscriber either sees
+                # that thread is gone or is noticed by the thread
+                if not self.subscribers:
+                    self.thread = None
+                    return
+
+            try:
+                if poll:
+                    self.__poll()
+                else:
+                    self.__watch()
+
+                delay = self.RETRY_DELAY
+                continue
+            except OperationFailure as ex:
+                if not poll and (
+                    ex.code in self.CHANGE_STREAMS_NOT_SUPPORTED
+                    or "replica set" in str(ex)
+                ):
+                    self.logger.info("Change streams are not supported, will poll: %s", ex)
+                    poll = True
+                    continue
+
+                self.logger.error("Error following RelMon changes: %s", ex)
+            except Exception as ex:
+                self.logger.error("Error following RelMon changes: %s", ex, exc_info=True)
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_RETRY_DELAY)
+            self.publish({"operation": "reset"})
+
+    def __watch(self):
+        """
+        Follow change stream of RelMons
+        """
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}
+        ]
+        with Database().relmons.watch(pipeline, max_await_time_ms=1000) as stream:
+            while self.__has_subscribers() and stream.alive:
+                event = stream.try_next()
+                if event is not None:
+                    change = self.to_change(event)
+                    if change:
+                        self.publish(change)
+
+    def __poll(self):
+        """
+        Periodically find RelMons that were updated since last poll
+        Deleted RelMons can not be noticed this way
+        """
+        since = int(time.time())
+        projection = {x: 1 for x in self.FIELDS}
+        while self.__has_subscribers():
+            time.sleep(self.POLL_INTERVAL)
+            # Last update has a precision of a second
+            relmons = Database().relmons.find({"last_update": {"$gte": since}}, projection)
+            since = int(time.time()) - 1
+            for relmon in relmons:
+                relmon_id = relmon.pop("_id")
+                self.publish({"operation": "update", "id": relmon_id, "fields": relmon})
+
+    @classmethod
+    def to_change(cls, event):
+        """
+        Make a compact change from a change stream event
+        Only fields that are shown in the web page are included, changed
+        references and targets are sent individually
+        Return None if nothing interesting changed
+        """
+        operation = event["operationType"]
+        relmon_id = event["documentKey"]["_id"]
+        if operation in ("insert", "delete"):
+            return {"operation": operation, "id": relmon_id}
+
+        if operation == "replace":
+            document = event.get("fullDocument") or {}
+            fields = {x: document[x] for x in cls.FIELDS if x in document}
+            fields["categories"] = document.get("categories", [])
+            return {"operation": "update", "id": relmon_id, "fields": fields}
+
+        description = event.get("updateDescription", {})
+        fields = {
+            key: value
+            for key, value in description.get("updatedFields", {}).items()
+            if key.split(".")[0] in cls.FIELDS or key.startswith("categories")
+        }
+        removed = [
+            x
+            for x in description.get("removedFields", [])
+            if x.split(".")[0] in cls.FIELDS
+        ]
+        if not fields and not removed:
+            return None
+
+        change = {"operation": "update", "id": relmon_id, "fields": fields}
+        if removed:
+            change["removed"] = removed
+
+        return change
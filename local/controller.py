@@ -4,17 +4,24 @@ Runs main loop that checks status and acts accordingly
 """
 
 import logging
+import re
 import time
 import os.path
 import shutil
-import zipfile
+import io
+import tarfile
 import json
-from multiprocessing import Manager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from mongodb_database import Database
-from core_lib.utils.ssh_executor import SSHExecutor
+from mongodb_stores import MetricsStore, OperationQueue, SchedulerStore
 from local.relmon import RelMon
 from local.file_creator import FileCreator
 from local.email_sender import EmailSender
+from local.ssh_pool import SSHConnectionPool
+from local.resource_estimator import ResourceEstimator, parse_job_log
+from local.submission_scheduler import SubmissionScheduler
+from local.leader_election import LeaseLost
+from local import metrics
 from environment import (
     SUBMISSION_HOST,
     SERVICE_ACCOUNT_USERNAME,
@@ -22,7 +29,12 @@ from environment import (
     SERVICE_URL,
     REPORTS_URL,
     REMOTE_DIRECTORY,
-    HTCONDOR_MODULE
+    HTCONDOR_MODULE,
+    SUBMISSION_WORKERS,
+    TICK_INTERVAL,
+    MIN_TICK_INTERVAL,
+    HTCONDOR_FANOUT,
+    MAX_RUNNING_RELMONS,
 )
 
 
@@ -33,22 +45,54 @@ class Controller:
     and their status is checked (if they are running)
     """
 
+    # Fields of RelMon that are set by submission to HTCondor
+    SUBMISSION_FIELDS = (
+        "status",
+        "condor_id",
+        "condor_status",
+        "condor_status_since",
+        "resources",
+        "expected_runtime",
+        "fanout",
+    )
+    # HTCondor JobStatus codes
+    CONDOR_STATUSES = {
+        "0": "UNEXPLAINED",
+        "1": "IDLE",
+        "2": "RUN",
+        "3": "REMOVED",
+        "4": "DONE",
+        "5": "HOLD",
+        "6": "SUBMISSION ERROR",
+    }
+
     def __init__(self):
         self.logger = logging.getLogger("logger")
         self.logger.info("***** Creating a controller! *****")
         self.is_tick_running = False
-        # Multithread manager
-        manager = Manager()
-        # Lists of relmon ids
-        self.relmons_to_reset = manager.list()
-        self.relmons_to_delete = manager.list()
+        # Relmons to reset, delete and process during next tick are
+        # stored in operations queue in the database, as well as time of
+        # last full sweep of all relmons, so they survive restarts and
+        # are shared by replicas
+        self.sweep_interval = TICK_INTERVAL
+        # Ticks happen more often while jobs are in flight, but not more
+        # often than this
+        self.min_tick_interval = MIN_TICK_INTERVAL
         self.config = None
         self.remote_directory = "relmon"
         self.ssh_executor = None
+        self.submission_workers = 1
         self.file_creator = None
         self.email_sender = None
+        self.resource_estimator = ResourceEstimator()
+        self.submission_scheduler = SubmissionScheduler(MAX_RUNNING_RELMONS)
         self.service_url = "localhost"
         self.reports_url = "localhost"
+        # Leader election and fencing token of the running tick, lease is
+        # checked before every change, so a leader that lost the lease
+        # stops before doing something the new leader does too
+        self.leader_election = None
+        self.lease_token = None
 
     def set_config(self):
         """
@@ -58,155 +102,440 @@ class Controller:
         if self.remote_directory[-1] == "/":
             self.remote_directory = self.remote_directory[:-1]
 
-        self.ssh_executor = SSHExecutor(
+        self.submission_workers = max(1, SUBMISSION_WORKERS)
+        # Connections are kept open between ticks and shared by submission
+        # workers, each connection serves several commands at once
+        channels = SSHConnectionPool.CHANNELS_PER_CONNECTION
+        self.ssh_executor = SSHConnectionPool(
             host=SUBMISSION_HOST,
             username=SERVICE_ACCOUNT_USERNAME,
-            password=SERVICE_ACCOUNT_PASSWORD
+            password=SERVICE_ACCOUNT_PASSWORD,
+            size=(self.submission_workers + channels - 1) // channels,
+            channels_per_connection=channels,
         )
         self.file_creator = FileCreator()
         self.email_sender = EmailSender()
         self.service_url = SERVICE_URL
         self.reports_url = REPORTS_URL
 
-    def tick(self):
+    def tick(self, leader_election=None):
         """
         Controller works by doing "ticks" every once in a while
-        During a tick it shoud check all existing relmon's and
-        their status and, if necessary, perform actions like
-        submission or output collection
+        During a tick it shoud check relmon's and their status and,
+        if necessary, perform actions like submission or output collection
         Actions go like this:
         * Delete relmons that are in deletion list
         * Reset relmons that are in reset list
         * Check running relmons
         * Submit new relmons
+        Full sweep of all RelMons is done only if it was requested or last
+        full sweep was longer than sweep interval ago, otherwise only RelMons
+        that were marked as dirty and RelMons whose check was planned by
+        the previous tick are checked and submitted, if there are none,
+        tick only deletes and resets
+        If leader election is given, tick is done only if this replica holds
+        the lease and lease is checked again before every change, tick stops
+        as soon as the lease is lost
+        Return decision when the next tick should happen
         """
         database = Database()
-        self.logger.info("Controller will tick")
+        token = None
+        if leader_election:
+            token = leader_election.current_token()
+            if token is None:
+                self.logger.info("Not a leader, will not tick")
+                return None
+
+        self.leader_election = leader_election
+        self.lease_token = token
+        try:
+            return self.__tick(database)
+        except LeaseLost as ex:
+            self.logger.warning("Lost leadership during tick, stopping: %s", ex)
+            return None
+
+    def __tick(self, database):
+        """
+        Do the tick, see tick()
+        """
         tick_start = time.time()
-        # Delete relmons
+        operations = OperationQueue()
+        scheduler = SchedulerStore()
+        sweep_operations = operations.claim("sweep")
+        dirty_operations = operations.claim("check")
+        try:
+            dirty_relmon_ids = [x["relmon_id"] for x in dirty_operations]
+            full_sweep = (
+                bool(sweep_operations)
+                or tick_start - scheduler.get_last_sweep() >= self.sweep_interval
+            )
+            if full_sweep:
+                self.logger.info("Controller will tick, full sweep")
+                scheduler.set_last_sweep(tick_start)
+            else:
+                planned_relmon_ids = self.__planned_checks(
+                    scheduler.get_last_decision(), tick_start
+                )
+                dirty_relmon_ids += [
+                    x for x in planned_relmon_ids if x not in dirty_relmon_ids
+                ]
+                self.logger.info(
+                    "Controller will tick, dirty and planned relmons (%s): %s",
+                    len(dirty_relmon_ids),
+                    ", ".join(dirty_relmon_ids),
+                )
+
+            if full_sweep:
+                metrics.TICKS_TOTAL.inc(sweep="full")
+            else:
+                metrics.TICKS_TOTAL.inc(sweep="dirty" if dirty_relmon_ids else "none")
+            with metrics.TICK_PHASE_SECONDS.time(phase="delete"):
+                self.__delete_relmons(database, operations)
+
+            with metrics.TICK_PHASE_SECONDS.time(phase="reset"):
+                self.__reset_relmons(database, operations)
+
+            if full_sweep:
+                relmons_to_check = database.get_relmons_to_check()
+                has_new_relmons = True
+            elif not dirty_relmon_ids:
+                relmons_to_check = []
+                has_new_relmons = False
+            else:
+                dirty_relmons = database.get_relmons_with_ids(dirty_relmon_ids)
+                relmons_to_check = [
+                    r
+                    for r in dirty_relmons
+                    if r["status"] in ("submitted", "running", "finishing")
+                    or r.get("condor_status") == "RUN"
+                ]
+                has_new_relmons = any(r["status"] == "new" for r in dirty_relmons)
+
+            if relmons_to_check and self.__check_relmons(relmons_to_check, database):
+                # Finished RelMons freed slots for new ones
+                has_new_relmons = True
+
+            relmons_to_submit = []
+            if has_new_relmons:
+                # Scheduled after the check, so slots that were freed by
+                # finished RelMons can be taken right away
+                relmon_ids = self.submission_scheduler.schedule(database)
+                relmons_to_submit = database.get_relmons_with_ids(relmon_ids)
+                relmons_to_submit.sort(key=lambda x: relmon_ids.index(x["_id"]))
+
+            with metrics.TICK_PHASE_SECONDS.time(phase="submit"):
+                self.__submit_new_relmons(relmons_to_submit, database)
+
+            self.__check_lease()
+        except Exception:
+            # Let the next tick process them instead of waiting for the
+            # claim to time out
+            operations.release(sweep_operations + dirty_operations)
+            raise
+
+        operations.ack(sweep_operations + dirty_operations)
+        decision = self.__plan_next_tick(database.get_relmons_to_check())
+        scheduler.add_decision(decision)
+        tick_end = time.time()
+        metrics.TICK_PHASE_SECONDS.observe(tick_end - tick_start, phase="total")
+        MetricsStore().save(metrics.process_id(), metrics.REGISTRY.snapshot())
+        self.logger.info(
+            "Controller tick finished. Took %.2fs, next tick in %ss",
+            tick_end - tick_start,
+            decision["next_tick"],
+        )
+        return decision
+
+    @staticmethod
+    def __planned_checks(decision, now):
+        """
+        Return ids of RelMons whose next check, as planned by given tick
+        decision, is due now
+        """
+        if not decision:
+            return []
+
+        # Tick might start a moment before planned time
+        elapsed = now - decision["time"] + 1
+        return [x["id"] for x in decision.get("relmons", []) if x["next_check"] <= elapsed]
+
+    def __plan_next_tick(self, relmons_in_flight):
+        """
+        Decide when the next tick should happen based on RelMons in flight
+        Each RelMon gets a delay of next check:
+        * RUN - half of the remaining expected runtime, if job is running
+          longer than expected, delay grows with the overrun
+        * IDLE - quarter of the time it is waiting in the queue
+        * other, e.g. HOLD or unknown - half of the time it is in that status,
+          but at least quarter of the tick interval, such jobs might stay
+          like that for hours
+        Delays are kept between minimum tick interval and tick interval
+        and next tick happens when the first RelMon needs to be checked
+        """
+        now = int(time.time())
+        relmons = []
+        for relmon in relmons_in_flight:
+            condor_status = relmon.get("condor_status")
+            elapsed = max(0, now - relmon.get("condor_status_since", now))
+            expected_runtime = relmon.get("expected_runtime", 0)
+            if condor_status == "RUN" and expected_runtime:
+                remaining = expected_runtime - elapsed
+                delay = remaining // 2 if remaining > 0 else -remaining // 4
+            elif condor_status == "IDLE":
+                delay = elapsed // 4
+            else:
+                delay = max(elapsed // 2, self.sweep_interval // 4)
+
+            delay = min(max(delay, self.min_tick_interval), self.sweep_interval)
+            relmons.append(
+                {
+                    "id": relmon["id"],
+                    "name": relmon["name"],
+                    "condor_status": condor_status,
+                    "elapsed": elapsed,
+                    "expected_runtime": expected_runtime,
+                    "next_check": delay,
+                }
+            )
+
+        if relmons:
+            next_tick = min(x["next_check"] for x in relmons)
+            reason = "%s RelMons in flight" % (len(relmons))
+        else:
+            next_tick = self.sweep_interval
+            reason = "Nothing in flight"
+
+        return {
+            "time": now,
+            "next_tick": next_tick,
+            "reason": reason,
+            "relmons": sorted(relmons, key=lambda x: x["next_check"]),
+        }
+
+    def __delete_relmons(self, database, operation_queue):
+        """
+        Delete relmons that are in deletion queue
+        """
+        operations = operation_queue.claim("delete")
         self.logger.info(
             "Relmons to delete (%s): %s.",
-            len(self.relmons_to_delete),
-            ",".join([x["id"] for x in self.relmons_to_delete]),
+            len(operations),
+            ",".join([x["relmon_id"] for x in operations]),
         )
-        for relmon_dict in self.relmons_to_delete:
-            relmon_id = relmon_dict["id"]
-            self.__delete_relmon(relmon_id, database)
-            self.relmons_to_delete.remove(relmon_dict)
+        for operation in operations:
+            try:
+                self.__check_lease()
+                self.__delete_relmon(operation["relmon_id"], database)
+            except Exception:
+                operation_queue.release(operations)
+                raise
 
-        # Reset relmons
+            # Acknowledged right away, so it is not done again if tick fails
+            operations = operations[1:]
+            operation_queue.ack([operation])
+
+    def __reset_relmons(self, database, operation_queue):
+        """
+        Reset relmons that are in reset queue
+        """
+        operations = operation_queue.claim("reset")
         self.logger.info(
             "Relmons to reset (%s): %s.",
-            len(self.relmons_to_reset),
-            ", ".join([x["id"] for x in self.relmons_to_reset]),
+            len(operations),
+            ", ".join([x["relmon_id"] for x in operations]),
         )
-        for relmon_dict in self.relmons_to_reset:
-            relmon_id = relmon_dict["id"]
-            self.__reset_relmon(relmon_id, database, relmon_dict["user_info"])
-            self.relmons_to_reset.remove(relmon_dict)
-
-        # Check relmons
-        relmons_to_check = database.get_relmons_with_status("submitted")
-        relmons_to_check.extend(database.get_relmons_with_status("running"))
-        relmons_to_check.extend(database.get_relmons_with_status("finishing"))
-        # Add relmons with HTCondor status RUN to be checked
-        for relmon_dict in database.get_relmons_with_condor_status("RUN"):
-            for added_relmon in relmons_to_check:
-                if added_relmon["_id"] == relmon_dict["_id"]:
-                    break
-            else:
-                relmons_to_check.append(relmon_dict)
+        for operation in operations:
+            try:
+                self.__check_lease()
+                self.__reset_relmon(
+                    operation["relmon_id"], database, operation["user_info"]
+                )
+            except Exception:
+                operation_queue.release(operations)
+                raise
+
+            operations = operations[1:]
+            operation_queue.ack([operation])
 
+    def __check_relmons(self, relmons_to_check, database):
+        """
+        Check HTCondor status of given relmons and collect output of finished ones
+        Return number of finished relmons
+        """
         self.logger.info(
             "Relmons to check (%s): %s.",
             len(relmons_to_check),
             ", ".join(r.get("id") for r in relmons_to_check),
         )
-        for relmon_json in relmons_to_check:
-            relmon = RelMon(relmon_json)
-            self.__check_if_running(relmon, database)
-            relmon = RelMon(database.get_relmon(relmon.get_id()))
-            condor_status = relmon.get_condor_status()
-            if condor_status in ("DONE", "REMOVED"):
-                # Refetch after check if running save
-                self.__collect_output(relmon, database)
-
-        # Submit relmons
-        relmons_to_submit = database.get_relmons_with_status("new")
+        relmons_to_check = [RelMon(relmon_json) for relmon_json in relmons_to_check]
+        self.__check_lease()
+        with metrics.TICK_PHASE_SECONDS.time(phase="check"):
+            condor_statuses = self.__check_if_running(relmons_to_check, database)
+
+        finished_ids = [
+            relmon_id
+            for relmon_id, condor_status in condor_statuses.items()
+            if condor_status in ("DONE", "REMOVED")
+        ]
+        if not finished_ids:
+            return 0
+
+        with metrics.TICK_PHASE_SECONDS.time(phase="collect"):
+            workers = min(self.submission_workers, len(finished_ids))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(self.__collect_finished, relmon_id, database): relmon_id
+                    for relmon_id in finished_ids
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except LeaseLost:
+                        raise
+                    except Exception as ex:
+                        self.logger.error(
+                            "Exception while collecting %s: %s", futures[future], str(ex)
+                        )
+
+        return len(finished_ids)
+
+    def __collect_finished(self, relmon_id, database):
+        """
+        Refetch finished RelMon and collect it's output
+        """
+        # Refetch after check if running save
+        relmon = RelMon(database.get_relmon(relmon_id))
+        self.__check_lease()
+        self.__collect_output(relmon, database)
+
+    def __check_lease(self):
+        """
+        Raise LeaseLost if tick is done by a leader that lost the lease
+        """
+        if self.leader_election:
+            self.leader_election.check(self.lease_token)
+
+    def __submit_new_relmons(self, relmons_to_submit, database):
+        """
+        Submit given new relmons
+        """
         self.logger.info(
             "Relmons to submit (%s): %s.",
             len(relmons_to_submit),
             ", ".join(r.get("id") for r in relmons_to_submit),
         )
-        for relmon_json in relmons_to_submit:
-            relmon = RelMon(relmon_json)
-            if "NOSUBMIT" in relmon.get_name():
-                continue
+        relmons_to_submit = [RelMon(relmon_json) for relmon_json in relmons_to_submit]
+        # Double check and if it is new, submit it
+        relmons_to_submit = [
+            relmon
+            for relmon in relmons_to_submit
+            if "NOSUBMIT" not in relmon.get_name() and relmon.get_status() == "new"
+        ]
+        self.__submit_relmons(relmons_to_submit, database)
 
-            status = relmon.get_status()
-            if status == "new":
-                # Double check and if it is new, submit it
-                self.__submit_to_condor(relmon, database)
+    def mark_dirty(self, relmon_id):
+        """
+        Mark relmon as dirty so it would be processed during next tick
+        """
+        self.logger.info("Marking %s as dirty", relmon_id)
+        OperationQueue().enqueue(str(relmon_id), "check")
 
-        self.ssh_executor.close_connections()
-        tick_end = time.time()
-        self.logger.info("Controller tick finished. Took %.2fs", tick_end - tick_start)
+    def has_dirty_relmons(self):
+        """
+        Return whether there are relmons waiting to be processed
+        or a full sweep was requested
+        """
+        operations = OperationQueue()
+        return operations.has_pending("sweep") or operations.has_pending("check")
+
+    def request_sweep(self):
+        """
+        Make next tick do a full sweep of all relmons
+        Request is stored in the database, so it reaches the leader even if
+        it was made to another replica
+        """
+        OperationQueue().enqueue("all", "sweep")
 
     def add_to_reset_list(self, relmon_id, user_info):
         """
-        Add relmon id to list of ids to be reset during next tick
+        Add relmon id to queue of ids to be reset during next tick
         """
-        self.logger.info("Will add %s to reset list", relmon_id)
         relmon_id = str(relmon_id)
-        for item in self.relmons_to_reset:
-            if item["id"] == relmon_id:
-                return
-
-        self.relmons_to_reset.append({"id": str(relmon_id), "user_info": user_info})
-        self.logger.info("Added %s to reset list", relmon_id)
+        OperationQueue().enqueue(relmon_id, "reset", user_info)
+        self.logger.info("Added %s to reset queue", relmon_id)
 
     def add_to_delete_list(self, relmon_id, user_info):
         """
-        Add relmon id to list of ids to be deleted during next tick
+        Add relmon id to queue of ids to be deleted during next tick
         """
-        self.logger.info("Will add %s to delete list", relmon_id)
         relmon_id = str(relmon_id)
-        for item in self.relmons_to_delete:
-            if item["id"] == relmon_id:
-                return
-
-        self.relmons_to_delete.append({"id": str(relmon_id), "user_info": user_info})
-        self.logger.info("Added %s to delete list", relmon_id)
+        OperationQueue().enqueue(relmon_id, "delete", user_info)
+        self.logger.info("Added %s to delete queue", relmon_id)
 
     def create_relmon(self, relmon, database, user_info):
         """
         Create relmon from the supplied dictionary
+        Return whether it was created, it is not if name or ID is taken
         """
         relmon.reset()
         relmon.set_user_info(user_info)
-        database.create_relmon(relmon)
+        if not database.create_relmon(relmon):
+            self.logger.error("Relmon %s could not be created", relmon)
+            return False
+
         self.logger.info("Relmon %s was created", relmon)
+        return True
 
     def rename_relmon_reports(self, relmon_id, new_name):
         """
         Rename relmon reports file
         """
-        self.ssh_executor.execute_command(
-            [
-                "cd %s" % (self.file_creator.web_location),
-                "EXISTING_REPORT=$(ls -1 %s*.sqlite | head -n 1)" % (relmon_id),
-                'echo "Existing file name: $EXISTING_REPORT"',
-                'mv "$EXISTING_REPORT" "%s___%s.sqlite"' % (relmon_id, new_name),
-            ]
-        )
+        with metrics.SSH_COMMAND_SECONDS.time(command="rename"):
+            self.ssh_executor.execute_command(
+                [
+                    "cd %s" % (self.file_creator.web_location),
+                    "EXISTING_REPORT=$(ls -1 %s*.sqlite | head -n 1)" % (relmon_id),
+                    'echo "Existing file name: $EXISTING_REPORT"',
+                    'mv "$EXISTING_REPORT" "%s___%s.sqlite"' % (relmon_id, new_name),
+                ]
+            )
 
     def edit_relmon(self, new_relmon, database, user_info):
         """
         Update relmon categories
+        If RelMon changes in the database at the same time, edit is applied
+        again to the changed RelMon
+        Return whether edit was saved, it is not if e.g. name is taken
         """
         relmon_id = new_relmon.get_id()
-        old_relmon_data = database.get_relmon(relmon_id)
-        old_relmon = RelMon(old_relmon_data)
+        actions = {}
+
+        def apply_edit(old_relmon):
+            actions.clear()
+            self.__apply_edit(old_relmon, new_relmon, user_info, actions)
+
+        old_relmon = RelMon(database.get_relmon(relmon_id))
+        old_relmon = database.update_relmon_with_retry(old_relmon, apply_edit)
+        if not old_relmon:
+            self.logger.error("Could not save edit of %s", relmon_id)
+            return False
+
+        # Actions outside of the database are done only once edit is saved
+        if actions.get("rename"):
+            self.rename_relmon_reports(relmon_id, actions["rename"])
+
+        if actions.get("reset"):
+            self.add_to_reset_list(relmon_id, user_info)
+
+        self.logger.info("Relmon %s was edited", old_relmon)
+        return True
+
+    def __apply_edit(self, old_relmon, new_relmon, user_info, actions):
+        """
+        Apply new name and categories to old RelMon
+        Reports that have to be renamed and whether RelMon has to be
+        reset are put to actions
+        """
         if old_relmon.get_status() == "done":
             self.logger.info(
                 "Relmon %s is done, will try to do a smart edit", old_relmon
@@ -238,7 +567,7 @@ class Controller:
                     old_relmon.get_category(category_name).update(new_category)
                     old_relmon.reset_category(category_name)
 
-            name_changed = old_relmon_data["name"] != new_relmon.get_name()
+            name_changed = old_relmon.get_name() != new_relmon.get_name()
             if name_changed or categories_changed:
                 new_name = new_relmon.get_name()
                 if not categories_changed:
@@ -248,7 +577,7 @@ class Controller:
                         old_relmon,
                         new_name,
                     )
-                    self.rename_relmon_reports(relmon_id, new_name)
+                    actions["rename"] = new_name
                 else:
                     # Categories changed, will have to resubmit
                     # Reset relmon without resetting all categories
@@ -256,7 +585,6 @@ class Controller:
 
                 old_relmon.set_name(new_name)
                 old_relmon.set_user_info(user_info)
-                database.update_relmon(old_relmon)
             else:
                 self.logger.info("Nothing changed for %s?", old_relmon)
 
@@ -268,85 +596,103 @@ class Controller:
             )
             # Update only name and categories, do not allow to update anything else
             old_relmon.reset()
-            database.update_relmon(old_relmon)
-            self.add_to_reset_list(relmon_id, user_info)
+            actions["reset"] = True
 
-        self.logger.info("Relmon %s was edited", old_relmon)
+    def __submit_relmons(self, relmons, database):
+        """
+        Submit given RelMons to HTCondor using a bounded pool of workers
+        Workers share connections of the SSH connection pool
+        """
+        if not relmons:
+            return
+
+        self.resource_estimator.refresh(database)
+        workers = min(self.submission_workers, len(relmons))
+        self.logger.info("Will submit %s RelMons using %s workers", len(relmons), workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(self.__submit_to_condor, relmon, database): relmon
+                for relmon in relmons
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except LeaseLost:
+                    raise
+                except Exception as ex:
+                    self.logger.error(
+                        "Exception while submitting %s: %s", futures[future], str(ex)
+                    )
 
     def __submit_to_condor(self, relmon, database):
         """
         Take relmon object and submit it to HTCondor
         """
         relmon_id = relmon.get_id()
-        local_relmon_directory = "relmons/%s" % (relmon_id)
-        if not os.path.isdir(local_relmon_directory):
-            os.mkdir(local_relmon_directory)
-
         remote_relmon_directory = "%s/%s" % (self.remote_directory, relmon_id)
         self.logger.info("Will submit %s to HTCondor", relmon)
         self.logger.info(
             "Remote directory of %s is %s", relmon, remote_relmon_directory
         )
-        self.logger.info("Saving %s to database", relmon)
-        database.update_relmon(relmon)
-        # Refetch after update
-        relmon = RelMon(database.get_relmon(relmon_id))
+        self.__check_lease()
+        relmon.set_resources(self.resource_estimator.estimate(relmon))
+        parts = self.__split_into_parts(relmon) if HTCONDOR_FANOUT else []
+        if len(parts) > 1:
+            # Parts run in parallel, merge job takes about 15 minutes
+            relmon.get_resources()["wall_time"] = (
+                max(x["resources"]["wall_time"] for x in parts) + 900
+            )
+            relmon.get_json()["fanout"] = len(parts)
+            self.logger.info("%s will be split into %s parts", relmon, len(parts))
+        else:
+            parts = []
+            relmon.get_json().pop("fanout", None)
+
+        relmon.get_json()["expected_runtime"] = relmon.get_expected_runtime()
         self.logger.info(
-            "Resources for %s: CPU: %s, memory: %s, disk %s",
+            "Resources for %s: CPU: %s, memory: %s, disk %s, expected runtime %ss (%s)",
             relmon,
             relmon.get_cpu(),
             relmon.get_memory(),
             relmon.get_disk(),
+            relmon.get_json()["expected_runtime"],
+            relmon.get_resources()["source"],
         )
         try:
-            self.logger.info("Will create files for %s", relmon)
-            # Dump the json to a file
-            self.file_creator.create_relmon_file(relmon)
-            # Create HTCondor submit file
-            self.file_creator.create_condor_job_file(relmon)
-            # Create actual job script file
-            self.file_creator.create_job_script_file(relmon)
-
-            self.logger.info("Will prepare remote directory for %s", relmon)
-            # Prepare remote directory. Delete old one and create a new one
-            self.ssh_executor.execute_command(
-                [
-                    "rm -rf %s" % (remote_relmon_directory),
-                    "mkdir -p %s" % (remote_relmon_directory),
-                ]
-            )
+            self.logger.info("Will create job bundle for %s", relmon)
+            # Relmon json, HTCondor submit file and job script in one archive
+            bundle = self.file_creator.create_job_bundle(relmon, parts)
+            if parts:
+                submit_command = "condor_submit_dag RELMON_%s.dag" % (relmon_id)
+            else:
+                submit_command = "condor_submit RELMON_%s.sub" % (relmon_id)
 
-            self.logger.info("Will upload files for %s", relmon)
-            # Upload relmon json, submit file and script to run
-            local_name = "%s/RELMON_%s" % (local_relmon_directory, relmon_id)
-            remote_name = "%s/RELMON_%s" % (remote_relmon_directory, relmon_id)
-            self.ssh_executor.upload_file(
-                "%s.json" % (local_name), "%s.json" % (remote_name)
-            )
-            self.ssh_executor.upload_file(
-                "%s.sub" % (local_name), "%s.sub" % (remote_name)
-            )
-            self.ssh_executor.upload_file(
-                "%s.sh" % (local_name), "%s.sh" % (remote_name)
+            self.logger.info(
+                "Will upload %sB job bundle and submit %s", len(bundle), relmon
             )
-
-            self.logger.info("Will try to submit %s", relmon)
-            # Run condor_submit
+            # Delete old remote directory, create a new one, unpack the bundle
+            # from stdin and run condor_submit all in one command
             # Submission happens through lxplus as condor is not available on website machine
             # It is easier to ssh to lxplus than set up condor locally
-            stdout, stderr, _ = self.ssh_executor.execute_command(
-                [
-                    "cd %s" % (remote_relmon_directory),
-                    "voms-proxy-init -voms cms --valid 24:00 --out $(pwd)/proxy.txt",
-                    "module load %s && condor_submit RELMON_%s.sub"
-                    % (HTCONDOR_MODULE, relmon_id),
-                ]
-            )
-            # Parse result of condor_submit
-            if stdout and "1 job(s) submitted to cluster" in stdout:
-                # output is "1 job(s) submitted to cluster 801341"
+            with metrics.SSH_COMMAND_SECONDS.time(command="condor_submit"):
+                stdout, stderr, _ = self.ssh_executor.execute_command_with_input(
+                    [
+                        "rm -rf %s" % (remote_relmon_directory),
+                        "mkdir -p %s" % (remote_relmon_directory),
+                        "cd %s && tar -xzf -" % (remote_relmon_directory),
+                        "voms-proxy-init -voms cms --valid 24:00 --out $(pwd)/proxy.txt",
+                        "module load %s && %s" % (HTCONDOR_MODULE, submit_command),
+                    ],
+                    bundle,
+                )
+            # Parse result of condor_submit, output contains
+            # "1 job(s) submitted to cluster 801341."
+            # For DAG it is the cluster of DAGMan job, that runs until all parts
+            # and merge job are done, so RelMon is tracked as one job
+            submitted = re.search(r"1 job\(s\) submitted to cluster (\d+)", stdout or "")
+            if submitted:
                 relmon.set_status("submitted")
-                condor_id = int(float(stdout.split()[-1]))
+                condor_id = int(submitted.group(1))
                 relmon.set_condor_id(condor_id)
                 relmon.set_condor_status("IDLE")
                 self.logger.info("Submitted %s. Condor job id %s", relmon, condor_id)
@@ -366,48 +712,151 @@ class Controller:
             )
 
         self.logger.info("%s status is %s", relmon, relmon.get_status())
-        database.update_relmon(relmon)
+        submission = {x: relmon.get_json().get(x) for x in self.SUBMISSION_FIELDS}
+
+        def apply_submission(target):
+            for key, value in submission.items():
+                if value is None:
+                    target.get_json().pop(key, None)
+                else:
+                    target.get_json()[key] = value
 
-    def __check_if_running(self, relmon, database):
+        self.logger.info("Saving %s to database", relmon)
+        if not database.update_relmon_with_retry(relmon, apply_submission):
+            self.logger.error("Could not save submission of %s", relmon)
+
+    def __split_into_parts(self, relmon):
         """
-        Check if given RelMon is running in HTCondor and get it's status there
+        Split RelMon into parts that are run as separate jobs
+        Each category is a part, categories that are compared both with
+        and without HLT are split into two parts
+        Return list of parts with their estimated resources
         """
-        relmon_condor_id = relmon.get_condor_id()
+        parts = []
+        for category in relmon.get_json()["categories"]:
+            if category["status"] != "initial":
+                continue
+
+            if not category["reference"] or not category["target"]:
+                continue
+
+            category_name = category["name"]
+            if category.get("hlt") == "both" and category_name.lower() != "generator":
+                hlt_flags = [("yes", "only"), ("no", "no")]
+            else:
+                hlt_flags = [(None, category.get("hlt"))]
+
+            for hlt_flag, hlt in hlt_flags:
+                # RelMon with only this category is used for estimation
+                part_relmon = RelMon(
+                    {
+                        "id": relmon.get_id(),
+                        "name": relmon.get_name(),
+                        "categories": [dict(category, hlt=hlt)],
+                    }
+                )
+                parts.append(
+                    {
+                        "category": category_name,
+                        "hlt": hlt_flag,
+                        "resources": self.resource_estimator.estimate(part_relmon),
+                    }
+                )
+
+        return parts
+
+    def __check_if_running(self, relmons, database):
+        """
+        Check if given RelMons are running in HTCondor and get their status there
+        All RelMons are checked with a single condor_q and, for jobs that already
+        left the queue, a single condor_history command
+        Return dictionary of RelMon ids and their new HTCondor statuses
+        """
+        condor_ids = {}
+        for relmon in relmons:
+            relmon_condor_id = relmon.get_condor_id()
+            if relmon_condor_id > 0:
+                condor_ids[relmon_condor_id] = relmon
+
         self.logger.info(
-            "Will check if %s is running in HTCondor, id: %s", relmon, relmon_condor_id
-        )
-        stdout, stderr, _ = self.ssh_executor.execute_command(
-            "module load %s && condor_q -af:h ClusterId JobStatus | "
-            "grep %s" % (HTCONDOR_MODULE, relmon_condor_id)
+            "Will check if %s RelMons are running in HTCondor, ids: %s",
+            len(condor_ids),
+            ", ".join(str(x) for x in condor_ids),
         )
-        new_condor_status = "<unknown>"
-        if stdout and not stderr:
-            status_number = stdout.split()[-1]
-            self.logger.info("Relmon %s status is %s", relmon, status_number)
-            status_dict = {
-                "0": "UNEXPLAINED",
-                "1": "IDLE",
-                "2": "RUN",
-                "3": "REMOVED",
-                "4": "DONE",
-                "5": "HOLD",
-                "6": "SUBMISSION ERROR",
-            }
-            new_condor_status = status_dict.get(status_number, "REMOVED")
+        cluster_statuses = {}
+        if condor_ids:
+            cluster_statuses = self.__query_condor("condor_q", list(condor_ids))
+
+        if cluster_statuses is None:
+            # HTCondor is not available, all statuses are unknown
+            cluster_statuses = {}
         else:
+            missing_ids = [x for x in condor_ids if x not in cluster_statuses]
+            if missing_ids:
+                self.logger.info(
+                    "Jobs %s are not in the queue, will look in the history",
+                    ", ".join(str(x) for x in missing_ids),
+                )
+                history_statuses = self.__query_condor("condor_history", missing_ids)
+                cluster_statuses.update(history_statuses or {})
+
+        condor_statuses = {}
+        for relmon in relmons:
+            status_number = cluster_statuses.get(relmon.get_condor_id())
+            if status_number is None:
+                new_condor_status = "<unknown>"
+            else:
+                new_condor_status = self.CONDOR_STATUSES.get(status_number, "REMOVED")
+
+            self.logger.info("Relmon %s condor status is %s", relmon, new_condor_status)
+            condor_statuses[relmon.get_id()] = new_condor_status
+
+        changed_statuses = {
+            relmon.get_id(): condor_statuses[relmon.get_id()]
+            for relmon in relmons
+            if relmon.get_condor_status() != condor_statuses[relmon.get_id()]
+        }
+        self.logger.info(
+            "Saving %s changed condor statuses: %s", len(changed_statuses), changed_statuses
+        )
+        database.set_condor_statuses(changed_statuses)
+        return condor_statuses
+
+    def __query_condor(self, command, condor_ids):
+        """
+        Run condor_q or condor_history for given cluster ids
+        Return dictionary of cluster ids and job status numbers or None if
+        HTCondor could not be queried
+        """
+        constraint = " || ".join("ClusterId == %s" % (x) for x in condor_ids)
+        limit = " -limit %s" % (len(condor_ids)) if command == "condor_history" else ""
+        with metrics.SSH_COMMAND_SECONDS.time(command=command):
+            stdout, stderr, _ = self.ssh_executor.execute_command(
+                "module load %s && %s -constraint '%s'%s -af ClusterId JobStatus"
+                % (HTCONDOR_MODULE, command, constraint, limit),
+                retry=True,
+            )
+
+        if stderr and not stdout:
             self.logger.error(
-                "Error with HTCondor?\nOutput: %s.\nError %s", stdout, stderr
+                "Error with HTCondor %s?\nOutput: %s.\nError %s", command, stdout, stderr
             )
+            return None
 
-        relmon = RelMon(database.get_relmon(relmon.get_id()))
-        self.logger.info("Saving %s condor status as %s", relmon, new_condor_status)
-        relmon.set_condor_status(new_condor_status)
-        database.update_relmon(relmon)
+        cluster_statuses = {}
+        for line in stdout.splitlines():
+            line = line.split()
+            if len(line) != 2 or not line[0].isdigit():
+                continue
+
+            cluster_statuses[int(line[0])] = line[1]
+
+        return cluster_statuses
 
     def __collect_output(self, relmon, database):
         """
-        When RelMon finishes running in HTCondor, download it's output logs, zip them
-        and send to relevant user via email
+        When RelMon finishes running in HTCondor, download it's output logs
+        as a single archive and send it to relevant user via email
         """
         condor_status = relmon.get_condor_status()
         if condor_status not in ["DONE", "REMOVED"]:
@@ -416,59 +865,108 @@ class Controller:
             )
             return
 
-        logging.info("Collecting output for %s", relmon)
+        self.logger.info("Collecting output for %s", relmon)
         relmon_id = relmon.get_id()
         remote_relmon_directory = "%s/%s" % (self.remote_directory, relmon_id)
-        local_relmon_directory = "relmons/%s" % (relmon_id)
+        log_files = [
+            "validation_matrix.log",
+            "RELMON_%s.out" % (relmon_id),
+            "RELMON_%s.log" % (relmon_id),
+            "RELMON_%s.err" % (relmon_id),
+        ]
+        if relmon.get_json().get("fanout"):
+            # Logs of parts and DAGMan
+            log_files += [
+                "validation_matrix_part_*.log",
+                "RELMON_%s_part_*.out" % (relmon_id),
+                "RELMON_%s_part_*.log" % (relmon_id),
+                "RELMON_%s_part_*.err" % (relmon_id),
+                "RELMON_%s.dag.dagman.out" % (relmon_id),
+            ]
 
-        self.ssh_executor.download_file(
-            "%s/validation_matrix.log" % (remote_relmon_directory),
-            "%s/validation_matrix.log" % (local_relmon_directory),
-        )
-        remote_name = "%s/RELMON_%s" % (remote_relmon_directory, relmon_id)
-        local_name = "%s/%s" % (local_relmon_directory, relmon_id)
-        self.ssh_executor.download_file(
-            "%s.out" % (remote_name), "%s.out" % (local_name)
-        )
-        self.ssh_executor.download_file(
-            "%s.log" % (remote_name), "%s.log" % (local_name)
-        )
-        self.ssh_executor.download_file(
-            "%s.err" % (remote_name), "%s.err" % (local_name)
-        )
+        # Compress logs on the submission host and stream the archive
+        # through stdout, missing files are skipped
+        with metrics.SSH_COMMAND_SECONDS.time(command="collect"):
+            archive, stderr, _ = self.ssh_executor.execute_command_with_input(
+                "cd %s && tar -czf - --ignore-failed-read %s"
+                % (remote_relmon_directory, " ".join(log_files)),
+                None,
+                binary_output=True,
+                retry=True,
+            )
 
-        downloaded_files = []
-        if os.path.isfile("%s.out" % (local_name)):
-            downloaded_files.append("%s.out" % (local_name))
+        attachments = []
+        output_location = None
+        if self.__archive_has_files(archive):
+            if len(archive) <= EmailSender.MAX_ATTACHMENT_SIZE:
+                attachments = [("RELMON_%s_logs.tar.gz" % (relmon_id), archive)]
+            else:
+                # Logs are left on the submission host for the user
+                output_location = "%s:%s" % (SUBMISSION_HOST, remote_relmon_directory)
+                self.logger.warning(
+                    "Logs of %s are too big to attach (%sB), keeping them in %s",
+                    relmon,
+                    len(archive),
+                    output_location,
+                )
 
-        if os.path.isfile("%s.log" % (local_name)):
-            downloaded_files.append("%s.log" % (local_name))
+            job_usage = None
+            if not relmon.get_json().get("fanout"):
+                # Job log of the whole RelMon is needed for estimation
+                job_usage = self.__read_job_usage(archive, "RELMON_%s.log" % (relmon_id))
 
-        if os.path.isfile("%s.err" % (local_name)):
-            downloaded_files.append("%s.err" % (local_name))
+        else:
+            job_usage = None
+            self.logger.warning("No logs were collected for %s: %s", relmon, stderr)
 
-        if os.path.isfile("%s/validation_matrix.log" % (local_relmon_directory)):
-            downloaded_files.append(
-                "%s/validation_matrix.log" % (local_relmon_directory)
-            )
+        def finish(target):
+            if job_usage:
+                # Used to estimate resources of future RelMons
+                target.get_json()["job_usage"] = job_usage
 
-        attachments = []
-        if downloaded_files:
-            archive_name = "%s.zip" % (local_name)
-            attachments = [archive_name]
-            with zipfile.ZipFile(archive_name, "w", zipfile.ZIP_DEFLATED) as zip_object:
-                for file_path in downloaded_files:
-                    zip_object.write(file_path, file_path.split("/")[-1])
+            if target.get_status() != "failed":
+                target.set_status("done")
 
+        relmon = database.update_relmon_with_retry(relmon, finish) or relmon
         if relmon.get_status() != "failed":
-            relmon.set_status("done")
-            self.__send_done_notification(relmon, files=attachments)
+            self.__send_done_notification(relmon, attachments, output_location)
         else:
-            self.__send_failed_notification(relmon, files=attachments)
+            self.__send_failed_notification(relmon, attachments, output_location)
+
+        if output_location:
+            # Directory is removed when RelMon is submitted again
+            return
+
+        with metrics.SSH_COMMAND_SECONDS.time(command="cleanup"):
+            self.ssh_executor.execute_command(
+                ["rm -rf %s" % (remote_relmon_directory)]
+            )
+
+    @staticmethod
+    def __archive_has_files(archive):
+        """
+        Return whether given tar.gz archive bytes contain at least one file
+        """
+        if not archive:
+            return False
 
-        database.update_relmon(relmon)
-        shutil.rmtree(local_relmon_directory, ignore_errors=True)
-        self.ssh_executor.execute_command(["rm -rf %s" % (remote_relmon_directory)])
+        try:
+            with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar_file:
+                return tar_file.next() is not None
+        except tarfile.TarError:
+            return False
+
+    def __read_job_usage(self, archive, log_name):
+        """
+        Return resource usage from HTCondor job log in given tar.gz archive
+        """
+        try:
+            with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar_file:
+                log_file = tar_file.extractfile(log_name)
+                return parse_job_log(log_file.read().decode("utf-8", "replace"))
+        except (KeyError, AttributeError, tarfile.TarError, ValueError) as ex:
+            self.logger.warning("Could not read job usage from %s: %s", log_name, ex)
+            return None
 
     def __reset_relmon(self, relmon_id, database, user_info):
         """
@@ -489,9 +987,12 @@ class Controller:
             )
             self.__send_reset_notification(relmon, user_info)
 
-        relmon.reset()
-        relmon.set_user_info(user_info)
-        database.update_relmon(relmon)
+        def reset(target):
+            target.reset()
+            target.set_user_info(user_info)
+
+        # Job that was just terminated might still report it's progress
+        database.update_relmon_with_retry(relmon, reset)
 
     def __delete_relmon(self, relmon_id, database):
         """
@@ -505,6 +1006,12 @@ class Controller:
         if os.path.isdir(local_relmon_directory):
             shutil.rmtree(local_relmon_directory, ignore_errors=True)
 
+        # Logs that were too big to attach might be left there
+        with metrics.SSH_COMMAND_SECONDS.time(command="cleanup"):
+            self.ssh_executor.execute_command(
+                ["rm -rf %s/%s" % (self.remote_directory, relmon_id)]
+            )
+
     def __terminate_relmon(self, relmon):
         """
         Terminate RelMon job in HTCondor
@@ -512,9 +1019,10 @@ class Controller:
         self.logger.info("Trying to terminate %s", relmon)
         condor_id = relmon.get_condor_id()
         if condor_id > 0:
-            self.ssh_executor.execute_command(
-                "module load %s && condor_rm %s" % (HTCONDOR_MODULE, condor_id)
-            )
+            with metrics.SSH_COMMAND_SECONDS.time(command="condor_rm"):
+                self.ssh_executor.execute_command(
+                    "module load %s && condor_rm %s" % (HTCONDOR_MODULE, condor_id)
+                )
         else:
             self.logger.info(
                 "Relmon %s HTCondor id is not valid: %s", relmon, condor_id
@@ -534,9 +1042,25 @@ class Controller:
         body += "RelMon in RelMon Service: %s?q=%s\n" % (self.service_url, relmon_name)
         subject = "RelMon %s was reset" % (relmon_name)
         recipients = [relmon.get_user_info()["email"]]
-        self.email_sender.send(subject, body, recipients)
+        self.email_sender.enqueue(subject, body, recipients)
+
+    @staticmethod
+    def __output_text(files, output_location):
+        """
+        Return sentence of notification body about where job output is
+        """
+        if files:
+            return "You can find job output as an attachment.\n"
+
+        if output_location:
+            return (
+                "Job output was too big to be attached, it is kept in %s "
+                "until RelMon is reset or deleted.\n" % (output_location)
+            )
+
+        return ""
 
-    def __send_done_notification(self, relmon, files=None):
+    def __send_done_notification(self, relmon, files=None, output_location=None):
         """
         Send email notification that RelMon has successfully finished
         """
@@ -545,14 +1069,12 @@ class Controller:
         body += "RelMon %s has finished running.\n" % (relmon_name)
         body += "Reports can be found here: %s?q=%s\n" % (self.reports_url, relmon_name)
         body += "RelMon in RelMon Service: %s?q=%s\n" % (self.service_url, relmon_name)
-        if files:
-            body += "You can find job output as an attachment.\n"
-
+        body += self.__output_text(files, output_location)
         subject = "RelMon %s is done" % (relmon_name)
         recipients = [relmon.get_user_info()["email"]]
-        self.email_sender.send(subject, body, recipients, files)
+        self.email_sender.enqueue(subject, body, recipients, files)
 
-    def __send_failed_notification(self, relmon, files=None):
+    def __send_failed_notification(self, relmon, files=None, output_location=None):
         """
         Send email notification that RelMon has failed
         """
@@ -560,9 +1082,7 @@ class Controller:
         body = "Hello,\n\n"
         body += "RelMon %s has failed.\n" % (relmon_name)
         body += "RelMon in RelMon Service: %s?q=%s\n" % (self.service_url, relmon_name)
-        if files:
-            body += "You can find job output as an attachment.\n"
-
+        body += self.__output_text(files, output_location)
         subject = "RelMon %s failed" % (relmon_name)
         recipients = [relmon.get_user_info()["email"]]
-        self.email_sender.send(subject, body, recipients, files)
+        self.email_sender.enqueue(subject, body, recipients, files)
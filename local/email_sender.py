@@ -3,10 +3,12 @@ Module that handles all email notifications
 """
 import smtplib
 import logging
+import time
 from email import encoders
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
+from mongodb_stores import NotificationOutbox
 from environment import (
     SERVICE_ACCOUNT_USERNAME,
     SERVICE_ACCOUNT_PASSWORD,
@@ -17,66 +19,271 @@ from environment import (
 class EmailSender:
     """
     Email Sender allows to send emails to users using CERN SMTP server
+    Notifications are put to an outbox in the database and are later
+    sent in batches, SMTP session is kept open between sends and checked
+    with NOOP before it is used again
     """
 
-    def __init__(self):
+    SMTP_HOST = "cernmx.cern.ch"
+    SMTP_PORT = 25
+    SENDER = "PdmV Service Account <pdmvserv@cern.ch>"
+    # Number of notifications claimed from the outbox at once
+    BATCH_SIZE = 20
+    # Notification is dropped after this many failed attempts
+    MAX_ATTEMPTS = 5
+    # Delay before first retry, doubled after each failed attempt
+    RETRY_DELAY = 60
+    # Attachments of a notification are stored in the outbox document, so
+    # together they must be well below the 16MB limit of MongoDB documents
+    MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
+    # Session that was idle longer than this is closed instead of reused,
+    # servers drop idle clients anyway
+    MAX_IDLE_TIME = 600
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_tls=True):
         self.logger = logging.getLogger("logger")
         self.smtp = None
+        self.last_used = 0
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
 
     def __setup_smtp(self):
         """
-        Setup SMTP client session
+        Setup and return a new SMTP client session
         """
         self.logger.info(
             "Credentials loaded successfully: %s", SERVICE_ACCOUNT_USERNAME
         )
-        self.smtp = smtplib.SMTP(host="cernmx.cern.ch", port=25)
-        self.smtp.ehlo()
-        self.smtp.starttls()
-        self.smtp.ehlo()
+        smtp = smtplib.SMTP(host=self.host, port=self.port)
+        smtp.ehlo()
+        if self.use_tls:
+            smtp.starttls()
+            smtp.ehlo()
+
         if EMAIL_AUTH_REQUIRED:
-            self.smtp.login(SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD)
+            smtp.login(SERVICE_ACCOUNT_USERNAME, SERVICE_ACCOUNT_PASSWORD)
 
-    def __close_smtp(self):
+        return smtp
+
+    def __close_smtp(self, smtp):
         """
         Close connection to SMTP server
         """
-        self.smtp.quit()
-        self.smtp = None
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError) as ex:
+            self.logger.error("Error closing SMTP session: %s", ex)
 
-    def send(self, subject, body, recipients, files=None):
+    def __ensure_smtp(self):
+        """
+        Reuse open SMTP session if it is still alive, otherwise open a new one
+        """
+        if self.smtp:
+            if time.time() - self.last_used > self.MAX_IDLE_TIME:
+                self.close()
+            else:
+                try:
+                    if self.smtp.noop()[0] == 250:
+                        return
+                except (smtplib.SMTPException, OSError) as ex:
+                    self.logger.info("SMTP session is not alive: %s", ex)
+
+                self.close()
+
+        self.smtp = self.__setup_smtp()
+
+    def close(self):
+        """
+        Close the SMTP session that is kept open between sends
+        """
+        if self.smtp:
+            self.__close_smtp(self.smtp)
+            self.smtp = None
+
+    @classmethod
+    def build_notification(cls, subject, body, recipients, files=None):
         """
-        Send email
+        Create a notification dictionary that can be stored in the outbox
+        Files are either paths or (file name, bytes) tuples
+        Files that do not fit in MAX_ATTACHMENT_SIZE are left out and body
+        says so
         """
         body = body.strip()
+        attachments = []
+        left_out = []
+        size = 0
+        for item in files or []:
+            if isinstance(item, str):
+                with open(item, "rb") as attachment_file:
+                    item = (item.split("/")[-1], attachment_file.read())
+
+            file_name, content = item
+            if size + len(content) > cls.MAX_ATTACHMENT_SIZE:
+                logging.getLogger("logger").warning(
+                    "Attachment %s is too big (%sB), will not attach it",
+                    file_name,
+                    len(content),
+                )
+                left_out.append(file_name)
+                continue
+
+            size += len(content)
+            attachments.append({"name": file_name, "content": content})
+
+        if left_out:
+            body += "\n\n%s could not be attached, because %s too big." % (
+                ", ".join(left_out),
+                "it is" if len(left_out) == 1 else "they are",
+            )
+
         body += "\n\nSincerely,\nRelMon Service"
-        ccs = ["PdmV Service Account <pdmvserv@cern.ch>"]
-        # Create a fancy email message
+
+        return {
+            "subject": "[RelMon] %s" % (subject),
+            "body": body,
+            "recipients": recipients,
+            "ccs": [cls.SENDER],
+            "attachments": attachments,
+        }
+
+    @classmethod
+    def build_message(cls, notification):
+        """
+        Create a fancy email message from a notification dictionary
+        """
         message = MIMEMultipart()
-        message["Subject"] = "[RelMon] %s" % (subject)
-        message["From"] = "PdmV Service Account <pdmvserv@cern.ch>"
-        message["To"] = ", ".join(recipients)
-        message["Cc"] = ", ".join(ccs)
+        message["Subject"] = notification["subject"]
+        message["From"] = cls.SENDER
+        message["To"] = ", ".join(notification["recipients"])
+        message["Cc"] = ", ".join(notification["ccs"])
         # Set body text
-        message.attach(MIMEText(body))
-        if files:
-            for path in files:
-                attachment = MIMEBase("application", "octet-stream")
-                with open(path, "rb") as attachment_file:
-                    attachment.set_payload(attachment_file.read())
-
-                file_name = path.split("/")[-1]
-                encoders.encode_base64(attachment)
-                attachment.add_header(
-                    "Content-Disposition", 'attachment; filename="%s"' % (file_name)
-                )
-                message.attach(attachment)
+        message.attach(MIMEText(notification["body"]))
+        for file_info in notification.get("attachments", []):
+            attachment = MIMEBase("application", "octet-stream")
+            attachment.set_payload(bytes(file_info["content"]))
+            encoders.encode_base64(attachment)
+            attachment.add_header(
+                "Content-Disposition",
+                'attachment; filename="%s"' % (file_info["name"]),
+            )
+            message.attach(attachment)
 
-        self.logger.info('Will send "%s" to %s', message["Subject"], message["To"])
-        self.__setup_smtp()
+        return message
+
+    def enqueue(self, subject, body, recipients, files=None):
+        """
+        Put email to the outbox, it will be sent by send_pending
+        """
+        notification = self.build_notification(subject, body, recipients, files)
+        self.logger.info(
+            'Will put "%s" for %s to outbox',
+            notification["subject"],
+            ", ".join(recipients),
+        )
+        NotificationOutbox().enqueue(notification)
+
+    def send(self, subject, body, recipients, files=None):
+        """
+        Send email immediately over a new SMTP session
+        """
+        notification = self.build_notification(subject, body, recipients, files)
+        smtp = self.__setup_smtp()
         try:
-            self.smtp.sendmail(message["From"], recipients + ccs, message.as_string())
+            self.__send_notification(smtp, notification)
         except Exception as ex:
             self.logger.error(ex)
         finally:
-            self.__close_smtp()
+            self.__close_smtp(smtp)
+
+    def __send_notification(self, smtp, notification):
+        """
+        Send notification over already open SMTP session
+        """
+        message = self.build_message(notification)
+        self.logger.info('Will send "%s" to %s', message["Subject"], message["To"])
+        smtp.sendmail(
+            message["From"],
+            notification["recipients"] + notification["ccs"],
+            message.as_string(),
+        )
+
+    def send_pending(self, outbox=None):
+        """
+        Send all notifications from the outbox over the kept open SMTP
+        session, session stays open for the next call
+        Notifications that could not be sent are retried later with a backoff
+        Return number of sent notifications
+        """
+        if outbox is None:
+            outbox = NotificationOutbox()
+
+        sent = 0
+        checked = False
+        while True:
+            notifications = outbox.claim(self.BATCH_SIZE)
+            if not notifications:
+                break
+
+            if not checked:
+                # Session is checked once per call, following batches
+                # use it right after the previous one
+                try:
+                    self.__ensure_smtp()
+                    checked = True
+                except Exception as ex:
+                    self.logger.error("Could not connect to SMTP server: %s", ex)
+                    self.smtp = None
+                    self.__retry_later(notifications, outbox)
+                    break
+
+            sent_ids = []
+            failed = []
+            for notification in notifications:
+                try:
+                    self.__send_notification(self.smtp, notification)
+                    sent_ids.append(notification["_id"])
+                except smtplib.SMTPServerDisconnected as ex:
+                    self.logger.error("SMTP server disconnected: %s", ex)
+                    self.smtp = None
+                    failed.append(notification)
+                    break
+                except Exception as ex:
+                    self.logger.error(
+                        'Error sending "%s": %s', notification["subject"], ex
+                    )
+                    failed.append(notification)
+
+            self.last_used = time.time()
+            outbox.ack(sent_ids)
+            sent += len(sent_ids)
+            # Notifications not attempted because of disconnect
+            processed = set(sent_ids) | set(x["_id"] for x in failed)
+            failed.extend(x for x in notifications if x["_id"] not in processed)
+            self.__retry_later(failed, outbox)
+            if not self.smtp:
+                break
+
+        if sent:
+            self.logger.info("Sent %s notifications from outbox", sent)
+
+        return sent
+
+    def __retry_later(self, notifications, outbox):
+        """
+        Schedule another attempt of failed notifications or drop them
+        if they failed too many times
+        """
+        for notification in notifications:
+            attempts = notification.get("attempts", 0) + 1
+            if attempts >= self.MAX_ATTEMPTS:
+                self.logger.error(
+                    'Giving up on "%s" after %s attempts',
+                    notification["subject"],
+                    attempts,
+                )
+                outbox.ack([notification["_id"]])
+                continue
+
+            next_attempt = time.time() + self.RETRY_DELAY * 2 ** (attempts - 1)
+            outbox.release(notification["_id"], attempts, next_attempt)
@@ -1,7 +1,10 @@
 """
 Module for FileCreator
 """
+import io
 import json
+import tarfile
+import time
 from environment import (
     REMOTE_DIRECTORY,
     WEB_LOCATION_PATH,
@@ -54,26 +57,85 @@ class FileCreator:
             "scram b -j 4",
         ]
 
-    def create_job_script_file(self, relmon):
+    def create_job_bundle(self, relmon, parts=None):
         """
-        Create bash executable for condor
+        Create in-memory gzipped tar archive with RelMon JSON, HTCondor
+        submit file and bash executable for condor
+        If parts are given, archive contains a job for each part, a merge
+        job and a DAG that runs merge job after all parts are done
         """
         relmon_id = relmon.get_id()
-        cpus = relmon.get_cpu()
-        relmon_name = relmon.get_name()
-        script_file_name = "relmons/%s/RELMON_%s.sh" % (relmon_id, relmon_id)
-        old_web_sqlite_path = "%s/%s*.sqlite" % (self.web_location, relmon_id)
-        web_sqlite_path = '"%s/%s___%s.sqlite"' % (
-            self.web_location,
-            relmon_id,
-            relmon_name,
-        )
-        callback_credentials = (
-            "--callback-credentials"
-            if not DISABLE_CALLBACK_CREDENTIALS
-            else ""
-        )
-        script_file_content = [
+        bundle_files = [
+            ("RELMON_%s.json" % (relmon_id), self.create_relmon_file(relmon), 0o644),
+        ]
+        if not parts:
+            bundle_files += [
+                ("RELMON_%s.sub" % (relmon_id), self.create_condor_job_file(relmon), 0o644),
+                ("RELMON_%s.sh" % (relmon_id), self.create_job_script_file(relmon), 0o755),
+            ]
+        else:
+            for index, part in enumerate(parts):
+                job_name = "RELMON_%s_part_%s" % (relmon_id, index)
+                condor_file = self.create_condor_job_file(
+                    relmon,
+                    job_name,
+                    part["resources"],
+                    output_files=[
+                        "%s.json" % (job_name),
+                        "Reports_part_%s.tar.gz" % (index),
+                        "validation_matrix_part_%s.log" % (index),
+                    ],
+                )
+                script_file = self.create_part_script_file(relmon, index, part)
+                bundle_files += [
+                    ("%s.sub" % (job_name), condor_file, 0o644),
+                    ("%s.sh" % (job_name), script_file, 0o755),
+                ]
+
+            part_files = []
+            for index in range(len(parts)):
+                part_files += [
+                    "RELMON_%s_part_%s.json" % (relmon_id, index),
+                    "Reports_part_%s.tar.gz" % (index),
+                ]
+
+            merge_resources = {
+                "cpus": 1,
+                "memory_mb": 2048,
+                "disk_mb": relmon.step_table_disk_mb(relmon.get_relval_count()),
+            }
+            condor_file = self.create_condor_job_file(
+                relmon,
+                resources=merge_resources,
+                input_files=["RELMON_%s.json" % (relmon_id), "proxy.txt"] + part_files,
+            )
+            bundle_files += [
+                ("RELMON_%s.sub" % (relmon_id), condor_file, 0o644),
+                (
+                    "RELMON_%s.sh" % (relmon_id),
+                    self.create_merge_script_file(relmon, len(parts)),
+                    0o755,
+                ),
+                ("RELMON_%s.dag" % (relmon_id), self.create_dag_file(relmon, len(parts)), 0o644),
+            ]
+
+        bundle = io.BytesIO()
+        with tarfile.open(fileobj=bundle, mode="w:gz") as tar_file:
+            for file_name, file_content, file_mode in bundle_files:
+                file_content = file_content.encode("utf-8")
+                file_info = tarfile.TarInfo(file_name)
+                file_info.size = len(file_content)
+                file_info.mtime = int(time.time())
+                file_info.mode = file_mode
+                tar_file.addfile(file_info, io.BytesIO(file_content))
+
+        return bundle.getvalue()
+
+    def create_clone_commands(self):
+        """
+        Return commands that set up the job directory and clone RelMon service
+        """
+        return [
             "#!/bin/bash",
             "DIR=$(pwd)",
             "export HOME=$(pwd)",
@@ -88,6 +150,13 @@ class FileCreator:
             "  unzip master.zip",
             "  mv RelmonService2-master relmonservice2",
             "fi",
+        ]
+
+    def create_cmssw_commands(self):
+        """
+        Return commands that set up CMSSW and open a scope with it's environment
+        """
+        commands = [
             # CMSSW environment setup
             "source /cvmfs/cms.cern.ch/cmsset_default.sh",
             "scramv1 project CMSSW $RELMON_CMSSW_RELEASE",
@@ -98,23 +167,29 @@ class FileCreator:
         ]
 
         # Check if a custom cms-sw source is requested to be loaded
-        custom_cmssw_content = self.load_custom_cmssw()
-        if custom_cmssw_content:
-            script_file_content += custom_cmssw_content
+        commands += self.load_custom_cmssw()
+        return commands
 
-        script_file_content += [
-            "cd ../..",
-            # Create reports directory
-            "mkdir -p Reports",
-            # Run the remote apparatus
-            "python3 relmonservice2/remote/remote_apparatus.py "  # No newline
-            "-r RELMON_%s.json -p proxy.txt --cpus %s --callback %s %s"
-            % (relmon_id, cpus, self.callback_url, callback_credentials),
-            # Close scope for CMSSW
-            ")",
-            "cd $DIR",
-            # Remove all root files
-            "rm *.root",
+    def callback_credentials(self):
+        """
+        Return argument of remote apparatus to authenticate callbacks
+        """
+        return "--callback-credentials" if not DISABLE_CALLBACK_CREDENTIALS else ""
+
+    def create_publish_commands(self, relmon):
+        """
+        Return commands that convert Reports directory to SQLite file, copy
+        it to web location and notify that RelMon is done
+        """
+        relmon_id = relmon.get_id()
+        relmon_name = relmon.get_name()
+        old_web_sqlite_path = "%s/%s*.sqlite" % (self.web_location, relmon_id)
+        web_sqlite_path = '"%s/%s___%s.sqlite"' % (
+            self.web_location,
+            relmon_id,
+            relmon_name,
+        )
+        return [
             # Copy sqlitify to Reports directory
             "cp relmonservice2/remote/sqltify.py Reports/sqltify.py",
             # Go to reports directory
@@ -156,34 +231,155 @@ class FileCreator:
             "cp cookie.txt relmonservice2/remote",
             "python3 relmonservice2/remote/remote_apparatus.py "  # No newlines here
             "-r RELMON_%s.json --callback %s --notifydone %s"
-            % (relmon_id, self.callback_url, callback_credentials),
+            % (relmon_id, self.callback_url, self.callback_credentials()),
         ]
 
-        script_file_content_string = "\n".join(script_file_content)
-        with open(script_file_name, "w") as output_file:
-            output_file.write(script_file_content_string)
+    def create_job_script_file(self, relmon):
+        """
+        Create bash executable for condor and return it as a string
+        """
+        relmon_id = relmon.get_id()
+        cpus = relmon.get_cpu()
+        script_file_content = self.create_clone_commands()
+        script_file_content += self.create_cmssw_commands()
+        script_file_content += [
+            "cd ../..",
+            # Create reports directory
+            "mkdir -p Reports",
+            # Run the remote apparatus
+            "python3 relmonservice2/remote/remote_apparatus.py "  # No newline
+            "-r RELMON_%s.json -p proxy.txt --cpus %s --callback %s %s"
+            % (relmon_id, cpus, self.callback_url, self.callback_credentials()),
+            # Close scope for CMSSW
+            ")",
+            "cd $DIR",
+            # Remove all root files
+            "rm *.root",
+        ]
+        script_file_content += self.create_publish_commands(relmon)
+        return "\n".join(script_file_content)
+
+    def create_part_script_file(self, relmon, index, part):
+        """
+        Create bash executable for condor job of one part of RelMon - one
+        category, compared with or without HLT - and return it as a string
+        Job packs it's Reports directory, merge job puts them together
+        """
+        relmon_id = relmon.get_id()
+        part_json = "RELMON_%s_part_%s.json" % (relmon_id, index)
+        hlt_argument = "--hlt %s" % (part["hlt"]) if part.get("hlt") else ""
+        script_file_content = self.create_clone_commands()
+        script_file_content += self.create_cmssw_commands()
+        script_file_content += [
+            "cd ../..",
+            # Create reports directory
+            "mkdir -p Reports",
+            # Run the remote apparatus for one category
+            "python3 relmonservice2/remote/remote_apparatus.py "  # No newline
+            "-r RELMON_%s.json -p proxy.txt --cpus %s --callback %s %s "
+            "--category %s %s --part-output %s"
+            % (
+                relmon_id,
+                part["resources"]["cpus"],
+                self.callback_url,
+                self.callback_credentials(),
+                part["category"],
+                hlt_argument,
+                part_json,
+            ),
+            # Close scope for CMSSW
+            ")",
+            "cd $DIR",
+            # Remove all root files
+            "rm *.root",
+            # All output files must exist, otherwise job is held
+            "if [ ! -f %s ]; then" % (part_json),
+            "  echo '{\"status\": \"failed\", \"categories\": []}' > %s" % (part_json),
+            "fi",
+            "touch validation_matrix.log",
+            "mv validation_matrix.log validation_matrix_part_%s.log" % (index),
+            "tar -czf Reports_part_%s.tar.gz -C Reports ." % (index),
+        ]
+        return "\n".join(script_file_content)
+
+    def create_merge_script_file(self, relmon, number_of_parts):
+        """
+        Create bash executable for condor job that merges all parts of
+        RelMon and publishes the reports, return it as a string
+        """
+        relmon_id = relmon.get_id()
+        part_jsons = " ".join(
+            "RELMON_%s_part_%s.json" % (relmon_id, index)
+            for index in range(number_of_parts)
+        )
+        script_file_content = self.create_clone_commands()
+        script_file_content += [
+            # Create reports directory and unpack reports of all parts
+            "mkdir -p Reports",
+            "for PART in Reports_part_*.tar.gz; do",
+            '  tar -xzf "$PART" -C Reports',
+            "done",
+            # Merge parts into RelMon
+            "python3 relmonservice2/remote/remote_apparatus.py "  # No newline
+            "-r RELMON_%s.json --callback %s %s --merge %s"
+            % (relmon_id, self.callback_url, self.callback_credentials(), part_jsons),
+        ]
+        script_file_content += self.create_publish_commands(relmon)
+        return "\n".join(script_file_content)
 
     @classmethod
-    def create_relmon_file(cls, relmon):
+    def create_dag_file(cls, relmon, number_of_parts):
         """
-        Dump relmon to a JSON file
+        Create DAGMan file that runs all parts and then the merge job
         """
         relmon_id = relmon.get_id()
+        parts = ["part_%s" % (index) for index in range(number_of_parts)]
+        dag_file_content = []
+        for index, part in enumerate(parts):
+            dag_file_content += [
+                "JOB %s RELMON_%s_part_%s.sub" % (part, relmon_id, index),
+                "RETRY %s 1" % (part),
+            ]
+
+        dag_file_content += [
+            "JOB merge RELMON_%s.sub" % (relmon_id),
+            "PARENT %s CHILD merge" % (" ".join(parts)),
+        ]
+        return "\n".join(dag_file_content)
+
+    @classmethod
+    def create_relmon_file(cls, relmon):
+        """
+        Dump relmon to a JSON string
+        """
         relmon_data = relmon.get_json()
-        relmon_file_name = "relmons/%s/RELMON_%s.json" % (relmon_id, relmon_id)
-        with open(relmon_file_name, "w") as output_file:
-            json.dump(relmon_data, output_file, indent=2, sort_keys=True)
+        return json.dumps(relmon_data, indent=2, sort_keys=True)
 
     @classmethod
-    def create_condor_job_file(cls, relmon):
+    def create_condor_job_file(
+        cls, relmon, job_name=None, resources=None, input_files=None, output_files=None
+    ):
         """
-        Create a condor job file for a relmon
+        Create a condor job file for a relmon and return it as a string
+        By default it is the job of the whole RelMon, job name, resources
+        and input and output files can be changed for parts of RelMon
         """
         relmon_id = relmon.get_id()
-        cpus = relmon.get_cpu()
-        memory = relmon.get_memory()
-        disk = relmon.get_disk()
-        condor_file_name = "relmons/%s/RELMON_%s.sub" % (relmon_id, relmon_id)
+        if not job_name:
+            job_name = "RELMON_%s" % (relmon_id)
+
+        if not input_files:
+            input_files = ["RELMON_%s.json" % (relmon_id), "proxy.txt"]
+
+        if resources:
+            cpus = resources["cpus"]
+            memory = "%sM" % (resources["memory_mb"])
+            disk = "%sM" % (resources["disk_mb"])
+        else:
+            cpus = relmon.get_cpu()
+            memory = relmon.get_memory()
+            disk = relmon.get_disk()
+
         credentials_env = (
             f"CALLBACK_CLIENT_ID={CALLBACK_CLIENT_ID} "
             f"CALLBACK_CLIENT_SECRET={CALLBACK_CLIENT_SECRET} "
@@ -192,12 +388,12 @@ class FileCreator:
         credentials_env_arg = f'"{credentials_env}"'
         accounting_group = "group_u_CMS.CAF.PHYS" if HTCONDOR_CAF_POOL else "group_u_CMS.u_zh.users"
         condor_file_content = [
-            "executable             = RELMON_%s.sh" % (relmon_id),
+            "executable             = %s.sh" % (job_name),
             "environment            = %s" % (credentials_env_arg),
-            "output                 = RELMON_%s.out" % (relmon_id),
-            "error                  = RELMON_%s.err" % (relmon_id),
-            "log                    = RELMON_%s.log" % (relmon_id),
-            "transfer_input_files   = RELMON_%s.json,proxy.txt" % (relmon_id),
+            "output                 = %s.out" % (job_name),
+            "error                  = %s.err" % (job_name),
+            "log                    = %s.log" % (job_name),
+            "transfer_input_files   = %s" % (",".join(input_files)),
             "when_to_transfer_output = on_exit",
             "request_cpus           = %s" % (cpus),
             "request_memory         = %s" % (memory),
@@ -209,9 +405,12 @@ class FileCreator:
             "leave_in_queue         = JobStatus == 4 && (CompletionDate =?= UNDEFINED"
             "                         || ((CurrentTime - CompletionDate) < 7200))",
             '+AccountingGroup       = "%s"' % (accounting_group),
-            "queue",
         ]
+        if output_files:
+            condor_file_content.append(
+                "transfer_output_files  = %s" % (",".join(output_files))
+            )
+
+        condor_file_content.append("queue")
 
-        condor_file_content_string = "\n".join(condor_file_content)
-        with open(condor_file_name, "w") as output_file:
-            output_file.write(condor_file_content_string)
+        return "\n".join(condor_file_content)
@@ -0,0 +1,92 @@
+"""
+Module for LeaderElection
+"""
+import logging
+import time
+from mongodb_stores import LeaseStore
+from local import metrics
+
+
+class LeaseLost(Exception):
+    """
+    Raised when replica that works as a leader does not hold the lease anymore
+    """
+
+
+class LeaderElection:
+    """
+    Leader election built on a lease document in the database
+    Every replica of the service periodically tries to acquire or renew
+    the lease, the replica that holds it is the leader
+    If leader stops renewing the lease, another replica takes it over
+    after the lease expires
+    Every change of the holder increases the fencing token, so a leader
+    that lost the lease can detect it before doing any changes
+    """
+
+    def __init__(self, name, ttl):
+        self.logger = logging.getLogger("logger")
+        self.name = name
+        self.ttl = ttl
+        # Identifier of this replica, it is determined in the main
+        # process, so forked tick processes share it
+        self.holder = metrics.process_id()
+        self.token = None
+
+    def heartbeat(self, leases=None):
+        """
+        Acquire or renew the lease
+        Return True if this replica has just become the leader
+        """
+        if leases is None:
+            leases = LeaseStore()
+
+        token = leases.acquire(self.name, self.holder, self.ttl)
+        became_leader = token is not None and token != self.token
+        if became_leader:
+            self.logger.info("%s became leader, token %s", self.holder, token)
+        elif token is None and self.token is not None:
+            self.logger.warning("%s is not leader anymore", self.holder)
+
+        self.token = token
+        return became_leader
+
+    def current_token(self, leases=None):
+        """
+        Return fencing token if lease is held by this replica and is not
+        expired, None otherwise
+        """
+        if leases is None:
+            leases = LeaseStore()
+
+        lease = leases.get(self.name)
+        if not lease:
+            return None
+
+        if lease["holder"] != self.holder or lease["expires"] < time.time():
+            return None
+
+        return lease["token"]
+
+    def is_valid(self, token, leases=None):
+        """
+        Return whether lease is still held by this replica with given token
+        """
+        return token is not None and self.current_token(leases) == token
+
+    def check(self, token, leases=None):
+        """
+        Raise LeaseLost if lease is not held by this replica with given token
+        """
+        if not self.is_valid(token, leases):
+            raise LeaseLost("%s lost lease %s" % (self.holder, self.name))
+
+    def release(self, leases=None):
+        """
+        Give up the lease, so another replica could take it over immediately
+        """
+        if leases is None:
+            leases = LeaseStore()
+
+        leases.release(self.name, self.holder)
+        self.token = None
@@ -0,0 +1,378 @@
+"""
+Module with minimal Prometheus style metrics: counters, gauges and histograms
+Controller ticks run in a separate process, so every process periodically
+saves a snapshot of it's metrics to the database and metrics endpoint renders
+snapshots of all processes, counters and histograms of each process are
+separate series with a process label, so a snapshot that expires does not
+look like a counter reset
+Forked processes start with empty metrics, so values of the parent process
+are not counted again in snapshots of it's children
+"""
+import os
+import socket
+import threading
+import time
+from functools import wraps
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600
+)
+
+
+class Metric:
+    """
+    Base class of a metric with a name, help text and label names
+    Values are stored per combination of label values
+    """
+
+    metric_type = "untyped"
+    # Values of each process are rendered as separate series with a
+    # process label
+    per_process = True
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_values(self, labels):
+        """
+        Return tuple of label values in the order of label names
+        """
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def snapshot(self):
+        """
+        Return JSON serializable list of label values and metric values
+        """
+        with self.lock:
+            return [
+                {"labels": list(labels), "value": value}
+                for labels, value in self.values.items()
+            ]
+
+    def reset(self):
+        """
+        Remove all values and replace the lock, lock might have been held
+        by another thread when process was forked
+        """
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def merge(self, values, other, process):
+        """
+        Add value from a snapshot of given process to the values dictionary
+        """
+        labels = tuple(other["labels"])
+        if self.per_process:
+            labels += (process,)
+
+        values[labels] = other["value"]
+
+    def render(self, values):
+        """
+        Return lines of Prometheus text exposition format
+        """
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+        for labels, value in sorted(values.items()):
+            lines.append("%s%s %s" % (self.name, self.format_labels(labels), value))
+
+        return lines
+
+    def format_labels(self, labels, extra=None):
+        """
+        Return labels in {name="value"} format
+        """
+        label_names = self.label_names
+        if self.per_process:
+            label_names += ("process",)
+
+        pairs = list(zip(label_names, labels)) + list(extra or [])
+        if not pairs:
+            return ""
+
+        pairs = ",".join(
+            '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return "{%s}" % (pairs)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase counter by given amount
+        """
+        labels = self.label_values(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+
+    metric_type = "gauge"
+    # Gauges describe the whole service, e.g. number of RelMons, so last
+    # reported value is used
+    per_process = False
+
+    def set(self, value, **labels):
+        """
+        Set gauge to given value
+        """
+        labels = self.label_values(labels)
+        with self.lock:
+            self.values[labels] = value
+
+    def replace(self, values):
+        """
+        Replace all values of the gauge with given list of value and labels
+        dictionary pairs at once, so snapshots never see a partial update
+        """
+        values = {self.label_values(labels): value for value, labels in values}
+        with self.lock:
+            self.values = values
+
+
+class Histogram(Metric):
+    """
+    Histogram of observed values in cumulative buckets
+    """
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Observe a value
+        """
+        labels = self.label_values(labels)
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+
+            histogram = self.values[labels]
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram["buckets"][index] += 1
+
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def time(self, **labels):
+        """
+        Return context manager that observes duration of the block
+        """
+        return Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [
+                {
+                    "labels": list(labels),
+                    "value": {
+                        "buckets": list(value["buckets"]),
+                        "sum": value["sum"],
+                        "count": value["count"],
+                    },
+                }
+                for labels, value in self.values.items()
+            ]
+
+    def merge(self, values, other, process):
+        # Snapshot of a process that used different buckets
+        if len(other["value"]["buckets"]) != len(self.buckets):
+            return
+
+        super().merge(values, other, process)
+
+    def render(self, values):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+        for labels, value in sorted(values.items()):
+            for bucket, count in zip(self.buckets, value["buckets"]):
+                bucket_labels = self.format_labels(labels, [("le", str(bucket))])
+                lines.append("%s_bucket%s %s" % (self.name, bucket_labels, count))
+
+            bucket_labels = self.format_labels(labels, [("le", "+Inf")])
+            lines.append("%s_bucket%s %s" % (self.name, bucket_labels, value["count"]))
+            lines.append(
+                "%s_sum%s %s" % (self.name, self.format_labels(labels), value["sum"])
+            )
+            lines.append(
+                "%s_count%s %s" % (self.name, self.format_labels(labels), value["count"])
+            )
+
+        return lines
+
+
+class Timer:
+    """
+    Context manager that observes time spent in a block in a histogram
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Registry:
+    """
+    Collection of metrics of a process
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Add metric to the registry and return it
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        """
+        Remove values of all metrics
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        """
+        Return JSON serializable snapshot of all metrics
+        """
+        return [
+            {"name": name, "values": metric.snapshot()}
+            for name, metric in self.metrics.items()
+        ]
+
+    def render(self, snapshots):
+        """
+        Merge given dictionary of process ids and their snapshots and return
+        metrics in Prometheus text format
+        """
+        merged = {name: {} for name in self.metrics}
+        for process, snapshot in snapshots.items():
+            for metric_snapshot in snapshot:
+                metric = self.metrics.get(metric_snapshot["name"])
+                if not metric:
+                    continue
+
+                for value in metric_snapshot["values"]:
+                    metric.merge(merged[metric.name], value, process)
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render(merged[name]))
+
+        return "\n".join(lines) + "\n"
+
+
+def process_id():
+    """
+    Return identifier of current process that is unique among service replicas
+    """
+    return "%s-%s" % (socket.gethostname(), os.getpid())
+
+
+def timed(histogram, label_name):
+    """
+    Decorator that observes duration of each call of a function in a histogram
+    Function name, with class name for methods, is used as the value of
+    given label
+    """
+
+    def decorator(function):
+        labels = {label_name: function.__qualname__}
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+REGISTRY = Registry()
+# Tick jobs run in forked processes that would otherwise report values of
+# the parent process as their own
+os.register_at_fork(after_in_child=REGISTRY.reset)
+TICK_PHASE_SECONDS = REGISTRY.register(
+    Histogram(
+        "relmonservice_tick_phase_seconds",
+        "Duration of controller tick phases",
+        ["phase"],
+    )
+)
+TICKS_TOTAL = REGISTRY.register(
+    Counter(
+        "relmonservice_ticks_total", "Number of controller ticks", ["sweep"]
+    )
+)
+SSH_COMMAND_SECONDS = REGISTRY.register(
+    Histogram(
+        "relmonservice_ssh_command_seconds",
+        "Latency of commands executed on the submission host",
+        ["command"],
+    )
+)
+DATABASE_QUERY_SECONDS = REGISTRY.register(
+    Histogram(
+        "relmonservice_database_query_seconds",
+        "Latency of database methods",
+        ["method"],
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    )
+)
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "relmonservice_request_seconds",
+        "Latency of web requests",
+        ["route", "method", "code"],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    )
+)
+RELMONS = REGISTRY.register(
+    Gauge("relmonservice_relmons", "Number of RelMons in each status", ["status"])
+)
+PENDING_OPERATIONS = REGISTRY.register(
+    Gauge(
+        "relmonservice_pending_operations",
+        "Number of queued RelMon operations",
+        ["operation"],
+    )
+)
@@ -2,6 +2,7 @@
 Module for RelMon class
 """
 import re
+import time
 from copy import deepcopy
 
 
@@ -12,6 +13,8 @@ class RelMon:
     """
 
     def __init__(self, data):
+        # Data as it was loaded, used to find out which fields changed
+        self.saved_data = deepcopy(data)
         data = deepcopy(data)
         data["name"] = RelMon.sanitize_name(data["name"])
         self.data = data
@@ -90,6 +93,78 @@ class RelMon:
             category["reference"] = new_references
             category["target"] = new_targets
 
+    def mark_saved(self):
+        """
+        Remember current data as saved, changes are tracked from now on
+        """
+        self.saved_data = deepcopy(self.data)
+
+    def get_changes(self):
+        """
+        Return dictionary of changed fields and their new values and list
+        of removed fields since RelMon was loaded or saved
+        Fields are in dot notation, changed references and targets of a
+        category are returned individually, so big RelMons would not be
+        rewritten because of a single changed file
+        """
+        changes = {}
+        removed = [key for key in self.saved_data if key not in self.data]
+        for key, value in self.data.items():
+            if key in self.saved_data and self.saved_data[key] == value:
+                continue
+
+            if key == "categories":
+                changes.update(
+                    self.__category_changes(value, self.saved_data.get("categories"))
+                )
+            else:
+                changes[key] = value
+
+        return changes, removed
+
+    @staticmethod
+    def __category_changes(categories, saved_categories):
+        """
+        Return changed fields of categories, if categories were added,
+        removed or reordered, all of them are changed
+        """
+        if not isinstance(saved_categories, list) or [
+            x.get("name") for x in categories
+        ] != [x.get("name") for x in saved_categories]:
+            return {"categories": categories}
+
+        changes = {}
+        for index, (category, saved_category) in enumerate(
+            zip(categories, saved_categories)
+        ):
+            if category == saved_category:
+                continue
+
+            prefix = "categories.%s" % (index)
+            if set(category) != set(saved_category):
+                changes[prefix] = category
+                continue
+
+            for key, value in category.items():
+                saved_value = saved_category[key]
+                if value == saved_value:
+                    continue
+
+                if (
+                    key in ("reference", "target")
+                    and isinstance(saved_value, list)
+                    and len(value) == len(saved_value)
+                ):
+                    for relval_index, (relval, saved_relval) in enumerate(
+                        zip(value, saved_value)
+                    ):
+                        if relval != saved_relval:
+                            changes["%s.%s.%s" % (prefix, key, relval_index)] = relval
+                else:
+                    changes["%s.%s" % (prefix, key)] = value
+
+        return changes
+
     @staticmethod
     def sanitize_name(name):
         """
@@ -157,10 +232,17 @@ class RelMon:
         self.set_status("new")
         self.set_condor_status("<unknown>")
         self.set_condor_id(0)
+        self.data.pop("resources", None)
+        self.data.pop("job_usage", None)
+        self.data.pop("fanout", None)
         if reset_categories:
             for category in self.data["categories"]:
                 self.reset_category(category["name"])
 
+        # Fields used to order submissions
+        self.data["priority"] = self.get_priority()
+        self.data["relval_count"] = self.get_relval_count()
+        self.data["queued_since"] = int(time.time())
         return self.data
 
     def get_id(self):
@@ -181,9 +263,9 @@ class RelMon:
         """
         self.data["name"] = name
 
-    def get_cpu(self):
+    def get_relval_count(self):
         """
-        Return number of CPUs required based on number of references and targets
+        Return number of references and targets in categories that will be compared
         """
         number_of_relvals = 0
         for category in self.data["categories"]:
@@ -193,6 +275,73 @@ class RelMon:
             number_of_relvals += len(category["reference"])
             number_of_relvals += len(category["target"])
 
+        return number_of_relvals
+
+    def get_summary(self):
+        """
+        Return progress of RelMon: number of all, downloaded and compared
+        references and targets and per category numbers of references and
+        targets in each status and their size
+        """
+        summary = {
+            "total_relvals": 0,
+            "downloaded_relvals": 0,
+            "compared_relvals": 0,
+            "categories": [],
+        }
+        for category in self.data.get("categories", []):
+            category_summary = {
+                "name": category["name"],
+                "status": category.get("status"),
+                "hlt": category.get("hlt"),
+                "automatic_pairing": category.get("automatic_pairing"),
+            }
+            for reference_target in ("reference", "target"):
+                relvals = category[reference_target]
+                statuses = {}
+                for relval in relvals:
+                    relval_status = relval["status"]
+                    statuses[relval_status] = statuses.get(relval_status, 0) + 1
+                    if relval_status != "initial":
+                        summary["downloaded_relvals"] += 1
+
+                    if category.get("status") == "done":
+                        summary["compared_relvals"] += 1
+
+                summary["total_relvals"] += len(relvals)
+                category_summary[reference_target] = {
+                    "total": len(relvals),
+                    "size": sum(x.get("file_size", 0) for x in relvals),
+                    "status": statuses,
+                }
+
+            summary["categories"].append(category_summary)
+
+        return summary
+
+    def get_priority(self):
+        """
+        Getter for submission priority, higher priority RelMons are submitted first
+        """
+        return self.data.get("priority", 0)
+
+    def get_resources(self):
+        """
+        Return resources estimated at submission or None if there are none
+        """
+        return self.data.get("resources")
+
+    def set_resources(self, resources):
+        """
+        Setter for estimated resources
+        """
+        self.data["resources"] = resources
+
+    @staticmethod
+    def step_table_cpu(number_of_relvals):
+        """
+        Return number of CPUs for given number of references and targets
+        """
         # Pairs       CPU
         #  0 -  5   -   1
         #  6 - 15   -   2
@@ -219,30 +368,70 @@ class RelMon:
 
         return cpus
 
+    @staticmethod
+    def step_table_disk_mb(number_of_relvals):
+        """
+        Return disk space in MB for given number of references and targets
+        """
+        # At lest 300M
+        return max(number_of_relvals, 1) * 300
+
+    @staticmethod
+    def step_table_runtime(number_of_relvals, cpus):
+        """
+        Return expected runtime in seconds for given number of references
+        and targets and number of CPUs
+        """
+        # Setup takes about 15 minutes, download and comparison of a relval
+        # takes about 3 minutes of a single CPU
+        return 900 + number_of_relvals * 180 // cpus
+
+    def get_cpu(self):
+        """
+        Return number of CPUs required, either estimated at submission or
+        based on number of references and targets
+        """
+        resources = self.get_resources()
+        if resources:
+            return resources["cpus"]
+
+        return self.step_table_cpu(self.get_relval_count())
+
     def get_memory(self):
         """
-        Return amount of memory required based on number of CPUs
+        Return amount of memory required, either estimated at submission or
+        based on number of CPUs
         """
+        resources = self.get_resources()
+        if resources:
+            return "%sM" % (resources["memory_mb"])
+
         memory = str(self.get_cpu() * 2) + "G"
         return memory
 
     def get_disk(self):
         """
-        Return amount of disk space required based on number of references and targets
+        Return amount of disk space required, either estimated at submission or
+        based on number of references and targets
         """
-        number_of_relvals = 0
-        for category in self.data["categories"]:
-            if category["status"] != "initial":
-                continue
+        resources = self.get_resources()
+        if resources:
+            return "%sM" % (resources["disk_mb"])
 
-            number_of_relvals += len(category["reference"])
-            number_of_relvals += len(category["target"])
-
-        # At lest 300M
-        number_of_relvals = max(number_of_relvals, 1)
-        disk = "%sM" % (number_of_relvals * 300)
+        disk = "%sM" % (self.step_table_disk_mb(self.get_relval_count()))
         return disk
 
+    def get_expected_runtime(self):
+        """
+        Return expected runtime of the job in seconds, either estimated at
+        submission or based on number of references and targets
+        """
+        resources = self.get_resources()
+        if resources:
+            return resources["wall_time"]
+
+        return self.step_table_runtime(self.get_relval_count(), self.get_cpu())
+
     def get_json(self):
         """
         Return object's dictionary
@@ -276,7 +465,11 @@ class RelMon:
     def set_condor_status(self, condor_status):
         """
         Setter for condor status
+        Time of status change is saved to condor_status_since
         """
+        if self.data.get("condor_status") != condor_status:
+            self.data["condor_status_since"] = int(time.time())
+
         self.data["condor_status"] = condor_status
 
     def set_condor_id(self, condor_id):
@@ -0,0 +1,401 @@
+"""
+Module for ResourceEstimator
+Estimates CPU, memory, disk and wall time of RelMon jobs from completed
+RelMons stored in the database
+Usage: python3 -m local.resource_estimator --evaluate
+"""
+import argparse
+import logging
+import math
+import re
+import time
+from datetime import datetime
+from local.relmon import RelMon
+
+
+# HTCondor user log event header, e.g.
+# 005 (801341.000.000) 2024-01-31 12:00:00 Job terminated.
+LOG_EVENT_REGEX = re.compile(
+    r"^(\d{3}) \(\d+\.\d+\.\d+\) (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}|\d{2}/\d{2} \d{2}:\d{2}:\d{2})"
+)
+# Usr 0 00:10:00, Sys 0 00:00:10  -  Run Remote Usage
+REMOTE_USAGE_REGEX = re.compile(
+    r"Usr (\d+) (\d+):(\d+):(\d+), Sys (\d+) (\d+):(\d+):(\d+)\s+-\s+Run Remote Usage"
+)
+# Memory (MB)          :    3000     8192      8192
+RESOURCE_REGEX = re.compile(
+    r"^\s*(Cpus|Disk \(KB\)|Memory \(MB\))\s*:\s*([\d.]+)?\s+([\d.]+)\s+([\d.]+)"
+)
+
+
+def parse_log_time(value):
+    """
+    Parse time of HTCondor user log event, old format does not have a year
+    """
+    if "/" in value:
+        return datetime.strptime(
+            "%s/%s" % (datetime.now().year, value), "%Y/%m/%d %H:%M:%S"
+        ).timestamp()
+
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def parse_job_log(log):
+    """
+    Parse HTCondor user log of a job and return dictionary with wall time,
+    CPU time and requested and used CPUs, memory and disk of the last
+    execution or None if job did not terminate
+    """
+    usage = None
+    execute_time = None
+    in_termination = False
+    for line in log.splitlines():
+        event = LOG_EVENT_REGEX.match(line)
+        if event:
+            in_termination = False
+            code, event_time = event.group(1), parse_log_time(event.group(2))
+            if code == "001":
+                execute_time = event_time
+            elif code == "005" and execute_time:
+                in_termination = True
+                wall_time = event_time - execute_time
+                if wall_time < 0:
+                    # Old format log spanning new year
+                    wall_time += 365 * 86400
+
+                usage = {"wall_time": int(wall_time)}
+
+            continue
+
+        if not in_termination:
+            continue
+
+        remote_usage = REMOTE_USAGE_REGEX.search(line)
+        if remote_usage:
+            values = [int(x) for x in remote_usage.groups()]
+            user = values[0] * 86400 + values[1] * 3600 + values[2] * 60 + values[3]
+            system = values[4] * 86400 + values[5] * 3600 + values[6] * 60 + values[7]
+            usage["cpu_time"] = user + system
+            continue
+
+        resource = RESOURCE_REGEX.match(line)
+        if resource:
+            name = {"Cpus": "cpus", "Disk (KB)": "disk_kb", "Memory (MB)": "memory_mb"}
+            name = name[resource.group(1)]
+            if resource.group(2):
+                usage["%s_used" % (name)] = float(resource.group(2))
+
+            usage[name] = float(resource.group(4))
+
+    if usage and all(
+        x in usage for x in ("cpu_time", "memory_mb_used", "disk_kb_used")
+    ):
+        return usage
+
+    return None
+
+
+def fit_line(points):
+    """
+    Fit y = a + b * x to list of (x, y) points with least squares
+    Return (a, b)
+    """
+    count = len(points)
+    mean_x = sum(x for x, _ in points) / count
+    mean_y = sum(y for _, y in points) / count
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return mean_y, 0.0
+
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    slope = max(slope, 0.0)
+    return mean_y - slope * mean_x, slope
+
+
+def quantile(values, fraction):
+    """
+    Return value at given fraction of sorted values
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def comparison_passes(category):
+    """
+    Return how many times category is compared, once without HLT and
+    once with HLT, Generator is never compared with HLT
+    """
+    if category["name"].lower() == "generator" or category.get("hlt") != "both":
+        return 1
+
+    return 2
+
+
+class ResourceEstimator:
+    """
+    Estimates resources of a RelMon job from completed RelMons
+    Size of relvals of a new RelMon is not known before the job runs, so it
+    is estimated from average relval size in each category of completed
+    RelMons. CPU time and disk are linear in size, memory is proportional
+    to number of CPUs and wall time is setup overhead plus CPU time divided
+    among CPUs. Number of CPUs is the smallest one that fits in target wall time
+    Number of events of relvals is not used: job reads it from downloaded
+    files, so it is not known before submission either, and comparison time
+    depends on number and size of histograms, not on number of events that
+    filled them, which file size already reflects
+    Step tables of RelMon are used until there is enough history
+    """
+
+    CPU_OPTIONS = (1, 2, 4, 8, 16)
+    # Jobs are sized to finish in this time
+    TARGET_WALL_TIME = 6 * 3600
+    # Minimum number of completed RelMons to use estimation
+    MIN_SAMPLES = 20
+    # Number of latest completed RelMons to learn from
+    HISTORY_SIZE = 2000
+    # Seconds between refits
+    REFIT_INTERVAL = 3600
+    # Requested memory and disk are this much more than expected usage
+    MARGIN = 1.25
+    MIN_MEMORY_MB = 1024
+    MIN_DISK_MB = 300
+
+    def __init__(self):
+        self.logger = logging.getLogger("logger")
+        self.model = None
+        self.fitted_at = 0
+
+    @staticmethod
+    def relvals(category):
+        """
+        Return references and targets of a category
+        """
+        return category.get("reference", []) + category.get("target", [])
+
+    def refresh(self, database):
+        """
+        Refit model from database if it is older than refit interval
+        """
+        if time.time() - self.fitted_at < self.REFIT_INTERVAL:
+            return
+
+        self.fitted_at = time.time()
+        try:
+            self.fit(database.get_relmons_with_job_usage(self.HISTORY_SIZE))
+        except Exception as ex:
+            self.logger.error("Could not fit resource estimator: %s", ex)
+            self.model = None
+
+    def fit(self, history):
+        """
+        Fit model to list of completed RelMon dictionaries with job usage
+        Only file sizes of relvals are used, see class description for why
+        number of events is not
+        """
+        category_sizes = {}
+        samples = []
+        for relmon in history:
+            usage = relmon.get("job_usage")
+            if not usage:
+                continue
+
+            size = 0
+            weighted_size = 0
+            for category in relmon.get("categories", []):
+                category_size = sum(x.get("file_size", 0) for x in self.relvals(category))
+                relval_count = len(self.relvals(category))
+                if category_size and relval_count:
+                    sizes = category_sizes.setdefault(category["name"], [0, 0])
+                    sizes[0] += category_size
+                    sizes[1] += relval_count
+
+                size += category_size
+                weighted_size += category_size * comparison_passes(category)
+
+            if size:
+                samples.append((size, weighted_size, usage))
+
+        if len(samples) < self.MIN_SAMPLES:
+            self.logger.info(
+                "Only %s completed RelMons, will use step tables", len(samples)
+            )
+            self.model = None
+            return
+
+        total_size = sum(x[0] for x in category_sizes.values())
+        total_count = sum(x[1] for x in category_sizes.values())
+        cpu_time = fit_line([(x[1], x[2]["cpu_time"]) for x in samples])
+        disk = fit_line([(x[0], x[2]["disk_kb_used"] / 1024) for x in samples])
+        memory_per_cpu = quantile(
+            [x[2]["memory_mb_used"] / max(x[2].get("cpus", 1), 1) for x in samples], 0.9
+        )
+        efficiency = quantile(
+            [
+                min(x[2].get("cpus_used", 1) / max(x[2].get("cpus", 1), 1), 1)
+                for x in samples
+            ],
+            0.5,
+        )
+        efficiency = max(efficiency, 0.1)
+        overhead = quantile(
+            [
+                max(
+                    x[2]["wall_time"]
+                    - x[2]["cpu_time"] / (max(x[2].get("cpus", 1), 1) * efficiency),
+                    0,
+                )
+                for x in samples
+            ],
+            0.5,
+        )
+        self.model = {
+            "category_relval_size": {
+                name: x[0] / x[1] for name, x in category_sizes.items()
+            },
+            "relval_size": total_size / total_count,
+            "cpu_time": cpu_time,
+            "disk_mb": disk,
+            "memory_per_cpu_mb": memory_per_cpu,
+            "efficiency": efficiency,
+            "overhead": overhead,
+            "samples": len(samples),
+        }
+        self.logger.info("Fitted resource estimator: %s", self.model)
+
+    def estimate(self, relmon, cpus=None):
+        """
+        Return dictionary with estimated cpus, memory_mb, disk_mb and wall_time
+        of RelMon job and whether estimation is based on history
+        If number of CPUs is given, other resources are estimated for it
+        """
+        number_of_relvals = relmon.get_relval_count()
+        if not self.model:
+            if not cpus:
+                cpus = RelMon.step_table_cpu(number_of_relvals)
+
+            return {
+                "cpus": cpus,
+                "memory_mb": cpus * 2048,
+                "disk_mb": RelMon.step_table_disk_mb(number_of_relvals),
+                "wall_time": RelMon.step_table_runtime(number_of_relvals, cpus),
+                "source": "step_table",
+            }
+
+        model = self.model
+        size = 0
+        weighted_size = 0
+        for category in relmon.get_json()["categories"]:
+            if category["status"] != "initial":
+                continue
+
+            relval_size = model["category_relval_size"].get(
+                category["name"], model["relval_size"]
+            )
+            category_size = relval_size * len(self.relvals(category))
+            size += category_size
+            weighted_size += category_size * comparison_passes(category)
+
+        cpu_time = model["cpu_time"][0] + model["cpu_time"][1] * weighted_size
+        for cpus_option in self.CPU_OPTIONS if not cpus else (cpus,):
+            wall_time = model["overhead"] + cpu_time / (cpus_option * model["efficiency"])
+            if wall_time <= self.TARGET_WALL_TIME:
+                break
+
+        cpus = cpus_option
+
+        disk_mb = model["disk_mb"][0] + model["disk_mb"][1] * size
+        memory_mb = model["memory_per_cpu_mb"] * cpus
+        return {
+            "cpus": cpus,
+            "memory_mb": max(int(math.ceil(memory_mb * self.MARGIN)), self.MIN_MEMORY_MB),
+            "disk_mb": max(int(math.ceil(disk_mb * self.MARGIN)), self.MIN_DISK_MB),
+            "wall_time": int(wall_time),
+            "source": "history",
+        }
+
+
+def evaluate(history, test_fraction):
+    """
+    Train estimator on older RelMons and compare it's and step tables'
+    predictions with observed usage of the newest RelMons
+    """
+    history = sorted(
+        [x for x in history if x.get("job_usage")], key=lambda x: x["last_update"]
+    )
+    split = int(len(history) * (1 - test_fraction))
+    estimator = ResourceEstimator()
+    estimator.fit(history[:split])
+    if not estimator.model:
+        print("Not enough history to evaluate (%s RelMons)" % (len(history)))
+        return
+
+    errors = {"history": {}, "step_table": {}}
+    for relmon_json in history[split:]:
+        usage = relmon_json["job_usage"]
+        relmon = RelMon(relmon_json)
+        for category in relmon.get_json()["categories"]:
+            # Estimate as if RelMon was not run yet
+            category["status"] = "initial"
+
+        # Resources are estimated for CPUs that job actually had
+        cpus = int(max(usage.get("cpus", 1), 1))
+        for source, estimate in (
+            ("history", estimator.estimate(relmon, cpus)),
+            ("step_table", ResourceEstimator().estimate(relmon, cpus)),
+        ):
+            pairs = (
+                ("wall_time", estimate["wall_time"], usage["wall_time"]),
+                ("memory_mb", estimate["memory_mb"], usage["memory_mb_used"]),
+                ("disk_mb", estimate["disk_mb"], usage["disk_kb_used"] / 1024),
+            )
+            for name, predicted, actual in pairs:
+                errors[source].setdefault(name, []).append((predicted, actual))
+
+    print(
+        "Trained on %s, tested on %s RelMons" % (split, len(history) - split)
+    )
+    print(
+        "%-11s %-10s %12s %12s %10s"
+        % ("source", "resource", "mean abs err", "median err%", "undersized")
+    )
+    for source, resources in errors.items():
+        for name, pairs in resources.items():
+            absolute = [abs(x - y) for x, y in pairs]
+            relative = [abs(x - y) / y * 100 for x, y in pairs if y]
+            undersized = sum(1 for x, y in pairs if x < y)
+            print(
+                "%-11s %-10s %12.1f %11.1f%% %9.1f%%"
+                % (
+                    source,
+                    name,
+                    sum(absolute) / len(absolute),
+                    quantile(relative, 0.5) if relative else 0,
+                    undersized / len(pairs) * 100,
+                )
+            )
+
+
+def main():
+    """
+    Offline evaluation of the estimator against completed RelMons
+    """
+    parser = argparse.ArgumentParser(description="RelMon resource estimator")
+    parser.add_argument("--evaluate", action="store_true", help="Report prediction error")
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("--history", type=int, default=ResourceEstimator.HISTORY_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # pylint: disable-next=import-outside-toplevel
+    from mongodb_database import Database
+
+    history = Database().get_relmons_with_job_usage(args.history)
+    if args.evaluate:
+        evaluate(history, args.test_fraction)
+    else:
+        estimator = ResourceEstimator()
+        estimator.fit(history)
+        print(estimator.model)
+
+
+if __name__ == "__main__":
+    main()
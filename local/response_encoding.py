@@ -0,0 +1,75 @@
+"""
+Module with JSON serialization and compression of API responses
+"""
+import gzip
+import json
+
+try:
+    # pylint: disable=import-error
+    import orjson
+
+    # pylint: enable=import-error
+except ImportError:
+    orjson = None
+
+try:
+    # pylint: disable=import-error
+    import brotli
+
+    # pylint: enable=import-error
+except ImportError:
+    brotli = None
+
+
+# Bodies smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 1024
+# Levels that favor speed, responses are compressed on every request
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def to_json(data, pretty=False):
+    """
+    Serialize data to JSON bytes, compact unless pretty is requested
+    orjson is used if it is installed
+    """
+    if orjson is not None:
+        options = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0
+        try:
+            return orjson.dumps(data, option=options)
+        except TypeError:
+            # E.g. integers that do not fit in 64 bits
+            pass
+
+    if pretty:
+        return json.dumps(data, indent=1, sort_keys=True).encode("utf-8")
+
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def supported_encodings():
+    """
+    Return content encodings that can be produced, preferred first
+    """
+    if brotli is not None:
+        return ["br", "gzip"]
+
+    return ["gzip"]
+
+
+def compress(body, encoding):
+    """
+    Compress body with given content encoding
+    Return compressed body and encoding, or unchanged body and None if
+    body is too small or encoding is not supported
+    """
+    if len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+
+    return body, None
@@ -0,0 +1,254 @@
+"""
+Module for SSHConnectionPool
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from paramiko import ChannelException, SSHException
+from core_lib.utils.ssh_executor import SSHExecutor
+
+
+class PooledConnection:
+    """
+    One authenticated SSH connection of the pool
+    Commands are executed in separate channels, so a connection can be used
+    by several threads at once, SFTP transfers are serialized
+    """
+
+    def __init__(self, host, username, password):
+        self.executor = SSHExecutor(host=host, username=username, password=password)
+        self.channels = 0
+        self.last_health_check = 0
+        self.setup_lock = threading.Lock()
+        self.sftp_lock = threading.Lock()
+
+    def transport(self):
+        """
+        Return paramiko transport of the connection or None if not connected
+        """
+        if not self.executor.ssh_client:
+            return None
+
+        return self.executor.ssh_client.get_transport()
+
+    def is_alive(self):
+        """
+        Return whether connection is established and transport is active
+        """
+        transport = self.transport()
+        return bool(transport and transport.is_active())
+
+    def close(self):
+        """
+        Close SSH and SFTP connections
+        """
+        try:
+            self.executor.close_connections()
+        except Exception as ex:
+            logging.getLogger("logger").warning("Error closing SSH connection: %s", ex)
+
+        self.executor.ssh_client = None
+        self.executor.ftp_client = None
+
+
+class SSHConnectionPool:
+    """
+    Pool of long-lived SSH connections to the submission host
+    Connections are kept alive between ticks with keep-alive packets,
+    checked before use and reconnected if they are broken
+    Interface is the same as SSHExecutor, so pool can be used instead of it
+    Failures to connect or to open a channel are retried once, failures
+    after a command might have started are retried only if it was asked for,
+    so commands that are not idempotent, e.g. condor_submit, do not run twice
+    """
+
+    # Seconds between keep-alive packets
+    KEEPALIVE_INTERVAL = 30
+    # Seconds between health checks of a connection before it is used
+    HEALTH_CHECK_INTERVAL = 60
+    # Number of commands that can run over one connection at the same time
+    CHANNELS_PER_CONNECTION = 4
+
+    def __init__(
+        self,
+        host,
+        username,
+        password,
+        size=1,
+        channels_per_connection=CHANNELS_PER_CONNECTION,
+    ):
+        self.logger = logging.getLogger("logger")
+        self.host = host
+        self.username = username
+        self.password = password
+        self.size = max(1, size)
+        self.channels_per_connection = max(1, channels_per_connection)
+        self.condition = threading.Condition()
+        self.connections = []
+        self.pid = None
+
+    def __check_fork(self):
+        """
+        Connections can not be shared with a forked process, so if pool
+        is used in a new process, drop inherited connections
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.connections = [
+                PooledConnection(self.host, self.username, self.password)
+                for _ in range(self.size)
+            ]
+
+    def __ensure_healthy(self, connection):
+        """
+        Check connection and reconnect if it is broken
+        """
+        with connection.setup_lock:
+            now = time.time()
+            if connection.is_alive():
+                if now - connection.last_health_check < self.HEALTH_CHECK_INTERVAL:
+                    return
+
+                try:
+                    connection.transport().send_ignore()
+                    connection.last_health_check = now
+                    return
+                except (SSHException, OSError, EOFError) as ex:
+                    self.logger.warning("SSH connection is broken: %s", ex)
+
+            self.logger.info("Setting up SSH connection to %s", self.host)
+            connection.close()
+            connection.executor.setup_ssh()
+            connection.transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+            connection.last_health_check = now
+
+    @contextmanager
+    def connection(self):
+        """
+        Lend a healthy connection with a free channel
+        Wait if all channels of all connections are in use
+        """
+        with self.condition:
+            self.__check_fork()
+            while True:
+                connection = min(self.connections, key=lambda x: x.channels)
+                if connection.channels < self.channels_per_connection:
+                    break
+
+                self.condition.wait()
+
+            connection.channels += 1
+
+        try:
+            self.__ensure_healthy(connection)
+            yield connection
+        finally:
+            with self.condition:
+                connection.channels -= 1
+                self.condition.notify()
+
+    def __with_retry(self, action, retry):
+        """
+        Run action with a pooled connection, if connection turns out to
+        be broken, reconnect and try once more
+        Action that failed after it was started is tried again only if
+        retry is set
+        """
+        started = False
+        try:
+            with self.connection() as connection:
+                started = True
+                try:
+                    return action(connection)
+                except (SSHException, OSError, EOFError) as ex:
+                    connection.last_health_check = 0
+                    if isinstance(ex, ChannelException):
+                        # Channel was not opened, so command did not start
+                        started = False
+
+                    raise
+        except (SSHException, OSError, EOFError) as ex:
+            if started and not retry:
+                self.logger.error("SSH action failed, it will not be retried: %s", ex)
+                raise
+
+            self.logger.warning("SSH action failed, will reconnect and retry: %s", ex)
+
+        with self.connection() as connection:
+            return action(connection)
+
+    def execute_command(self, command, retry=False):
+        """
+        Execute command on the remote host
+        Set retry only for commands that can safely run twice
+        Return stdout, stderr and exit code
+        """
+        return self.__with_retry(lambda x: x.executor.execute_command(command), retry)
+
+    def execute_command_with_input(
+        self, command, input_data, binary_output=False, retry=False
+    ):
+        """
+        Execute command on the remote host and stream given bytes to it's stdin
+        Set retry only for commands that can safely run twice
+        Return stdout, stderr and exit code, same as execute_command
+        """
+        if isinstance(command, list):
+            command = "; ".join(command)
+
+        def action(connection):
+            self.logger.debug(
+                "Executing %s with %sB of input", command, len(input_data or b"")
+            )
+            client = connection.executor.ssh_client
+            stdin, stdout, stderr = client.exec_command(command)
+            if input_data:
+                stdin.write(input_data)
+                stdin.flush()
+
+            stdin.channel.shutdown_write()
+            stdout_data = stdout.read()
+            stderr_data = stderr.read().decode("utf-8").strip()
+            exit_code = stdout.channel.recv_exit_status()
+            if not binary_output:
+                stdout_data = stdout_data.decode("utf-8").strip()
+
+            return stdout_data, stderr_data, exit_code
+
+        return self.__with_retry(action, retry)
+
+    def upload_file(self, copy_from, copy_to):
+        """
+        Upload a local file to the remote host
+        """
+
+        def action(connection):
+            with connection.sftp_lock:
+                return connection.executor.upload_file(copy_from, copy_to)
+
+        # Uploading the same file again is harmless
+        return self.__with_retry(action, True)
+
+    def download_file(self, copy_from, copy_to):
+        """
+        Download a remote file to the local machine
+        """
+
+        def action(connection):
+            with connection.sftp_lock:
+                return connection.executor.download_file(copy_from, copy_to)
+
+        return self.__with_retry(action, True)
+
+    def close_connections(self):
+        """
+        Close all connections of the pool
+        """
+        with self.condition:
+            if self.pid != os.getpid():
+                return
+
+            for connection in self.connections:
+                connection.close()
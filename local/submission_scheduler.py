@@ -0,0 +1,75 @@
+"""
+Module for SubmissionScheduler
+"""
+import logging
+
+
+class SubmissionScheduler:
+    """
+    Decides which new RelMons are submitted to HTCondor during a tick
+    Number of RelMons in flight is limited, free slots are given out in
+    order of priority, within the same priority users take turns, so user
+    with fewest RelMons in flight goes first, and user's smaller RelMons
+    are submitted before bigger ones
+    """
+
+    def __init__(self, max_running):
+        self.logger = logging.getLogger("logger")
+        self.max_running = max_running
+
+    def schedule(self, database):
+        """
+        Return list of ids of new RelMons that should be submitted now
+        """
+        running = database.get_relmons_in_flight_per_user()
+        slots = self.max_running - sum(running.values())
+        if slots <= 0:
+            self.logger.info(
+                "%s RelMons in flight, limit is %s, will not submit any",
+                sum(running.values()),
+                self.max_running,
+            )
+            return []
+
+        # User can not get more than all free slots, so only that many
+        # candidates per user are needed
+        candidates = database.get_submission_candidates(slots)
+        selected = self.pick(candidates, running, slots)
+        self.logger.info(
+            "%s free slots, %s users waiting, selected %s",
+            slots,
+            len(candidates),
+            ", ".join(x["id"] for x in selected),
+        )
+        return [x["id"] for x in selected]
+
+    @staticmethod
+    def pick(candidates, running, slots):
+        """
+        Pick up to given number of slots RelMons from candidates
+        Candidates is a dictionary of users and their new RelMons, already
+        sorted by priority and size, running is dictionary of users and
+        number of their RelMons in flight
+        """
+        queues = {user: list(relmons) for user, relmons in candidates.items() if relmons}
+        load = {user: running.get(user, 0) for user in queues}
+        selected = []
+        while queues and len(selected) < slots:
+            # Highest priority first, then user with fewest RelMons in flight,
+            # then smallest RelMon, then the one that was queued first
+            user = min(
+                queues,
+                key=lambda x: (
+                    -queues[x][0].get("priority", 0),
+                    load[x],
+                    queues[x][0].get("relval_count", 0),
+                    queues[x][0].get("queued_since", 0),
+                    x,
+                ),
+            )
+            selected.append(queues[user].pop(0))
+            load[user] += 1
+            if not queues[user]:
+                del queues[user]
+
+        return selected
@@ -3,26 +3,44 @@ Module that contains start of the program, tick scheduler and web APIs
 """
 import logging
 import json
+import hashlib
 import os
 import time
 import inspect
-from datetime import datetime
+import queue
+import threading
+from datetime import datetime, timedelta
 from flask import (
     Flask,
+    g,
     session,
     render_template,
     request,
     make_response,
+    has_request_context,
+    Response,
+    stream_with_context,
 )
 from flask_restful import Api
 from jinja2.exceptions import TemplateNotFound
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 from core_lib.middlewares.auth import AuthenticationMiddleware, UserInfo
 from mongodb_database import Database
+from mongodb_maintenance import create_indexes
+from mongodb_stores import LeaseStore, MetricsStore, OperationQueue, SchedulerStore
 from local.controller import Controller
+from local.email_sender import EmailSender
+from local.leader_election import LeaderElection
+from local.change_feed import ChangeFeed
+from local import metrics
+from local import response_encoding
 from local.relmon import RelMon
 from environment import (
     TICK_INTERVAL,
+    CONTROLLER_COALESCE_DELAY,
+    NOTIFICATION_INTERVAL,
+    LEASE_TTL,
     HOST,
     PORT,
     DEBUG,
@@ -42,7 +60,43 @@ if ENABLE_AUTH_MIDDLEWARE:
         lambda: auth.authenticate(request=request, flask_session=session)
     )
 scheduler = BackgroundScheduler()
+# Metrics snapshots older than this are not included in metrics endpoint
+METRICS_MAX_AGE = 86400
 controller = Controller()
+# Only replica that holds the lease runs controller ticks
+leader_election = LeaderElection("controller", LEASE_TTL)
+tick_schedule_lock = threading.Lock()
+# Sends notifications from the outbox, keeps SMTP session between sends
+email_sender = EmailSender()
+# Changes of RelMons for /api/stream
+change_feed = ChangeFeed()
+# Seconds between keep-alive comments in /api/stream
+STREAM_KEEPALIVE_INTERVAL = 15
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Remember when request processing started
+    """
+    g.request_start = time.time()
+
+
+@app.after_request
+def observe_request_time(response):
+    """
+    Observe request latency per route
+    """
+    request_start = g.get("request_start")
+    if request_start is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.time() - request_start,
+            route=request.url_rule.rule if request.url_rule else "<unmatched>",
+            method=request.method,
+            code=response.status_code,
+        )
+
+    return response
 
 
 def get_groups_from_headers() -> list[str]:
@@ -124,8 +178,13 @@ def add_relmon():
     if database.get_relmon(relmon.get_id()):
         return output_text({"message": "RelMon with this ID already exists"}, code=422)
 
-    controller.create_relmon(relmon, database, user_info_dict())
-    controller_tick()
+    if not controller.create_relmon(relmon, database, user_info_dict()):
+        # Name or ID was taken after the checks above
+        return output_text(
+            {"message": "RelMon with this name or ID already exists"}, code=422
+        )
+
+    trigger_controller(relmon.get_id())
     return output_text({"message": "OK"})
 
 
@@ -139,8 +198,9 @@ def reset_relmon():
 
     data = json.loads(request.data.decode("utf-8"))
     if "id" in data:
-        controller.add_to_reset_list(str(int(data["id"])), user_info_dict())
-        controller_tick()
+        relmon_id = str(int(data["id"]))
+        controller.add_to_reset_list(relmon_id, user_info_dict())
+        trigger_controller(relmon_id)
         return output_text({"message": "OK"})
 
     return output_text({"message": "No ID"})
@@ -156,97 +216,276 @@ def delete_relmon():
 
     data = json.loads(request.data.decode("utf-8"))
     if "id" in data:
-        controller.add_to_delete_list(str(int(data["id"])), user_info_dict())
-        controller_tick()
+        relmon_id = str(int(data["id"]))
+        controller.add_to_delete_list(relmon_id, user_info_dict())
+        trigger_controller(relmon_id)
         return output_text({"message": "OK"})
 
     return output_text({"message": "No ID"})
 
 
+@app.route("/api/set_priority", methods=["POST"])
+def set_relmon_priority():
+    """
+    API to set submission priority of a RelMon
+    RelMons with higher priority are submitted first, default is 0
+    """
+    if not is_user_authorized():
+        return output_text({"message": "Unauthorized"}, code=403)
+
+    data = json.loads(request.data.decode("utf-8"))
+    if "id" not in data:
+        return output_text({"message": "No ID"}, code=400)
+
+    try:
+        priority = int(data.get("priority"))
+    except (TypeError, ValueError):
+        return output_text({"message": "Priority must be an integer"}, code=400)
+
+    relmon_id = str(int(data["id"]))
+    if not Database().set_relmon_priority(relmon_id, priority):
+        return output_text({"message": "RelMon does not exist"}, code=404)
+
+    trigger_controller(relmon_id)
+    return output_text({"message": "OK"})
+
+
 @app.route("/api/get_relmons")
 def get_relmons():
     """
-    API to fetch RelMons from database
+    API to fetch RelMons from database, newest first
+    Arguments:
+    q - RelMon id, status or text to search for in names
+    limit - number of RelMons in a page
+    after - "next" token of the previous page, next page is found quickly
+    regardless of how deep it is
+    page - zero based page number, used if "after" is not given, deep pages
+    are slower to fetch
+    fields - "full" (default) for RelMons with all references and targets,
+    "summary" for RelMons with only progress "summary" instead of categories
+    total - "total_rows" is not returned if it is set to 0
     """
     database = Database()
     args = request.args.to_dict()
-    if args is None:
-        args = {}
-
-    page = int(args.get("page", 0))
     limit = int(args.get("limit", database.PAGE_SIZE))
-    query = args.get("q")
-    if query:
-        query = query.strip()
-        if query.lower() in (
-            "new",
-            "submitted",
-            "running",
-            "finishing",
-            "done",
-            "failed",
-        ):
-            query_dict = {"status": query.lower()}
-            data, total_rows = database.get_relmons(
-                query_dict=query_dict, page=page, page_size=limit
-            )
-        else:
-            query_dict = {"_id": query}
-            data, total_rows = database.get_relmons(
-                query_dict=query_dict, page=page, page_size=limit
-            )
-            if total_rows == 0:
-                query = "*%s*" % (query)
-                # Perform case insensitive search
-                query_dict = {
-                    "name": {"$regex": query.replace("*", ".*"), "$options": "-i"}
-                }
-                data, total_rows = database.get_relmons(
-                    query_dict=query_dict, page=page, page_size=limit
-                )
+    fields = args.get("fields", "full")
+    if fields not in ("full", "summary"):
+        return output_text({"message": "Fields must be full or summary"}, code=400)
+
+    after = None
+    skip = 0
+    if args.get("after"):
+        try:
+            after = database.decode_page_token(args["after"])
+        except ValueError:
+            return output_text({"message": "Invalid page token"}, code=400)
+    elif args.get("page"):
+        skip = max(int(args["page"]), 0) * limit
+
+    query = args.get("q", "").strip()
+    if not query:
+        queries = [{}]
+    elif query.lower() in (
+        "new",
+        "submitted",
+        "running",
+        "finishing",
+        "done",
+        "failed",
+    ):
+        queries = [{"status": query.lower()}]
+    elif query.startswith("^"):
+        # Case insensitive search by prefix, it uses the index of names
+        queries = [{"_id": query}, database.name_search_query(query[1:], True)]
     else:
-        data, total_rows = database.get_relmons(page=page, page_size=limit)
-
-    for relmon in data:
-        relmon.pop("user_info", None)
-        relmon["total_relvals"] = 0
-        relmon["downloaded_relvals"] = 0
-        relmon["compared_relvals"] = 0
-        for category in relmon.get("categories"):
-            relmon["total_relvals"] += len(category["reference"]) + len(
-                category["target"]
-            )
-            for reference_target in ("reference", "target"):
-                category["rerun"] = False
-                category["%s_status" % (reference_target)] = {}
-                category["%s_size" % (reference_target)] = 0
-                for relval in category[reference_target]:
-                    category["%s_size" % (reference_target)] += relval.get(
-                        "file_size", 0
-                    )
-                    relmon_status = relval["status"]
-                    if relmon_status not in category["%s_status" % (reference_target)]:
-                        category["%s_status" % (reference_target)][relmon_status] = 0
+        # Case insensitive search anywhere in the name
+        queries = [{"_id": query}, database.name_search_query(query, False)]
+
+    # First query that finds something is used, only ids and versions are
+    # fetched until it is known that page has changed
+    for query_dict in queries:
+        versions, last_id = database.get_relmons(
+            query_dict=query_dict,
+            page_size=limit,
+            projection=database.VERSION_PROJECTION,
+            after=after,
+            skip=skip,
+        )
+        if versions:
+            break
+
+    total_rows = None
+    if args.get("total") != "0":
+        total_rows = database.count_relmons(query_dict)
+
+    etag = make_etag(
+        [[x["_id"], x.get("last_update"), x.get("version")] for x in versions],
+        last_id,
+        limit,
+        total_rows,
+        fields,
+    )
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    data = []
+    if versions:
+        # Same RelMons as in the ETag, found by ids
+        projection = database.SUMMARY_PROJECTION
+        if fields == "full":
+            projection = database.FULL_PROJECTION
+
+        data, _ = database.get_relmons(
+            query_dict={"_id": {"$in": [x["_id"] for x in versions]}},
+            page_size=limit,
+            projection=projection,
+        )
+        if fields == "full":
+            for relmon in data:
+                add_progress(relmon)
+
+    result = {
+        "data": data,
+        "next": database.encode_page_token(last_id) if last_id else None,
+        "page_size": limit,
+    }
+    if total_rows is not None:
+        result["total_rows"] = total_rows
+
+    return output_text(result, etag=etag)
 
-                    if relmon_status != "initial":
-                        relmon["downloaded_relvals"] += +1
 
-                    if category["status"] == "done":
-                        relmon["compared_relvals"] += 1
+@app.route("/api/stream")
+def stream_changes():
+    """
+    API that streams changes of RelMons as Server-Sent Events
+    Each event is a JSON with operation (insert, update, delete or reset),
+    RelMon id and changed fields in dot notation, reset means that changes
+    were missed and everything should be fetched again
+    """
+    subscriber = change_feed.subscribe()
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    change = subscriber.get(timeout=STREAM_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    # Comment keeps connection open through proxies
+                    yield ": keep-alive\n\n"
+                    continue
 
-                    category["%s_status" % (reference_target)][relmon_status] += 1
+                yield "data: %s\n\n" % (json.dumps(change, separators=(",", ":")))
+        finally:
+            change_feed.unsubscribe(subscriber)
 
-    return output_text({"data": data, "total_rows": total_rows, "page_size": limit})
+    resp = Response(stream_with_context(events()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    # Do not let nginx buffer the events
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
-def output_text(data, code=200, headers=None):
+@app.route("/api/get_relmon")
+def get_relmon():
     """
-    Makes a Flask response with a plain text encoded body
+    API to fetch a single RelMon with all references and targets
+    """
+    relmon_id = request.args.get("id", "").strip()
+    database = Database()
+    version = database.get_relmon(relmon_id, database.VERSION_PROJECTION)
+    if not version:
+        return output_text({"message": "RelMon does not exist"}, code=404)
+
+    etag = make_etag(relmon_id, version.get("last_update"), version.get("version"))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    relmon = database.get_relmon(relmon_id)
+    if not relmon:
+        return output_text({"message": "RelMon does not exist"}, code=404)
+
+    relmon.pop("user_info", None)
+    relmon.pop("name_lowercase", None)
+    relmon.pop("name_words", None)
+    add_progress(relmon)
+    return output_text(relmon, etag=etag)
+
+
+def add_progress(relmon):
+    """
+    Add progress summary to RelMon with all references and targets, as well
+    as numbers of relvals to RelMon and statuses and sizes of references and
+    targets to it's categories
+    """
+    summary = RelMon(relmon).get_summary()
+    relmon["summary"] = summary
+    for key in ("total_relvals", "downloaded_relvals", "compared_relvals"):
+        relmon[key] = summary[key]
+
+    for category, category_summary in zip(relmon["categories"], summary["categories"]):
+        category["rerun"] = False
+        for reference_target in ("reference", "target"):
+            category["%s_status" % (reference_target)] = category_summary[
+                reference_target
+            ]["status"]
+            category["%s_size" % (reference_target)] = category_summary[
+                reference_target
+            ]["size"]
+
+
+def make_etag(*parts):
+    """
+    Return ETag of a response that is built from data that has given ids
+    and versions
+    """
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def not_modified(etag):
     """
-    resp = make_response(json.dumps(data, indent=1, sort_keys=True), code)
+    Makes a Flask response telling that client's copy is up to date
+    """
+    resp = make_response("", 304)
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
+def output_text(data, code=200, headers=None, etag=None):
+    """
+    Makes a Flask response with a plain text encoded body
+    Body is compact JSON unless "pretty" argument is given, it is compressed
+    if client accepts gzip or brotli
+    If ETag is given, client is asked to revalidate the response every time
+    """
+    pretty = has_request_context() and request.args.get("pretty", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    body = response_encoding.to_json(data, pretty)
+    encoding = None
+    if has_request_context():
+        body, encoding = response_encoding.compress(
+            body,
+            request.accept_encodings.best_match(response_encoding.supported_encodings()),
+        )
+
+    resp = make_response(body, code)
     resp.headers.extend(headers or {})
     resp.headers["Content-Type"] = "application/json"
+    resp.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
     resp.headers["Access-Control-Allow-Origin"] = "*"
+    if etag:
+        # Weak, because body depends on serialization and compression
+        resp.set_etag(etag, weak=True)
+        resp.headers["Cache-Control"] = "no-cache"
+
     return resp
 
 
@@ -273,8 +512,15 @@ def edit_relmon():
     if not relmon_id or not existing_relmon:
         return output_text({"message": "RelMon does not exist"}, code=404)
 
-    controller.edit_relmon(relmon, database, user_info_dict())
-    controller_tick()
+    if not controller.edit_relmon(relmon, database, user_info_dict()):
+        if any(x["id"] != relmon_id for x in database.get_relmons_with_name(relmon.get_name())):
+            return output_text(
+                {"message": "RelMon with this name already exists"}, code=409
+            )
+
+        return output_text({"message": "RelMon could not be saved, try again"}, code=409)
+
+    trigger_controller(relmon_id)
     return output_text({"message": "OK"})
 
 
@@ -302,19 +548,41 @@ def update_info():
     if not relmon:
         return output_text({"message": "Could not find"})
 
-    old_status = relmon.get("status")
-    relmon["categories"] = data["categories"]
-    relmon["status"] = data["status"]
+    statuses = {}
+
+    def apply_update(target):
+        relmon_json = target.get_json()
+        statuses["old"] = relmon_json.get("status")
+        if data.get("part"):
+            # Job of a part of RelMon updates only it's categories,
+            # final status comes from the merge job
+            for part_category in data["categories"]:
+                for index, category in enumerate(relmon_json["categories"]):
+                    if category["name"] == part_category["name"]:
+                        part_category["hlt"] = category["hlt"]
+                        relmon_json["categories"][index] = part_category
+
+            if relmon_json["status"] == "submitted" and data["status"] == "running":
+                relmon_json["status"] = "running"
+        else:
+            relmon_json["categories"] = data["categories"]
+            relmon_json["status"] = data["status"]
+
+        statuses["new"] = relmon_json["status"]
+
+    # Changes are made to RelMon object, so only they would be saved
+    relmon = database.update_relmon_with_retry(RelMon(relmon), apply_update)
+    if not relmon:
+        return output_text({"message": "Could not save"}, code=409)
+
     logger.info(
         "Update for %s (%s). Status is %s",
-        relmon["name"],
-        relmon["id"],
-        relmon["status"],
+        relmon.get_name(),
+        relmon.get_id(),
+        statuses["new"],
     )
-    database.update_relmon(RelMon(relmon))
-    if relmon["status"] != old_status:
-        for job in scheduler.get_jobs():
-            job.modify(next_run_time=datetime.now())
+    if statuses["new"] != statuses["old"]:
+        trigger_controller(relmon.get_id())
 
     return output_text({"message": "OK"})
 
@@ -327,12 +595,60 @@ def controller_tick():
     if not is_user_authorized():
         return output_text({"message": "Unauthorized"}, code=403)
 
-    for job in scheduler.get_jobs():
-        job.modify(next_run_time=datetime.now())
-
+    controller.request_sweep()
+    schedule_tick(0)
     return output_text({"message": "OK"})
 
 
+@app.route("/api/metrics")
+def get_metrics():
+    """
+    API for metrics in Prometheus text format
+    """
+    database = Database()
+    metrics.RELMONS.replace(
+        [
+            (count, {"status": status})
+            for status, count in database.get_relmon_status_counts().items()
+        ]
+    )
+    metrics.PENDING_OPERATIONS.replace(
+        [
+            (count, {"operation": operation})
+            for operation, count in OperationQueue().get_counts().items()
+        ]
+    )
+    # Controller ticks run in other processes, render their snapshots too
+    metrics_store = MetricsStore()
+    metrics_store.save(metrics.process_id(), metrics.REGISTRY.snapshot())
+    snapshots = metrics_store.get(METRICS_MAX_AGE)
+    resp = make_response(metrics.REGISTRY.render(snapshots), 200)
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return resp
+
+
+@app.route("/api/scheduler")
+def get_scheduler():
+    """
+    API for inspection of controller tick scheduling
+    Returns latest decisions of the leader and next tick time of this replica
+    """
+    lease = LeaseStore().get(leader_election.name) or {}
+    job = scheduler.get_job("tick")
+    next_run_time = None
+    if job and job.next_run_time:
+        next_run_time = int(job.next_run_time.timestamp())
+
+    return output_text(
+        {
+            "leader": lease.get("holder"),
+            "replica": leader_election.holder,
+            "next_tick": next_run_time,
+            "decisions": SchedulerStore().get_decisions(),
+        }
+    )
+
+
 @app.route("/api/user")
 def user_info():
     """
@@ -378,8 +694,79 @@ def is_user_authorized() -> bool:
 def tick():
     """
     Trigger controller to perform a tick
+    Return decision when the next tick should happen
+    """
+    return controller.tick(leader_election)
+
+
+def schedule_tick(delay):
+    """
+    Make controller tick in given number of seconds
+    Tick is not postponed if it is already scheduled to happen earlier
+    Only leader schedules ticks, other replicas leave the work to it
+    """
+    if leader_election.token is None:
+        return
+
+    with tick_schedule_lock:
+        job = scheduler.get_job("tick")
+        if not job:
+            return
+
+        run_time = datetime.now(scheduler.timezone) + timedelta(seconds=delay)
+        if job.next_run_time is None or job.next_run_time > run_time:
+            job.modify(next_run_time=run_time)
+
+
+def trigger_controller(relmon_id):
     """
-    controller.tick()
+    Mark RelMon as dirty and schedule a controller tick to process it
+    Triggers that arrive close together are coalesced into one tick
+    """
+    controller.mark_dirty(relmon_id)
+    schedule_tick(CONTROLLER_COALESCE_DELAY)
+
+
+def lease_heartbeat():
+    """
+    Acquire or renew controller lease
+    New leader does a full sweep immediately, leader picks up RelMons that
+    were marked dirty by other replicas
+    """
+    if leader_election.heartbeat():
+        controller.request_sweep()
+        schedule_tick(0)
+    elif leader_election.token is not None and controller.has_dirty_relmons():
+        schedule_tick(CONTROLLER_COALESCE_DELAY)
+
+
+def send_notifications():
+    """
+    Send notifications from the outbox, SMTP session of the sender is
+    reused by the next call
+    """
+    email_sender.send_pending()
+
+
+def tick_finished(event):
+    """
+    Schedule next tick as decided by the controller or sooner if RelMons
+    were marked dirty while tick was running and send notifications that
+    were produced during the tick
+    """
+    if event.job_id != "tick":
+        return
+
+    decision = getattr(event, "retval", None)
+    if decision:
+        schedule_tick(decision["next_tick"])
+
+    if leader_election.token is not None and controller.has_dirty_relmons():
+        schedule_tick(CONTROLLER_COALESCE_DELAY)
+
+    notifications_job = scheduler.get_job("notifications")
+    if notifications_job:
+        notifications_job.modify(next_run_time=datetime.now(scheduler.timezone))
 
 
 def setup_console_logging():
@@ -401,15 +788,42 @@ def main():
 
     setup_console_logging()
     logger = logging.getLogger("logger")
+    # Existing indexes are not created again, fields of RelMons saved by
+    # older versions are added by python3 mongodb_maintenance.py --create-indexes
+    create_indexes()
     scheduler.add_executor("processpool")
+    scheduler.add_executor("threadpool", alias="threadpool")
     if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
         controller.set_config()
-        scheduler.add_job(tick, "interval", seconds=TICK_INTERVAL, max_instances=1)
+        scheduler.add_job(
+            tick, "interval", seconds=TICK_INTERVAL, max_instances=1, id="tick"
+        )
+        scheduler.add_job(
+            send_notifications,
+            "interval",
+            seconds=NOTIFICATION_INTERVAL,
+            max_instances=1,
+            executor="threadpool",
+            id="notifications",
+        )
+        scheduler.add_job(
+            lease_heartbeat,
+            "interval",
+            seconds=max(1, LEASE_TTL // 3),
+            max_instances=1,
+            executor="threadpool",
+            id="lease",
+            next_run_time=datetime.now(scheduler.timezone),
+        )
+        scheduler.add_listener(tick_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
 
     scheduler.start()
     logger.info("Will run on %s:%s", host, port)
     app.run(host=host, port=port, debug=debug, threaded=True)
     scheduler.shutdown()
+    email_sender.close()
+    if leader_election.token is not None:
+        leader_election.release()
 
 
 if __name__ == "__main__":
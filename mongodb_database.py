@@ -1,15 +1,31 @@
 """
 Module that contains Database class
 """
+import base64
 import logging
 import time
 import json
 import os
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+import re
+import threading
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from local.metrics import DATABASE_QUERY_SECONDS, timed
+from local.relmon import RelMon
 from environment import MONGO_DB_PORT, MONGO_DB_HOST, MONGO_DB_PASSWORD, MONGO_DB_USER
 
 
+# Characters that separate words of RelMon names
+NAME_SEPARATOR_REGEX = re.compile(r"[^a-z0-9]+")
+
+
+def name_words(name):
+    """
+    Return sorted unique lowercase words of a RelMon name
+    """
+    return sorted({x for x in NAME_SEPARATOR_REGEX.split(name.lower()) if x})
+
+
 class Database:
     """
     Database class represents MongoDB database
@@ -21,28 +37,114 @@ class Database:
     DATABASE_PORT = MONGO_DB_PORT
     DATABASE_NAME = "relmons"
     COLLECTION_NAME = "relmons"
+    # Fields of RelMons in lists, references and targets are replaced by summary
+    SUMMARY_PROJECTION = {
+        "categories": 0,
+        "user_info": 0,
+        "job_usage": 0,
+        "name_lowercase": 0,
+        "name_words": 0,
+    }
+    # Fields of RelMons in lists with all references and targets
+    FULL_PROJECTION = {
+        "user_info": 0,
+        "job_usage": 0,
+        "name_lowercase": 0,
+        "name_words": 0,
+    }
+    # Fields that change whenever a RelMon is saved, used for ETags
+    VERSION_PROJECTION = {"last_update": 1, "version": 1}
+    # New RelMons that are looked at when choosing which to submit
+    CANDIDATES_LIMIT = 1000
+    # RelMons whose HTCondor jobs have to be checked
+    TO_CHECK_QUERY = {
+        "$or": [
+            {"status": {"$in": ["submitted", "running", "finishing"]}},
+            {"condor_status": "RUN"},
+        ]
+    }
+    # Seconds for which numbers of search results are cached
+    COUNT_CACHE_SECONDS = 60
+    # Maximum number of cached numbers of search results
+    COUNT_CACHE_SIZE = 100
+    # Attempts to save a change of RelMon that is changed at the same time
+    UPDATE_ATTEMPTS = 5
     USERNAME = MONGO_DB_USER
     PASSWORD = MONGO_DB_PASSWORD
+    # Maximum number of connections in the pool of the shared client
+    MAX_POOL_SIZE = 50
+    # Number of connections that pool keeps open even if they are idle
+    MIN_POOL_SIZE = 2
+    # Idle connections above minimum are closed after this many milliseconds
+    MAX_IDLE_TIME_MS = 300000
+    # Milliseconds to wait for a free connection from the pool
+    WAIT_QUEUE_TIMEOUT_MS = 10000
+    # MongoClient shared by all Database objects of a process
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+    # Cached numbers of search results of this process
+    _count_cache = {}
 
     def __init__(self):
         self.logger = logging.getLogger("logger")
+        self.client = self.get_client()[Database.DATABASE_NAME]
+        self.relmons = self.client[self.COLLECTION_NAME]
+
+    @classmethod
+    def get_client(cls):
+        """
+        Return MongoClient shared by the whole process, create it on first use
+        Client can not be used after fork, so forked process, e.g. a tick in
+        the process pool, creates it's own client
+        """
+        with cls._client_lock:
+            if cls._client is None or cls._client_pid != os.getpid():
+                cls._client = cls.__create_client()
+                cls._client_pid = os.getpid()
+
+            return cls._client
+
+    @classmethod
+    def __create_client(cls):
+        """
+        Create a new MongoClient with connection pool settings
+        """
+        logger = logging.getLogger("logger")
         db_host = os.environ.get("DB_HOST", Database.DATABASE_HOST)
-        db_port = os.environ.get("DB_PORT", Database.DATABASE_PORT)
+        db_port = int(os.environ.get("DB_PORT", Database.DATABASE_PORT))
+        pool_options = {
+            "maxPoolSize": cls.MAX_POOL_SIZE,
+            "minPoolSize": cls.MIN_POOL_SIZE,
+            "maxIdleTimeMS": cls.MAX_IDLE_TIME_MS,
+            "waitQueueTimeoutMS": cls.WAIT_QUEUE_TIMEOUT_MS,
+        }
         if Database.USERNAME and Database.PASSWORD:
-            self.logger.debug("Using DB with username and password")
-            self.client = MongoClient(
+            logger.debug("Using DB with username and password")
+            return MongoClient(
                 db_host,
                 db_port,
                 username=Database.USERNAME,
                 password=Database.PASSWORD,
                 authSource="admin",
                 authMechanism="SCRAM-SHA-256",
-            )[Database.DATABASE_NAME]
-        else:
-            self.logger.debug("Using DB without username and password")
-            self.client = MongoClient(db_host, db_port)[Database.DATABASE_NAME]
+                **pool_options,
+            )
 
-        self.relmons = self.client[self.COLLECTION_NAME]
+        logger.debug("Using DB without username and password")
+        return MongoClient(db_host, db_port, **pool_options)
+
+    @classmethod
+    def close_client(cls):
+        """
+        Close shared client of this process, next Database creates a new one
+        """
+        with cls._client_lock:
+            if cls._client is not None and cls._client_pid == os.getpid():
+                cls._client.close()
+
+            cls._client = None
+            cls._client_pid = None
 
     @classmethod
     def set_credentials(cls, username, password):
@@ -51,6 +153,8 @@ class Database:
         """
         cls.USERNAME = username
         cls.PASSWORD = password
+        # Client with old credentials must not be used anymore
+        cls.close_client()
 
     @classmethod
     def set_credentials_file(cls, filename):
@@ -62,64 +166,359 @@ class Database:
 
         cls.set_credentials(credentials["username"], credentials["password"])
 
+    def create_indexes(self):
+        """
+        Create indexes that are needed by the queries
+        Creating an index that already exists does nothing, so this is
+        done at every startup
+        Fields of RelMons saved before indexed fields were introduced are
+        added by migrate()
+        """
+        # Order in which new RelMons are submitted, also used by other
+        # queries of status
+        self.relmons.create_index(
+            [("status", 1), ("priority", -1), ("relval_count", 1), ("queued_since", 1)]
+        )
+        # Search by status sorted by newest first
+        self.relmons.create_index([("status", 1), ("_id", -1)])
+        # RelMons with a running job, regardless of their status
+        self.relmons.create_index([("condor_status", 1), ("status", 1)])
+        # History for resource estimation
+        self.relmons.create_index(
+            [("last_update", -1)],
+            partialFilterExpression={"job_usage": {"$exists": True}},
+        )
+        # Recently updated RelMons for the change feed
+        self.relmons.create_index([("last_update", 1)])
+        # Case insensitive search by name prefix and by words of the name
+        self.relmons.create_index([("name_lowercase", 1)])
+        self.relmons.create_index([("name_words", 1)])
+        try:
+            self.relmons.create_index([("name", 1)], unique=True)
+        except OperationFailure as ex:
+            duplicates = self.relmons.aggregate(
+                [
+                    {"$group": {"_id": "$name", "count": {"$sum": 1}}},
+                    {"$match": {"count": {"$gt": 1}}},
+                ]
+            )
+            self.logger.error(
+                "Could not create unique index of names: %s, duplicate names: %s",
+                ex,
+                ", ".join(x["_id"] for x in duplicates),
+            )
+
+    def migrate(self):
+        """
+        Add fields that are needed by queries and indexes to RelMons that
+        were saved before these fields were introduced
+        It goes through the whole collection, so it is done only by
+        maintenance command and not at startup
+        """
+        self.relmons.update_many(
+            {
+                "$or": [
+                    {"priority": {"$exists": False}},
+                    {"relval_count": {"$exists": False}},
+                    {"queued_since": {"$exists": False}},
+                ]
+            },
+            [{"$set": self.__submission_order_fields()}],
+        )
+        self.relmons.update_many(
+            {"name_lowercase": {"$exists": False}},
+            [{"$set": {"name_lowercase": {"$toLower": "$name"}}}],
+        )
+        relmons = self.relmons.find({"name_words": {"$exists": False}}, {"name": 1})
+        updates = [
+            UpdateOne({"_id": x["_id"]}, {"$set": {"name_words": name_words(x["name"])}})
+            for x in relmons
+        ]
+        if updates:
+            self.logger.info("Adding name words to %s RelMons", len(updates))
+            self.relmons.bulk_write(updates, ordered=False)
+
+        self.__add_missing_summaries()
+
+    @staticmethod
+    def __submission_order_fields():
+        """
+        Return expressions of fields used to order submissions, same as set
+        by RelMon reset, existing values are kept
+        """
+        categories = {
+            "$filter": {
+                "input": {"$ifNull": ["$categories", []]},
+                "cond": {"$eq": [{"$ifNull": ["$$this.status", "initial"]}, "initial"]},
+            }
+        }
+        relval_count = {
+            "$sum": {
+                "$map": {
+                    "input": categories,
+                    "in": {
+                        "$add": [
+                            {"$size": {"$ifNull": ["$$this.reference", []]}},
+                            {"$size": {"$ifNull": ["$$this.target", []]}},
+                        ]
+                    },
+                }
+            }
+        }
+        return {
+            "priority": {"$ifNull": ["$priority", 0]},
+            "relval_count": {"$ifNull": ["$relval_count", relval_count]},
+            "queued_since": {"$ifNull": ["$queued_since", {"$ifNull": ["$last_update", 0]}]},
+        }
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def create_relmon(self, relmon):
         """
         Add given RelMon to the database
+        Return None if RelMon with the same ID or name already exists
         """
         relmon_json = relmon.get_json()
         relmon_json["last_update"] = int(time.time())
+        relmon_json["name_lowercase"] = relmon_json["name"].lower()
+        relmon_json["name_words"] = name_words(relmon_json["name"])
+        relmon_json["summary"] = relmon.get_summary()
+        relmon_json["version"] = 1
         relmon_json["_id"] = relmon_json["id"]
         try:
-            return self.relmons.insert_one(relmon_json)
-        except DuplicateKeyError:
+            result = self.relmons.insert_one(relmon_json)
+        except DuplicateKeyError as ex:
+            self.logger.error("Could not create %s: %s", relmon, ex)
             return None
 
+        relmon.mark_saved()
+        return result
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def update_relmon(self, relmon):
         """
         Update given RelMon in the database based on ID
+        Only fields that changed since RelMon was loaded are written,
+        if nothing changed, nothing is written
+        Update is done only if version in the database is the same as
+        when RelMon was loaded
+        Return True if RelMon was saved or there was nothing to save, False
+        if it was changed in the database in the meantime
         """
         relmon_json = relmon.get_json()
-        relmon_json["last_update"] = int(time.time())
         if "_id" not in relmon_json:
             self.logger.error("No _id in document")
-            return
+            return None
+
+        relmon_json["name_lowercase"] = relmon_json["name"].lower()
+        relmon_json["name_words"] = name_words(relmon_json["name"])
+        if "categories" in relmon_json:
+            # RelMon might be loaded without categories
+            relmon_json["summary"] = relmon.get_summary()
+
+        changes, removed = relmon.get_changes()
+        if not changes and not removed:
+            self.logger.debug("Nothing changed in %s, not saving", relmon)
+            return True
+
+        version = relmon_json.get("version")
+        relmon_json["last_update"] = int(time.time())
+        changes["last_update"] = relmon_json["last_update"]
+        update = {"$set": changes, "$inc": {"version": 1}}
+        if removed:
+            update["$unset"] = {x: "" for x in removed}
 
+        query = {"_id": relmon_json["_id"]}
+        # RelMons saved before versions were introduced do not have it
+        query["version"] = version if version is not None else {"$exists": False}
         try:
-            self.relmons.replace_one({"_id": relmon_json["_id"]}, relmon_json)
-        except DuplicateKeyError:
+            result = self.relmons.update_one(query, update)
+        except DuplicateKeyError as ex:
+            self.logger.error("Could not save %s: %s", relmon, ex)
+            return None
+
+        if not result.matched_count:
+            self.logger.info("%s version %s was changed in the meantime", relmon, version)
+            return False
+
+        relmon_json["version"] = (version or 0) + 1
+        relmon.mark_saved()
+        return True
+
+    def update_relmon_with_retry(self, relmon, change, attempts=UPDATE_ATTEMPTS):
+        """
+        Apply change function to RelMon and save it
+        If RelMon was changed in the database in the meantime, fetch it
+        again, apply change to the fetched RelMon and try again
+        Return saved RelMon or None if it could not be saved
+        """
+        for _ in range(attempts):
+            change(relmon)
+            saved = self.update_relmon(relmon)
+            if saved:
+                return relmon
+
+            if saved is None:
+                return None
+
+            relmon_json = self.get_relmon(relmon.get_id())
+            if not relmon_json:
+                self.logger.warning("%s does not exist anymore", relmon)
+                return None
+
+            relmon = RelMon(relmon_json)
+
+        self.logger.error("Could not save %s in %s attempts", relmon, attempts)
+        return None
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def set_condor_statuses(self, condor_statuses):
+        """
+        Update HTCondor statuses of multiple RelMons in a single bulk write
+        condor_statuses is a dictionary of RelMon ids and new HTCondor statuses
+        """
+        if not condor_statuses:
             return
 
+        last_update = int(time.time())
+        self.relmons.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": relmon_id},
+                    {
+                        "$set": {
+                            "condor_status": status,
+                            "condor_status_since": last_update,
+                            "last_update": last_update,
+                        },
+                        "$inc": {"version": 1},
+                    },
+                )
+                for relmon_id, status in condor_statuses.items()
+            ],
+            ordered=False,
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def delete_relmon(self, relmon):
         """
         Delete given RelMon from the database based on it's ID
         """
         self.relmons.delete_one({"_id": relmon.get_id()})
 
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def get_relmon_count(self):
         """
         Return total number of RelMons in the database
         """
         return self.relmons.count_documents({})
 
-    def get_relmon(self, relmon_id):
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmon(self, relmon_id, projection=None):
         """
         Fetch a RelMon with given ID from the database
         """
-        return self.relmons.find_one({"_id": relmon_id})
+        return self.relmons.find_one({"_id": relmon_id}, projection)
 
-    def get_relmons(self, query_dict=None, page=0, page_size=PAGE_SIZE):
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmons(
+        self, query_dict=None, page_size=PAGE_SIZE, projection=None, after=None, skip=0
+    ):
         """
-        Search for relmons in the database
-        Return list of paginated RelMons and total number of search results
+        Search for relmons in the database, newest first
+        Page starts after RelMon with given id, so it is found using index of
+        ids regardless of how deep the page is, or after skipping given
+        number of RelMons, which gets slower the deeper the page is
+        Return list of RelMons and id of the last one if there are more
+        RelMons after it, None otherwise
         """
         if query_dict is None:
             query_dict = {}
 
-        relmons = self.relmons.find(query_dict).sort("_id", -1)
-        total_rows = relmons.count()
-        relmons = relmons.skip(page * page_size).limit(page_size)
-        return list(relmons), total_rows
+        if after is not None:
+            query_dict = {"$and": [query_dict, {"_id": {"$lt": after}}]}
+
+        # One extra RelMon tells whether there is a next page
+        relmons = self.relmons.find(query_dict, projection).sort("_id", -1)
+        if skip:
+            relmons = relmons.skip(skip)
+
+        relmons = list(relmons.limit(page_size + 1))
+        if len(relmons) <= page_size:
+            return relmons, None
+
+        relmons = relmons[:page_size]
+        return relmons, relmons[-1]["_id"]
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def count_relmons(self, query_dict=None):
+        """
+        Return number of RelMons that match the query
+        Total number is estimated from collection metadata, numbers of
+        search results are cached for a short time
+        """
+        if not query_dict:
+            return self.relmons.estimated_document_count()
+
+        key = json.dumps(query_dict, sort_keys=True)
+        now = time.time()
+        cached = self._count_cache.get(key)
+        if cached and cached[0] > now - self.COUNT_CACHE_SECONDS:
+            return cached[1]
+
+        count = self.relmons.count_documents(query_dict)
+        if len(self._count_cache) >= self.COUNT_CACHE_SIZE:
+            self._count_cache.clear()
+
+        self._count_cache[key] = (now, count)
+        return count
+
+    @staticmethod
+    def encode_page_token(relmon_id):
+        """
+        Return opaque token of the page that starts after given RelMon
+        """
+        token = json.dumps({"after": relmon_id}).encode("utf-8")
+        return base64.urlsafe_b64encode(token).decode("utf-8")
+
+    @staticmethod
+    def decode_page_token(token):
+        """
+        Return RelMon id the page of given token starts after
+        Raise ValueError if token is not valid
+        """
+        try:
+            return json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))["after"]
+        except (ValueError, TypeError, KeyError) as ex:
+            raise ValueError("Invalid page token") from ex
 
+    def __add_missing_summaries(self):
+        """
+        Add progress summary to RelMons that were saved before summaries
+        were introduced
+        """
+        relmons = self.relmons.find(
+            {"summary": {"$exists": False}}, {"name": 1, "categories": 1}
+        )
+        updates = [
+            UpdateOne(
+                {"_id": x["_id"]},
+                {"$set": {"summary": RelMon(x).get_summary()}, "$inc": {"version": 1}},
+            )
+            for x in relmons
+        ]
+        if updates:
+            self.logger.info("Adding summaries to %s RelMons", len(updates))
+            self.relmons.bulk_write(updates, ordered=False)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmons_with_ids(self, relmon_ids):
+        """
+        Get list of RelMons with given IDs
+        """
+        relmons = self.relmons.find({"_id": {"$in": list(relmon_ids)}})
+        return list(relmons)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def get_relmons_with_status(self, status):
         """
         Get list of RelMons with given status
@@ -127,6 +526,7 @@ class Database:
         relmons = self.relmons.find({"status": status})
         return list(relmons)
 
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def get_relmons_with_condor_status(self, status):
         """
         Get list of RelMons with given HTCondor status
@@ -134,9 +534,335 @@ class Database:
         relmons = self.relmons.find({"condor_status": status})
         return list(relmons)
 
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmons_to_check(self):
+        """
+        Get list of RelMons that are submitted, running or finishing or have
+        HTCondor status RUN
+        Only fields needed to check HTCondor status and schedule next check
+        are returned
+        """
+        relmons = self.relmons.find(
+            self.TO_CHECK_QUERY,
+            {
+                "id": 1,
+                "name": 1,
+                "status": 1,
+                "condor_id": 1,
+                "condor_status": 1,
+                "condor_status_since": 1,
+                "expected_runtime": 1,
+            },
+        )
+        return list(relmons)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmons_with_job_usage(self, limit):
+        """
+        Get latest RelMons that have resource usage of their job
+        Only fields needed for resource estimation are returned
+        """
+        relmons = self.relmons.find(
+            {"job_usage": {"$exists": True}},
+            {
+                "id": 1,
+                "name": 1,
+                "last_update": 1,
+                "job_usage": 1,
+                "categories.name": 1,
+                "categories.hlt": 1,
+                "categories.status": 1,
+                "categories.reference.name": 1,
+                "categories.reference.file_size": 1,
+                "categories.target.name": 1,
+                "categories.target.file_size": 1,
+            },
+        )
+        return list(relmons.sort("last_update", -1).limit(limit))
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
     def get_relmons_with_name(self, relmon_name):
         """
         Get list of (should be one) RelMons with given name
         """
         relmons = self.relmons.find({"name": relmon_name})
         return list(relmons)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmons_in_flight_per_user(self):
+        """
+        Return dictionary of users and number of their RelMons that are
+        submitted, running or finishing
+        """
+        counts = self.relmons.aggregate(self.__in_flight_per_user_pipeline())
+        return {x["_id"]: x["count"] for x in counts}
+
+    @staticmethod
+    def __in_flight_per_user_pipeline():
+        """
+        Return aggregation pipeline of get_relmons_in_flight_per_user
+        """
+        return [
+            {"$match": {"status": {"$in": ["submitted", "running", "finishing"]}}},
+            {"$group": {"_id": "$user_info.login", "count": {"$sum": 1}}},
+        ]
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_submission_candidates(self, limit):
+        """
+        Return dictionary of users and up to limit of their new RelMons in
+        order of priority, size and time they were queued
+        Only first CANDIDATES_LIMIT new RelMons in that order are looked at,
+        they are read from the index instead of scanning all new RelMons
+        Only fields needed for scheduling are returned
+        """
+        candidates = self.relmons.aggregate(self.__submission_candidates_pipeline(limit))
+        return {x["_id"]: x["relmons"] for x in candidates}
+
+    @staticmethod
+    def __submission_candidates_pipeline(limit):
+        """
+        Return aggregation pipeline of get_submission_candidates
+        """
+        return [
+            {"$match": {"status": "new", "name": {"$not": {"$regex": "NOSUBMIT"}}}},
+            {"$sort": {"priority": -1, "relval_count": 1, "queued_since": 1}},
+            {"$limit": Database.CANDIDATES_LIMIT},
+            {
+                "$group": {
+                    "_id": "$user_info.login",
+                    "relmons": {
+                        "$push": {
+                            "id": "$id",
+                            "priority": "$priority",
+                            "relval_count": "$relval_count",
+                            "queued_since": "$queued_since",
+                        }
+                    },
+                }
+            },
+            {"$project": {"relmons": {"$slice": ["$relmons", limit]}}},
+        ]
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def set_relmon_priority(self, relmon_id, priority):
+        """
+        Set submission priority of a RelMon
+        Return whether RelMon exists
+        """
+        result = self.relmons.update_one(
+            {"_id": relmon_id}, {"$set": {"priority": priority}, "$inc": {"version": 1}}
+        )
+        return result.matched_count > 0
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_relmon_status_counts(self):
+        """
+        Return dictionary of RelMon statuses and number of RelMons in them
+        """
+        counts = self.relmons.aggregate(
+            [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+        )
+        return {x["_id"]: x["count"] for x in counts}
+
+    @staticmethod
+    def name_search_query(query, prefix):
+        """
+        Return query for case insensitive search of names, "*" is a wildcard
+        Search by prefix uses the index of names
+        Search anywhere in the name uses the index of words of names if
+        query contains a separator, e.g. "_": part of the query after a
+        separator is the start of a word of the name and part between two
+        separators is a whole word. Search for a part of a single word scans
+        the whole index of names
+        """
+        query = query.lower()
+        pattern = ".*".join(re.escape(x) for x in query.split("*"))
+        if prefix:
+            return {"name_lowercase": {"$regex": "^%s" % (pattern)}}
+
+        words = []
+        for part in query.split("*"):
+            part_words = NAME_SEPARATOR_REGEX.split(part)
+            for index, word in enumerate(part_words[1:], 1):
+                if not word:
+                    continue
+
+                if index < len(part_words) - 1:
+                    words.append({"name_words": word})
+                else:
+                    words.append({"name_words": {"$regex": "^%s" % (re.escape(word))}})
+
+        name_query = {"name_lowercase": {"$regex": pattern}}
+        if not words:
+            return name_query
+
+        return {"$and": words + [name_query]}
+
+    def explain_queries(self):
+        """
+        Explain query plans of queries that are done by Database methods
+        Return list of dictionaries with method name, plan stages, numbers
+        of examined and returned documents and whether collection is scanned
+        """
+        finds = [
+            ("get_relmon", self.relmons, {"_id": "0"}, None, None),
+            ("get_relmons", self.relmons, {}, [("_id", -1)], self.PAGE_SIZE),
+            (
+                "get_relmons(after)",
+                self.relmons,
+                {"_id": {"$lt": "0"}},
+                [("_id", -1)],
+                self.PAGE_SIZE,
+            ),
+            (
+                "get_relmons(status)",
+                self.relmons,
+                {"status": "done"},
+                [("_id", -1)],
+                self.PAGE_SIZE,
+            ),
+            (
+                "get_relmons(name prefix)",
+                self.relmons,
+                self.name_search_query("cmssw", True),
+                [("_id", -1)],
+                self.PAGE_SIZE,
+            ),
+            (
+                "get_relmons(name words)",
+                self.relmons,
+                self.name_search_query("cmssw_14_0", False),
+                [("_id", -1)],
+                self.PAGE_SIZE,
+            ),
+            ("get_relmons_with_ids", self.relmons, {"_id": {"$in": ["0"]}}, None, None),
+            ("get_relmons_with_status", self.relmons, {"status": "new"}, None, None),
+            (
+                "get_relmons_with_condor_status",
+                self.relmons,
+                {"condor_status": "RUN"},
+                None,
+                None,
+            ),
+            ("get_relmons_to_check", self.relmons, self.TO_CHECK_QUERY, None, None),
+            (
+                "get_relmons_with_job_usage",
+                self.relmons,
+                {"job_usage": {"$exists": True}},
+                [("last_update", -1)],
+                100,
+            ),
+            ("get_relmons_with_name", self.relmons, {"name": "0"}, None, None),
+        ]
+        aggregations = [
+            (
+                "get_relmons_in_flight_per_user",
+                self.relmons,
+                self.__in_flight_per_user_pipeline(),
+            ),
+            (
+                "get_submission_candidates",
+                self.relmons,
+                self.__submission_candidates_pipeline(1),
+            ),
+            (
+                "get_relmon_status_counts",
+                self.relmons,
+                [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+            ),
+        ]
+        return explain(self.client, finds, aggregations)
+
+
+def explain(database, finds, aggregations):
+    """
+    Explain query plans of given finds, tuples of method name, collection,
+    query, sort and limit, and aggregations, tuples of method name,
+    collection and pipeline
+    Return list of dictionaries with method name, plan stages, numbers
+    of examined and returned documents and whether collection is scanned
+    """
+    results = []
+    for method, collection, query, sort, limit in finds:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        if limit:
+            cursor = cursor.limit(limit)
+
+        results.append(plan_summary(method, collection, cursor.explain()))
+
+    for method, collection, pipeline in aggregations:
+        explain_output = database.command(
+            "aggregate", collection.name, pipeline=pipeline, explain=True
+        )
+        results.append(plan_summary(method, collection, explain_output))
+
+    return results
+
+
+def plan_summary(method, collection, explain_output):
+    """
+    Return summary of explain output of a query
+    """
+
+    def plan_stages(node):
+        # Rejected plans are not executed, so they are not interesting
+        stages = []
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in ("rejectedPlans", "allPlansExecution"):
+                    continue
+
+                if key == "stage":
+                    stages.append(value)
+                else:
+                    stages.extend(plan_stages(value))
+        elif isinstance(node, list):
+            for value in node:
+                stages.extend(plan_stages(value))
+
+        return stages
+
+    def find_key(node, key):
+        if isinstance(node, dict):
+            if key in node:
+                return node[key]
+
+            node = list(node.values())
+
+        if isinstance(node, list):
+            for value in node:
+                found = find_key(value, key)
+                if found is not None:
+                    return found
+
+        return None
+
+    stages = []
+    for stage in plan_stages(find_key(explain_output, "winningPlan")):
+        if stage not in stages:
+            stages.append(stage)
+
+    statistics = find_key(explain_output, "executionStats") or {}
+    return {
+        "method": method,
+        "collection": collection.name,
+        "stages": stages,
+        "examined": statistics.get("totalDocsExamined"),
+        "returned": statistics.get("nReturned"),
+        "collection_scan": "COLLSCAN" in stages,
+    }
+
+
+def _reset_client_lock():
+    """
+    Lock might have been held by another thread at the moment of fork
+    """
+    Database._client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_client_lock)
+
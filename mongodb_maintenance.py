@@ -0,0 +1,77 @@
+"""
+Database maintenance and diagnostics
+Usage: python3 mongodb_maintenance.py --create-indexes --explain
+"""
+import argparse
+import logging
+from mongodb_database import Database
+from mongodb_stores import STORES
+
+
+def create_indexes():
+    """
+    Create indexes of all collections
+    """
+    Database().create_indexes()
+    for store in STORES:
+        store().create_indexes()
+
+
+def explain_queries():
+    """
+    Return summaries of query plans of all collections
+    """
+    results = Database().explain_queries()
+    for store in STORES:
+        results.extend(store().explain_queries())
+
+    return results
+
+
+def main():
+    """
+    Migrate RelMons, create indexes and explain query plans
+    """
+    parser = argparse.ArgumentParser(description="RelMon Service database tools")
+    parser.add_argument(
+        "--create-indexes",
+        action="store_true",
+        help="Add indexed fields to RelMons that do not have them and create "
+        "indexes of all collections",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Explain plans of all queries and flag collection scans",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.create_indexes:
+        Database().migrate()
+        create_indexes()
+
+    if args.explain:
+        print(
+            "%-32s %-14s %8s %8s %s"
+            % ("method", "collection", "examined", "returned", "stages")
+        )
+        collection_scans = 0
+        for result in explain_queries():
+            collection_scans += int(result["collection_scan"])
+            print(
+                "%-32s %-14s %8s %8s %s%s"
+                % (
+                    result["method"],
+                    result["collection"],
+                    "-" if result["examined"] is None else result["examined"],
+                    "-" if result["returned"] is None else result["returned"],
+                    " > ".join(result["stages"]),
+                    "  <-- COLLECTION SCAN" if result["collection_scan"] else "",
+                )
+            )
+
+        print("Queries with collection scans: %s" % (collection_scans))
+
+
+if __name__ == "__main__":
+    main()
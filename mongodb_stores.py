@@ -0,0 +1,489 @@
+"""
+Module with stores of service state other than RelMons: queue of RelMon
+operations, outbox of notifications, leases, scheduler state and metrics
+snapshots
+Each store keeps it's documents in a collection of the RelMon database and
+shares MongoClient of Database
+"""
+import logging
+import time
+import uuid
+from pymongo import DeleteOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from local.metrics import DATABASE_QUERY_SECONDS, timed
+from mongodb_database import Database, explain
+
+
+class Store:
+    """
+    Base class of a store of documents in a collection
+    """
+
+    COLLECTION_NAME = None
+
+    def __init__(self):
+        self.logger = logging.getLogger("logger")
+        self.database = Database.get_client()[Database.DATABASE_NAME]
+        self.collection = self.database[self.COLLECTION_NAME]
+
+    def create_indexes(self):
+        """
+        Create indexes that are needed by the queries of the store
+        """
+
+    def explain_queries(self):
+        """
+        Return summaries of query plans of the store, see Database
+        """
+        return []
+
+
+class OperationQueue(Store):
+    """
+    Queue of RelMon operations (reset, delete, check and sweep) that are
+    done during the next controller tick
+    Operations are stored in the database, so they survive restarts and
+    are shared by replicas
+    """
+
+    COLLECTION_NAME = "operations"
+    # Claimed operations that are not acknowledged in this time are claimed
+    # again, e.g. if process was killed during a tick, it is longer than a
+    # tick is expected to take
+    CLAIM_TIMEOUT = 600
+
+    def create_indexes(self):
+        self.collection.create_index([("operation", 1), ("claim", 1)])
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def enqueue(self, relmon_id, operation, user_info=None):
+        """
+        Add an operation of a RelMon to the queue
+        Same operation of the same RelMon is queued only once, but if it is
+        enqueued again while claimed, it will be processed again
+        """
+        self.collection.update_one(
+            {"_id": "%s_%s" % (operation, relmon_id)},
+            {
+                "$set": {"user_info": user_info, "enqueued_at": time.time()},
+                "$setOnInsert": {
+                    "relmon_id": relmon_id,
+                    "operation": operation,
+                    "claim": None,
+                    "claimed_at": 0,
+                },
+            },
+            upsert=True,
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def claim(self, operation, claim_timeout=CLAIM_TIMEOUT):
+        """
+        Atomically claim all pending operations of given type
+        Operations that were claimed earlier, but not acknowledged in
+        claim_timeout seconds are claimed again
+        Return list of claimed operations in the order they were enqueued
+        """
+        claim = uuid.uuid4().hex
+        now = time.time()
+        self.collection.update_many(
+            {
+                "operation": operation,
+                "$or": [{"claim": None}, {"claimed_at": {"$lt": now - claim_timeout}}],
+            },
+            {"$set": {"claim": claim, "claimed_at": now}},
+        )
+        operations = self.collection.find({"operation": operation, "claim": claim})
+        return sorted(operations, key=lambda x: x["enqueued_at"])
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def ack(self, operations):
+        """
+        Remove processed operations from the queue
+        Operations that were enqueued again after being claimed are
+        released, so they would be claimed again
+        """
+        if not operations:
+            return
+
+        self.collection.bulk_write(
+            [
+                DeleteOne({"_id": x["_id"], "enqueued_at": x["enqueued_at"]})
+                for x in operations
+            ],
+            ordered=False,
+        )
+        self.collection.update_many(
+            {"_id": {"$in": [x["_id"] for x in operations]}},
+            {"$set": {"claim": None, "claimed_at": 0}},
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def release(self, operations):
+        """
+        Release claimed operations that were not processed, so they would
+        be claimed again by the next tick
+        """
+        if not operations:
+            return
+
+        self.collection.update_many(
+            {
+                "_id": {"$in": [x["_id"] for x in operations]},
+                "claim": {"$in": list({x["claim"] for x in operations})},
+            },
+            {"$set": {"claim": None, "claimed_at": 0}},
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def has_pending(self, operation):
+        """
+        Return whether there are unclaimed operations of given type
+        """
+        return bool(self.collection.find_one({"operation": operation, "claim": None}))
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_counts(self):
+        """
+        Return dictionary of operation types and number of queued operations
+        """
+        counts = self.collection.aggregate(
+            [{"$group": {"_id": "$operation", "count": {"$sum": 1}}}]
+        )
+        return {x["_id"]: x["count"] for x in counts}
+
+    def explain_queries(self):
+        return explain(
+            self.database,
+            [
+                (
+                    "OperationQueue.claim",
+                    self.collection,
+                    {"operation": "check", "claim": "0"},
+                    None,
+                    None,
+                ),
+                (
+                    "OperationQueue.has_pending",
+                    self.collection,
+                    {"operation": "check", "claim": None},
+                    None,
+                    1,
+                ),
+            ],
+            [
+                (
+                    "OperationQueue.get_counts",
+                    self.collection,
+                    [{"$group": {"_id": "$operation", "count": {"$sum": 1}}}],
+                ),
+            ],
+        )
+
+
+class NotificationOutbox(Store):
+    """
+    Outbox of email notifications that are sent in the background
+    """
+
+    COLLECTION_NAME = "notifications"
+    # Claimed notifications that are not acknowledged in this time are
+    # claimed again
+    CLAIM_TIMEOUT = 3600
+
+    def create_indexes(self):
+        self.collection.create_index([("claim", 1), ("next_attempt", 1)])
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def enqueue(self, notification):
+        """
+        Put notification to the outbox
+        """
+        notification = dict(notification)
+        notification["created"] = time.time()
+        notification["attempts"] = 0
+        notification["next_attempt"] = 0
+        notification["claim"] = None
+        notification["claimed_at"] = 0
+        self.collection.insert_one(notification)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def claim(self, limit, claim_timeout=CLAIM_TIMEOUT):
+        """
+        Atomically claim up to limit notifications that are due to be sent
+        Return list of claimed notifications in the order they were created
+        """
+        now = time.time()
+        query = {
+            "next_attempt": {"$lte": now},
+            "$or": [{"claim": None}, {"claimed_at": {"$lt": now - claim_timeout}}],
+        }
+        notification_ids = [
+            x["_id"]
+            for x in self.collection.find(query, {"_id": 1})
+            .sort("created", 1)
+            .limit(limit)
+        ]
+        if not notification_ids:
+            return []
+
+        claim = uuid.uuid4().hex
+        query["_id"] = {"$in": notification_ids}
+        self.collection.update_many(query, {"$set": {"claim": claim, "claimed_at": now}})
+        notifications = self.collection.find({"claim": claim})
+        return sorted(notifications, key=lambda x: x["created"])
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def ack(self, notification_ids):
+        """
+        Remove sent notifications from the outbox
+        """
+        if notification_ids:
+            self.collection.delete_many({"_id": {"$in": list(notification_ids)}})
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def release(self, notification_id, attempts, next_attempt):
+        """
+        Release claimed notification so it would be retried at next_attempt
+        """
+        self.collection.update_one(
+            {"_id": notification_id},
+            {
+                "$set": {
+                    "attempts": attempts,
+                    "next_attempt": next_attempt,
+                    "claim": None,
+                    "claimed_at": 0,
+                }
+            },
+        )
+
+    def explain_queries(self):
+        return explain(
+            self.database,
+            [
+                (
+                    "NotificationOutbox.claim",
+                    self.collection,
+                    {
+                        "next_attempt": {"$lte": 0},
+                        "$or": [{"claim": None}, {"claimed_at": {"$lt": 0}}],
+                    },
+                    [("created", 1)],
+                    None,
+                ),
+            ],
+            [],
+        )
+
+
+class LeaseStore(Store):
+    """
+    Leases with fencing tokens used for leader election
+    """
+
+    COLLECTION_NAME = "leases"
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def acquire(self, name, holder, ttl):
+        """
+        Acquire or renew a lease with given name for ttl seconds
+        Lease can be acquired if it does not exist, is expired or is already
+        held by the same holder
+        Fencing token is increased every time lease changes holder
+        Return fencing token if lease is held, None otherwise
+        """
+        now = time.time()
+        # Renew own lease
+        lease = self.collection.find_one_and_update(
+            {"_id": name, "holder": holder},
+            {"$set": {"expires": now + ttl, "renewed": now}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if lease:
+            return lease["token"]
+
+        # Take over an expired lease
+        lease = self.collection.find_one_and_update(
+            {"_id": name, "expires": {"$lt": now}},
+            {
+                "$set": {
+                    "holder": holder,
+                    "expires": now + ttl,
+                    "renewed": now,
+                    "acquired": now,
+                },
+                "$inc": {"token": 1},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if lease:
+            return lease["token"]
+
+        # Create a lease if there is none
+        try:
+            self.collection.insert_one(
+                {
+                    "_id": name,
+                    "holder": holder,
+                    "token": 1,
+                    "expires": now + ttl,
+                    "renewed": now,
+                    "acquired": now,
+                }
+            )
+            return 1
+        except DuplicateKeyError:
+            return None
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def release(self, name, holder):
+        """
+        Release a lease if it is held by given holder
+        """
+        self.collection.update_one(
+            {"_id": name, "holder": holder}, {"$set": {"expires": 0}}
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get(self, name):
+        """
+        Return lease with given name
+        """
+        return self.collection.find_one({"_id": name})
+
+    def explain_queries(self):
+        return explain(
+            self.database,
+            [("LeaseStore.get", self.collection, {"_id": "controller"}, None, None)],
+            [],
+        )
+
+
+class SchedulerStore(Store):
+    """
+    State of controller tick scheduling: time of the last full sweep and
+    latest scheduling decisions
+    """
+
+    COLLECTION_NAME = "scheduler"
+    # Number of latest tick scheduling decisions that are kept
+    DECISIONS = 20
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def add_decision(self, decision):
+        """
+        Save tick scheduling decision, only latest decisions are kept
+        """
+        self.collection.update_one(
+            {"_id": "controller"},
+            {"$push": {"decisions": {"$each": [decision], "$slice": -self.DECISIONS}}},
+            upsert=True,
+        )
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_last_decision(self):
+        """
+        Return latest tick scheduling decision or None if there is none
+        """
+        scheduler = self.collection.find_one(
+            {"_id": "controller"}, {"decisions": {"$slice": -1}}
+        )
+        if not scheduler or not scheduler.get("decisions"):
+            return None
+
+        return scheduler["decisions"][-1]
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_decisions(self):
+        """
+        Return latest tick scheduling decisions, newest first
+        """
+        scheduler = self.collection.find_one({"_id": "controller"})
+        if not scheduler:
+            return []
+
+        return list(reversed(scheduler.get("decisions", [])))
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def get_last_sweep(self):
+        """
+        Return time of last full sweep of all RelMons, 0 if there was none
+        """
+        scheduler = self.collection.find_one({"_id": "controller"}, {"last_sweep": 1})
+        if not scheduler:
+            return 0
+
+        return scheduler.get("last_sweep", 0)
+
+    @timed(DATABASE_QUERY_SECONDS, "method")
+    def set_last_sweep(self, last_sweep):
+        """
+        Save time of last full sweep of all RelMons
+        """
+        self.collection.update_one(
+            {"_id": "controller"}, {"$set": {"last_sweep": last_sweep}}, upsert=True
+        )
+
+    def explain_queries(self):
+        return explain(
+            self.database,
+            [
+                (
+                    "SchedulerStore.get_decisions",
+                    self.collection,
+                    {"_id": "controller"},
+                    None,
+                    None,
+                )
+            ],
+            [],
+        )
+
+
+class MetricsStore(Store):
+    """
+    Metrics snapshots of all processes of all replicas
+    """
+
+    COLLECTION_NAME = "metrics"
+
+    def create_indexes(self):
+        self.collection.create_index([("updated", 1)])
+
+    def save(self, process_id, snapshot):
+        """
+        Save snapshot of metrics of a process
+        """
+        self.collection.replace_one(
+            {"_id": process_id},
+            {"_id": process_id, "snapshot": snapshot, "updated": time.time()},
+            upsert=True,
+        )
+
+    def get(self, max_age):
+        """
+        Return dictionary of process ids and their metrics snapshots that
+        were updated in the last max_age seconds
+        """
+        snapshots = self.collection.find({"updated": {"$gte": time.time() - max_age}})
+        return {x["_id"]: x["snapshot"] for x in snapshots}
+
+    def explain_queries(self):
+        return explain(
+            self.database,
+            [
+                (
+                    "MetricsStore.get",
+                    self.collection,
+                    {"updated": {"$gte": time.time()}},
+                    None,
+                    None,
+                )
+            ],
+            [],
+        )
+
+
+# All stores, e.g. for creating their indexes
+STORES = (OperationQueue, NotificationOutbox, LeaseStore, SchedulerStore, MetricsStore)
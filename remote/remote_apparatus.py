@@ -6,6 +6,8 @@ for these root files
 During the whole process, it sends callbacks to RelmonService
 website about file and whole RelMon status changes
 Output is stored in Reports directory
+RelMon can also be split into parts - one category (and HLT flag) per job,
+then parts are merged back into one RelMon by the final job
 """
 import json
 import argparse
@@ -617,6 +619,94 @@ def run_validation_matrix(relmon, cpus, callback_url, callback_credentials):
             notify(relmon, callback_url, callback_credentials)
 
 
+def select_part(relmon, category_name, hlt):
+    """
+    Return RelMon with only given category
+    If HLT flag is given, category is compared only with or only without HLT
+    """
+    part = dict(relmon)
+    part["part"] = True
+    part["categories"] = []
+    for category in relmon.get("categories", []):
+        if category["name"] != category_name:
+            continue
+
+        category = dict(category)
+        if hlt == "yes":
+            category["hlt"] = "only"
+        elif hlt == "no":
+            category["hlt"] = "no"
+
+        part["categories"].append(category)
+
+    return part
+
+
+def merge_items(items, part_items):
+    """
+    Merge statuses and file info of references or targets of a part
+    Item that is still initial is taken from the part, item that was
+    downloaded in one part, but not in another takes status of the other
+    """
+    part_items = {x["name"]: x for x in part_items}
+    for index, item in enumerate(items):
+        part_item = part_items.get(item["name"])
+        if not part_item:
+            continue
+
+        if item["status"] == "initial" or (
+            item["status"] == "downloaded" and part_item["status"] != "downloaded"
+        ):
+            items[index] = part_item
+
+
+def merge_parts(relmon, part_file_names):
+    """
+    Update categories of RelMon with categories of parts
+    Category with HLT "both" is compared in two parts, so references and
+    targets are merged item by item and category is done only if both
+    parts are done
+    RelMon fails if any of the parts failed
+    """
+    merged = set()
+    for part_file_name in part_file_names:
+        logging.info("Merging %s", part_file_name)
+        with open(part_file_name) as part_file:
+            part = json.load(part_file)
+
+        for part_category in part.get("categories", []):
+            for category in relmon.get("categories", []):
+                if category["name"] != part_category["name"]:
+                    continue
+
+                for reference_target in ("reference", "target"):
+                    merge_items(
+                        category[reference_target],
+                        part_category.get(reference_target, []),
+                    )
+
+                if category["name"] not in merged or part_category["status"] != "done":
+                    category["status"] = part_category["status"]
+
+                merged.add(category["name"])
+
+        if part.get("status") == "failed":
+            logging.error("Part %s failed", part_file_name)
+            relmon["status"] = "failed"
+
+    for category in relmon.get("categories", []):
+        if category["name"] in merged:
+            continue
+
+        if category["reference"] or category["target"]:
+            # Category should have been compared in a part
+            logging.error("No part for category %s", category["name"])
+            category["status"] = "failed"
+        else:
+            # Categories without references and targets were not split into parts
+            category["status"] = "done"
+
+
 def main():
     """
     Main function
@@ -645,6 +735,18 @@ def main():
         action="store_true",
         help="Request and send OAuth tokens to authenticate the callback"
     )
+    parser.add_argument("--category", type=str, help="Compare only this category")
+    parser.add_argument(
+        "--hlt",
+        choices=["yes", "no"],
+        help="Compare category of the part only with or only without HLT",
+    )
+    parser.add_argument(
+        "--part-output", type=str, help="JSON file for RelMon part after comparison"
+    )
+    parser.add_argument(
+        "--merge", nargs="+", help="JSON files of RelMon parts to merge into RelMon"
+    )
 
     args = vars(parser.parse_args())
     logging.basicConfig(
@@ -661,6 +763,9 @@ def main():
     callback_url = args.get("callback")
     notify_done = bool(args.get("notifydone"))
     callback_credentials = bool(args.get("callback_credentials"))
+    category_name = args.get("category")
+    part_output = args.get("part_output")
+    part_files = args.get("merge")
     logging.info(
         "Arguments: %s; cert %s; key %s; proxy: %s; cpus %s; callback %s; notify %s",
         relmon_filename,
@@ -675,8 +780,17 @@ def main():
     with open(relmon_filename) as relmon_file:
         relmon = json.load(relmon_file)
 
+    if category_name:
+        logging.info("Part: category %s, HLT %s", category_name, args.get("hlt"))
+        relmon = select_part(relmon, category_name, args.get("hlt"))
+        relmon_filename = part_output
+
     try:
-        if notify_done:
+        if part_files:
+            merge_parts(relmon, part_files)
+            if relmon["status"] != "failed":
+                relmon["status"] = "finishing"
+        elif notify_done:
             if relmon["status"] != "failed":
                 relmon["status"] = "done"
             else:
@@ -691,7 +805,8 @@ def main():
             notify(relmon, callback_url, callback_credentials)
             download_root_files(relmon, cmsweb, callback_url, callback_credentials)
             run_validation_matrix(relmon, cpus, callback_url, callback_credentials)
-            relmon["status"] = "finishing"
+            if not category_name:
+                relmon["status"] = "finishing"
     except Exception as ex:
         logging.error(ex)
         logging.error(traceback.format_exc())
@@ -0,0 +1,25 @@
+"""
+Unit tests of RelMon service
+Run with: python3 -m pytest tests
+"""
+import os
+
+# Configuration is read from environment when modules are imported
+for name in (
+    "CALLBACK_URL",
+    "SERVICE_URL",
+    "REPORTS_URL",
+    "SUBMISSION_HOST",
+    "REMOTE_DIRECTORY",
+    "SERVICE_ACCOUNT_USERNAME",
+    "SERVICE_ACCOUNT_PASSWORD",
+    "WEB_LOCATION_PATH",
+    "MONGO_DB_HOST",
+    "MONGO_DB_USER",
+    "MONGO_DB_PASSWORD",
+    "SECRET_KEY",
+    "CLIENT_ID",
+    "CALLBACK_CLIENT_ID",
+    "CALLBACK_CLIENT_SECRET",
+):
+    os.environ.setdefault(name, "test")
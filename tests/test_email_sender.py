@@ -0,0 +1,142 @@
+"""
+Tests of sending notifications from the outbox
+"""
+import threading
+import time
+import unittest
+from local.email_sender import EmailSender
+from benchmarks.notification_outbox import StandInSMTPServer
+
+
+class FakeOutbox:
+    """
+    Outbox with the same interface as NotificationOutbox
+    """
+
+    def __init__(self, notifications):
+        self.notifications = list(notifications)
+        self.acked = []
+        self.released = []
+
+    def claim(self, limit):
+        """
+        Return up to limit notifications
+        """
+        claimed = self.notifications[:limit]
+        self.notifications = self.notifications[limit:]
+        return claimed
+
+    def ack(self, notification_ids):
+        """
+        Remember sent or dropped notifications
+        """
+        self.acked.extend(notification_ids)
+
+    def release(self, notification_id, attempts, next_attempt):
+        """
+        Remember notifications that will be retried
+        """
+        self.released.append((notification_id, attempts, next_attempt))
+
+
+def make_outbox(count, attempts=0):
+    """
+    Return outbox with given number of notifications
+    """
+    notifications = []
+    for index in range(count):
+        notification = EmailSender.build_notification(
+            "Test %s" % (index), "Body", ["user@localhost"]
+        )
+        notification["_id"] = index
+        notification["attempts"] = attempts
+        notifications.append(notification)
+
+    return FakeOutbox(notifications)
+
+
+class SendPendingTest(unittest.TestCase):
+    """
+    Tests of EmailSender.send_pending with a stand-in SMTP server
+    """
+
+    def setUp(self):
+        self.server = StandInSMTPServer(0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.sender = EmailSender(host=host, port=port, use_tls=False)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_is_reused_across_drains(self):
+        first = make_outbox(EmailSender.BATCH_SIZE + 5)
+        second = make_outbox(3)
+        self.assertEqual(self.sender.send_pending(first), EmailSender.BATCH_SIZE + 5)
+        self.assertEqual(self.sender.send_pending(second), 3)
+        self.assertEqual(self.sender.send_pending(make_outbox(0)), 0)
+        self.assertEqual(self.server.messages, EmailSender.BATCH_SIZE + 8)
+        self.assertEqual(self.server.sessions, 1)
+        self.assertEqual(first.released, [])
+
+    def test_dead_session_is_replaced(self):
+        self.sender.send_pending(make_outbox(1))
+        # Server dropped the idle client
+        self.sender.smtp.close()
+        self.assertEqual(self.sender.send_pending(make_outbox(1)), 1)
+        self.assertEqual(self.server.sessions, 2)
+
+    def test_idle_session_is_replaced(self):
+        self.sender.send_pending(make_outbox(1))
+        self.sender.last_used = time.time() - EmailSender.MAX_IDLE_TIME - 1
+        self.assertEqual(self.sender.send_pending(make_outbox(1)), 1)
+        self.assertEqual(self.server.sessions, 2)
+
+    def test_failed_notifications_are_retried_with_backoff(self):
+        # Nothing listens on the port anymore
+        self.server.shutdown()
+        self.server.server_close()
+        outbox = make_outbox(2, attempts=2)
+        start = time.time()
+        self.assertEqual(self.sender.send_pending(outbox), 0)
+        self.assertEqual(outbox.acked, [])
+        self.assertEqual([x[:2] for x in outbox.released], [(0, 3), (1, 3)])
+        for _, _, next_attempt in outbox.released:
+            self.assertGreaterEqual(next_attempt, start + EmailSender.RETRY_DELAY * 4)
+
+    def test_notification_is_dropped_after_max_attempts(self):
+        self.server.shutdown()
+        self.server.server_close()
+        outbox = make_outbox(1, attempts=EmailSender.MAX_ATTEMPTS - 1)
+        self.sender.send_pending(outbox)
+        self.assertEqual(outbox.acked, [0])
+        self.assertEqual(outbox.released, [])
+
+
+class BuildNotificationTest(unittest.TestCase):
+    """
+    Tests of EmailSender.build_notification
+    """
+
+    def test_too_big_attachment_is_mentioned_in_body(self):
+        content = b"x" * (EmailSender.MAX_ATTACHMENT_SIZE + 1)
+        notification = EmailSender.build_notification(
+            "Subject", "Body", ["user@localhost"], [("logs.tar.gz", content)]
+        )
+        self.assertEqual(notification["attachments"], [])
+        self.assertIn("logs.tar.gz could not be attached", notification["body"])
+
+    def test_small_attachment_is_attached(self):
+        notification = EmailSender.build_notification(
+            "Subject", "Body", ["user@localhost"], [("logs.tar.gz", b"logs")]
+        )
+        self.assertEqual(
+            notification["attachments"], [{"name": "logs.tar.gz", "content": b"logs"}]
+        )
+        self.assertNotIn("could not be attached", notification["body"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Tests of metrics snapshots and rendering
+"""
+import unittest
+from local.metrics import Counter, Gauge, Histogram, Registry
+
+
+def make_registry():
+    """
+    Return registry with a counter, a gauge and a histogram
+    """
+    registry = Registry()
+    registry.register(Counter("test_ticks_total", "Ticks", ["sweep"]))
+    registry.register(Gauge("test_relmons", "RelMons", ["status"]))
+    registry.register(Histogram("test_seconds", "Durations", buckets=(1, 10)))
+    return registry
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Tests of metrics
+    """
+
+    def test_counters_are_per_process(self):
+        """
+        Counters of different processes are not summed, so a process whose
+        snapshot expired does not make counter go down
+        """
+        registry = make_registry()
+        counter = registry.metrics["test_ticks_total"]
+        counter.inc(sweep="full")
+        counter.inc(2, sweep="full")
+        first = registry.snapshot()
+        registry.reset()
+        counter.inc(5, sweep="full")
+        second = registry.snapshot()
+        lines = registry.render({"a-1": first, "b-2": second}).splitlines()
+        self.assertIn('test_ticks_total{sweep="full",process="a-1"} 3', lines)
+        self.assertIn('test_ticks_total{sweep="full",process="b-2"} 5', lines)
+        lines = registry.render({"b-2": second}).splitlines()
+        self.assertIn('test_ticks_total{sweep="full",process="b-2"} 5', lines)
+        self.assertNotIn('test_ticks_total{sweep="full",process="a-1"} 3', lines)
+
+    def test_histogram_render(self):
+        """
+        Histogram buckets are cumulative and have sum and count
+        """
+        registry = make_registry()
+        histogram = registry.metrics["test_seconds"]
+        histogram.observe(0.5)
+        histogram.observe(5)
+        histogram.observe(50)
+        lines = registry.render({"a-1": registry.snapshot()}).splitlines()
+        self.assertIn('test_seconds_bucket{process="a-1",le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{process="a-1",le="10"} 2', lines)
+        self.assertIn('test_seconds_bucket{process="a-1",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{process="a-1"} 55.5', lines)
+        self.assertIn('test_seconds_count{process="a-1"} 3', lines)
+        self.assertIn("# TYPE test_seconds histogram", lines)
+
+    def test_histogram_with_other_buckets_is_skipped(self):
+        """
+        Snapshot made with different buckets is not rendered
+        """
+        registry = make_registry()
+        snapshot = [
+            {
+                "name": "test_seconds",
+                "values": [
+                    {"labels": [], "value": {"buckets": [1], "sum": 1, "count": 1}}
+                ],
+            }
+        ]
+        lines = registry.render({"a-1": snapshot}).splitlines()
+        self.assertEqual([x for x in lines if x.startswith("test_seconds")], [])
+
+    def test_gauge_replace(self):
+        """
+        Gauge replace removes values that are not given and gauges have no
+        process label
+        """
+        registry = make_registry()
+        gauge = registry.metrics["test_relmons"]
+        gauge.set(3, status="new")
+        gauge.replace([(1, {"status": "done"}), (2, {"status": "running"})])
+        lines = registry.render({"a-1": registry.snapshot()}).splitlines()
+        self.assertIn('test_relmons{status="done"} 1', lines)
+        self.assertIn('test_relmons{status="running"} 2', lines)
+        self.assertFalse([x for x in lines if 'status="new"' in x])
+
+    def test_label_escaping(self):
+        """
+        Quotes and backslashes in label values are escaped
+        """
+        registry = make_registry()
+        registry.metrics["test_ticks_total"].inc(sweep='a"b\\c')
+        lines = registry.render({"a-1": registry.snapshot()}).splitlines()
+        self.assertIn('test_ticks_total{sweep="a\\"b\\\\c",process="a-1"} 1', lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
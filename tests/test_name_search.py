@@ -0,0 +1,118 @@
+"""
+Tests of search of RelMons by name
+"""
+import re
+import unittest
+from mongodb_database import Database, name_words
+
+
+NAMES = [
+    "CMSSW_14_0_0_pre1_vs_pre2_2024",
+    "CMSSW_14_0_10-PU_vs_noPU",
+    "cmssw_13_2_0__pre3",
+    "Validation.FastSim-2024",
+    "NoSeparators",
+]
+
+
+def matches(query, relmon):
+    """
+    Return whether RelMon document matches the query, only operators that
+    are used by name search are supported
+    """
+    if "$and" in query:
+        return all(matches(x, relmon) for x in query["$and"])
+
+    field, condition = list(query.items())[0]
+    values = relmon[field] if isinstance(relmon[field], list) else [relmon[field]]
+    if isinstance(condition, dict):
+        return any(re.search(condition["$regex"], x) for x in values)
+
+    return condition in values
+
+
+def search(query, prefix=False):
+    """
+    Return names that match the search query
+    """
+    query = Database.name_search_query(query, prefix)
+    relmons = [
+        {"name": x, "name_lowercase": x.lower(), "name_words": name_words(x)}
+        for x in NAMES
+    ]
+    return [x["name"] for x in relmons if matches(query, x)]
+
+
+def substring_search(query, prefix=False):
+    """
+    Return names that contain the query, "*" is a wildcard
+    """
+    pattern = ".*".join(re.escape(x) for x in query.lower().split("*"))
+    if prefix:
+        pattern = "^" + pattern
+
+    return [x for x in NAMES if re.search(pattern, x.lower())]
+
+
+class NameSearchTest(unittest.TestCase):
+    """
+    Tests of name search query
+    """
+
+    def test_name_words(self):
+        """
+        Names are split to unique lowercase words
+        """
+        self.assertEqual(
+            name_words("CMSSW_14_0_0_pre1_vs_pre2"),
+            ["0", "14", "cmssw", "pre1", "pre2", "vs"],
+        )
+        self.assertEqual(name_words("a--b..A"), ["a", "b"])
+
+    def test_same_results_as_substring_search(self):
+        """
+        Conditions on words only narrow down RelMons, results are the same
+        as of search anywhere in the name
+        """
+        queries = [
+            "cmssw_14",
+            "SW_14_0",
+            "_0_",
+            "14_0_1",
+            "_pre",
+            "re1_vs_pr",
+            "pu_vs",
+            "-pu",
+            "0__pre",
+            "fastsim-20",
+            "sim-2024",
+            "cmssw*_vs_*pu",
+            "separ",
+            "",
+            "_",
+        ]
+        for query in queries:
+            self.assertEqual(search(query), substring_search(query), query)
+            self.assertEqual(search(query, True), substring_search(query, True), query)
+
+    def test_words_are_used(self):
+        """
+        Query with a separator has conditions on words of names, query
+        without one can only search the whole names
+        """
+        query = Database.name_search_query("cmssw_14_0_1", False)
+        self.assertIn({"name_words": "14"}, query["$and"])
+        self.assertIn({"name_words": "0"}, query["$and"])
+        self.assertIn({"name_words": {"$regex": "^1"}}, query["$and"])
+        self.assertEqual(
+            Database.name_search_query("pre", False),
+            {"name_lowercase": {"$regex": "pre"}},
+        )
+        self.assertEqual(
+            Database.name_search_query("cmssw_14", True),
+            {"name_lowercase": {"$regex": "^cmssw_14"}},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Tests of RelMon change tracking
+"""
+import unittest
+from local.relmon import RelMon
+
+
+def make_relmon():
+    """
+    Return RelMon as it would be loaded from the database
+    """
+    relmon = RelMon(
+        {
+            "_id": "1",
+            "id": "1",
+            "name": "Test",
+            "status": "new",
+            "categories": [
+                {
+                    "name": "Data",
+                    "status": "initial",
+                    "hlt": "both",
+                    "automatic_pairing": True,
+                    "reference": ["RelValA", "RelValB"],
+                    "target": ["RelValC", "RelValD"],
+                },
+                {
+                    "name": "FullSimulation",
+                    "status": "initial",
+                    "hlt": "no",
+                    "automatic_pairing": True,
+                    "reference": ["RelValE"],
+                    "target": ["RelValF"],
+                },
+            ],
+        }
+    )
+    return RelMon(relmon.get_json())
+
+
+class GetChangesTest(unittest.TestCase):
+    """
+    Tests of RelMon.get_changes
+    """
+
+    def test_no_changes(self):
+        """
+        RelMon that was not changed has nothing to save
+        """
+        self.assertEqual(make_relmon().get_changes(), ({}, []))
+
+    def test_top_level_fields(self):
+        """
+        Changed, added and removed fields are returned
+        """
+        relmon = make_relmon()
+        relmon.set_status("submitted")
+        relmon.get_json()["priority"] = 3
+        del relmon.get_json()["_id"]
+        changes, removed = relmon.get_changes()
+        self.assertEqual(changes, {"status": "submitted", "priority": 3})
+        self.assertEqual(removed, ["_id"])
+
+    def test_changed_relval(self):
+        """
+        Only changed reference or target is returned in dot notation
+        """
+        relmon = make_relmon()
+        target = relmon.get_json()["categories"][0]["target"][1]
+        target["status"] = "downloaded"
+        target["file_size"] = 100
+        changes, removed = relmon.get_changes()
+        self.assertEqual(changes, {"categories.0.target.1": target})
+        self.assertEqual(removed, [])
+
+    def test_changed_category_field(self):
+        """
+        Changed field of a category is returned in dot notation
+        """
+        relmon = make_relmon()
+        relmon.get_json()["categories"][1]["status"] = "done"
+        self.assertEqual(relmon.get_changes()[0], {"categories.1.status": "done"})
+
+    def test_added_relval(self):
+        """
+        If number of references changes, whole list is returned
+        """
+        relmon = make_relmon()
+        references = relmon.get_json()["categories"][0]["reference"]
+        references.append(dict(references[0], name="RelValG"))
+        self.assertEqual(
+            relmon.get_changes()[0], {"categories.0.reference": references}
+        )
+
+    def test_reordered_categories(self):
+        """
+        If categories are reordered, all of them are returned
+        """
+        relmon = make_relmon()
+        categories = relmon.get_json()["categories"]
+        categories.reverse()
+        self.assertEqual(relmon.get_changes()[0], {"categories": categories})
+
+    def test_mark_saved(self):
+        """
+        Changes are tracked from the last save
+        """
+        relmon = make_relmon()
+        relmon.set_status("submitted")
+        relmon.mark_saved()
+        self.assertEqual(relmon.get_changes(), ({}, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
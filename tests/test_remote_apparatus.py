@@ -0,0 +1,148 @@
+"""
+Tests of merging RelMon parts in remote apparatus
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "remote"))
+# pylint: disable=import-error,wrong-import-position
+from remote_apparatus import merge_parts, select_part
+
+# pylint: enable=import-error,wrong-import-position
+
+
+def make_item(name, status="initial"):
+    """
+    Return a reference or target
+    """
+    return {
+        "name": name,
+        "file_name": "",
+        "file_url": "",
+        "file_size": 0,
+        "status": status,
+        "events": 0,
+    }
+
+
+def make_relmon():
+    """
+    Return RelMon with a category compared with and without HLT and an
+    empty category
+    """
+    return {
+        "id": "1",
+        "name": "Test",
+        "status": "running",
+        "categories": [
+            {
+                "name": "Data",
+                "hlt": "both",
+                "status": "initial",
+                "automatic_pairing": True,
+                "reference": [make_item("RelValA"), make_item("RelValB")],
+                "target": [make_item("RelValC"), make_item("RelValD")],
+            },
+            {
+                "name": "Generator",
+                "hlt": "no",
+                "status": "initial",
+                "automatic_pairing": True,
+                "reference": [],
+                "target": [],
+            },
+        ],
+    }
+
+
+class MergePartsTest(unittest.TestCase):
+    """
+    Tests of merge_parts
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_part(self, name, part):
+        """
+        Write part to a file and return it's name
+        """
+        file_name = os.path.join(self.directory.name, name)
+        with open(file_name, "w") as part_file:
+            json.dump(part, part_file)
+
+        return file_name
+
+    def hlt_parts(self, relmon):
+        """
+        Return parts of Data category with and without HLT
+        """
+        return (
+            select_part(json.loads(json.dumps(relmon)), "Data", "yes"),
+            select_part(json.loads(json.dumps(relmon)), "Data", "no"),
+        )
+
+    def test_hlt_both_parts_are_merged_per_relval(self):
+        relmon = make_relmon()
+        with_hlt, without_hlt = self.hlt_parts(relmon)
+        self.assertEqual(with_hlt["categories"][0]["hlt"], "only")
+        self.assertEqual(without_hlt["categories"][0]["hlt"], "no")
+        # Only one part managed to download RelValB
+        for part, status in ((with_hlt, "downloaded"), (without_hlt, "no_root")):
+            category = part["categories"][0]
+            category["status"] = "done"
+            category["reference"][0]["status"] = "downloaded"
+            category["reference"][1]["status"] = status
+            for item in category["target"]:
+                item["status"] = "downloaded"
+
+        merge_parts(
+            relmon,
+            [
+                self.write_part("hlt.json", with_hlt),
+                self.write_part("no_hlt.json", without_hlt),
+            ],
+        )
+        data = relmon["categories"][0]
+        self.assertEqual(data["hlt"], "both")
+        self.assertEqual(data["status"], "done")
+        self.assertEqual(
+            [x["status"] for x in data["reference"]], ["downloaded", "no_root"]
+        )
+        self.assertEqual(
+            [x["status"] for x in data["target"]], ["downloaded", "downloaded"]
+        )
+        self.assertEqual(relmon["categories"][1]["status"], "done")
+        self.assertEqual(relmon["status"], "running")
+
+    def test_category_is_not_done_if_one_part_is_not(self):
+        relmon = make_relmon()
+        with_hlt, without_hlt = self.hlt_parts(relmon)
+        with_hlt["categories"][0]["status"] = "failed"
+        with_hlt["status"] = "failed"
+        without_hlt["categories"][0]["status"] = "done"
+        merge_parts(
+            relmon,
+            [
+                self.write_part("hlt.json", with_hlt),
+                self.write_part("no_hlt.json", without_hlt),
+            ],
+        )
+        self.assertEqual(relmon["categories"][0]["status"], "failed")
+        self.assertEqual(relmon["status"], "failed")
+
+    def test_category_without_part_is_not_done(self):
+        relmon = make_relmon()
+        merge_parts(relmon, [])
+        self.assertEqual(relmon["categories"][0]["status"], "failed")
+        self.assertEqual(relmon["categories"][1]["status"], "done")
+
+
+if __name__ == "__main__":
+    unittest.main()
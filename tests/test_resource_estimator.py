@@ -0,0 +1,167 @@
+"""
+Tests of job log parsing and fitting of the resource estimator
+"""
+import unittest
+from local.relmon import RelMon
+from local.resource_estimator import ResourceEstimator, fit_line, parse_job_log
+
+
+JOB_LOG = """000 (801341.000.000) 2024-01-31 11:55:00 Job submitted from host: <127.0.0.1:9618>
+...
+001 (801341.000.000) 2024-01-31 12:00:00 Job executing on host: <127.0.0.2:9618>
+...
+004 (801341.000.000) 2024-01-31 12:30:00 Job was evicted.
+	(0) Job was not checkpointed.
+		Usr 0 00:20:00, Sys 0 00:00:10  -  Run Remote Usage
+		Usr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+...
+001 (801341.000.000) 2024-01-31 13:00:00 Job executing on host: <127.0.0.3:9618>
+...
+005 (801341.000.000) 2024-01-31 15:00:00 Job terminated.
+	(1) Normal termination (return value 0)
+		Usr 0 03:20:00, Sys 0 00:01:40  -  Run Remote Usage
+		Usr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+		Usr 0 03:40:00, Sys 0 00:01:50  -  Total Remote Usage
+		Usr 0 00:00:00, Sys 0 00:00:00  -  Total Local Usage
+	0  -  Run Bytes Sent By Job
+	0  -  Run Bytes Received By Job
+	Partitionable Resources :    Usage  Request Allocated
+	   Cpus                 :     1.85        2         2
+	   Disk (KB)            :   512000   1048576   1100000
+	   Memory (MB)          :     3000      4096      4096
+...
+"""
+
+
+def make_relval(index, file_size=0):
+    """
+    Return a downloaded relval
+    """
+    return {
+        "name": "RelValTest%s" % (index),
+        "file_name": "",
+        "file_url": "",
+        "file_size": file_size,
+        "status": "downloaded" if file_size else "initial",
+        "events": 0,
+    }
+
+
+def make_relmon(relvals, file_size=0):
+    """
+    Return RelMon dictionary with a category of given number of relvals
+    per side and job usage as if job CPU time was linear in size
+    """
+    categories = [
+        {
+            "name": "FullSimulation",
+            "status": "done" if file_size else "initial",
+            "hlt": "no",
+            "automatic_pairing": True,
+            "reference": [make_relval(i, file_size) for i in range(relvals)],
+            "target": [make_relval(i, file_size) for i in range(relvals)],
+        }
+    ]
+    size = 2 * relvals * file_size
+    return {
+        "id": str(relvals),
+        "name": "Test%s" % (relvals),
+        "categories": categories,
+        "job_usage": {
+            "wall_time": 600 + size // 1000,
+            "cpu_time": size // 1000,
+            "cpus": 1,
+            "cpus_used": 1,
+            "memory_mb_used": 2000,
+            "disk_kb_used": size // 1024,
+        },
+    }
+
+
+class ParseJobLogTest(unittest.TestCase):
+    """
+    Tests of HTCondor user log parsing
+    """
+
+    def test_last_execution(self):
+        """
+        Usage of the last execution is taken
+        """
+        usage = parse_job_log(JOB_LOG)
+        self.assertEqual(usage["wall_time"], 7200)
+        self.assertEqual(usage["cpu_time"], 3 * 3600 + 20 * 60 + 100)
+        self.assertEqual(usage["cpus"], 2)
+        self.assertEqual(usage["cpus_used"], 1.85)
+        self.assertEqual(usage["memory_mb"], 4096)
+        self.assertEqual(usage["memory_mb_used"], 3000)
+        self.assertEqual(usage["disk_kb"], 1100000)
+        self.assertEqual(usage["disk_kb_used"], 512000)
+
+    def test_old_time_format(self):
+        """
+        Event times without a year are parsed
+        """
+        log = JOB_LOG.replace("2024-01-31 ", "01/31 ")
+        self.assertEqual(parse_job_log(log)["wall_time"], 7200)
+
+    def test_not_terminated(self):
+        """
+        Job that did not terminate has no usage
+        """
+        log = JOB_LOG[: JOB_LOG.index("005 (")]
+        self.assertIsNone(parse_job_log(log))
+        self.assertIsNone(parse_job_log(""))
+
+
+class FitTest(unittest.TestCase):
+    """
+    Tests of fitting and estimation
+    """
+
+    def test_fit_line(self):
+        """
+        Line is fitted with least squares and slope is never negative
+        """
+        intercept, slope = fit_line([(1, 3), (2, 5), (3, 7)])
+        self.assertAlmostEqual(intercept, 1)
+        self.assertAlmostEqual(slope, 2)
+        self.assertEqual(fit_line([(2, 1), (2, 3)]), (2, 0.0))
+        intercept, slope = fit_line([(1, 3), (2, 2), (3, 1)])
+        self.assertEqual((intercept, slope), (2, 0.0))
+
+    def test_step_tables_without_history(self):
+        """
+        Step tables are used until there are enough completed RelMons
+        """
+        estimator = ResourceEstimator()
+        estimator.fit([make_relmon(x + 1, 10**8) for x in range(5)])
+        self.assertIsNone(estimator.model)
+        estimate = estimator.estimate(RelMon(make_relmon(10)))
+        self.assertEqual(estimate["source"], "step_table")
+
+    def test_estimate_from_history(self):
+        """
+        Resources of a new RelMon are estimated from history
+        """
+        estimator = ResourceEstimator()
+        estimator.fit(
+            [make_relmon(x + 1, 10**6) for x in range(ResourceEstimator.MIN_SAMPLES)]
+        )
+        self.assertEqual(estimator.model["samples"], ResourceEstimator.MIN_SAMPLES)
+        self.assertAlmostEqual(estimator.model["cpu_time"][1], 0.001)
+        estimate = estimator.estimate(RelMon(make_relmon(10)))
+        self.assertEqual(estimate["source"], "history")
+        # 2 * 10 relvals of 1MB, 1s of CPU time per 1KB
+        self.assertEqual(estimate["cpus"], 1)
+        self.assertAlmostEqual(estimate["wall_time"], 600 + 20000, delta=1)
+        self.assertEqual(estimate["memory_mb"], 2500)
+        # More CPUs are requested when job would not fit in target wall time
+        estimate = estimator.estimate(RelMon(make_relmon(20)))
+        self.assertEqual(estimate["cpus"], 2)
+        estimate = estimator.estimate(RelMon(make_relmon(50)))
+        self.assertEqual(estimate["cpus"], 8)
+        self.assertLessEqual(estimate["wall_time"], ResourceEstimator.TARGET_WALL_TIME)
+
+
+if __name__ == "__main__":
+    unittest.main()
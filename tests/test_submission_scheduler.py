@@ -0,0 +1,114 @@
+"""
+Tests of choosing which new RelMons are submitted
+"""
+import unittest
+from local.submission_scheduler import SubmissionScheduler
+
+
+def make_candidate(relmon_id, priority=0, relval_count=10, queued_since=0):
+    """
+    Return a new RelMon as returned by submission candidates query
+    """
+    return {
+        "id": relmon_id,
+        "priority": priority,
+        "relval_count": relval_count,
+        "queued_since": queued_since,
+    }
+
+
+def pick(candidates, running, slots):
+    """
+    Return ids of picked RelMons
+    """
+    return [x["id"] for x in SubmissionScheduler.pick(candidates, running, slots)]
+
+
+class FakeDatabase:
+    """
+    Database with submission candidates and RelMons in flight
+    """
+
+    def __init__(self, candidates, running):
+        self.candidates = candidates
+        self.running = running
+        self.limit = None
+
+    def get_relmons_in_flight_per_user(self):
+        """
+        Return users and numbers of their RelMons in flight
+        """
+        return self.running
+
+    def get_submission_candidates(self, limit):
+        """
+        Return users and their new RelMons
+        """
+        self.limit = limit
+        return self.candidates
+
+
+class PickTest(unittest.TestCase):
+    """
+    Tests of SubmissionScheduler.pick
+    """
+
+    def test_users_take_turns(self):
+        """
+        User with fewest RelMons in flight goes first, then users alternate
+        """
+        candidates = {
+            "alice": [make_candidate("a1"), make_candidate("a2"), make_candidate("a3")],
+            "bob": [make_candidate("b1"), make_candidate("b2")],
+        }
+        self.assertEqual(pick(candidates, {"alice": 1}, 4), ["b1", "a1", "b2", "a2"])
+
+    def test_priority_goes_first(self):
+        """
+        Higher priority RelMon is picked regardless of user's load
+        """
+        candidates = {
+            "alice": [make_candidate("a1", priority=5), make_candidate("a2")],
+            "bob": [make_candidate("b1")],
+        }
+        self.assertEqual(pick(candidates, {"alice": 10}, 2), ["a1", "b1"])
+
+    def test_smaller_and_older_first(self):
+        """
+        With the same priority and load smaller RelMon goes first, then the
+        one that was queued first, then user name decides
+        """
+        candidates = {
+            "alice": [make_candidate("a1", relval_count=20)],
+            "bob": [make_candidate("b1", relval_count=10, queued_since=2)],
+            "carol": [make_candidate("c1", relval_count=10, queued_since=1)],
+            "dave": [make_candidate("d1", relval_count=20)],
+        }
+        self.assertEqual(pick(candidates, {}, 4), ["c1", "b1", "a1", "d1"])
+
+    def test_slots_and_empty_queues(self):
+        """
+        No more than slots RelMons are picked, users without candidates
+        are ignored
+        """
+        candidates = {"alice": [make_candidate("a1"), make_candidate("a2")], "bob": []}
+        self.assertEqual(pick(candidates, {"bob": 0}, 1), ["a1"])
+        self.assertEqual(pick(candidates, {}, 5), ["a1", "a2"])
+        self.assertEqual(pick({}, {}, 5), [])
+
+    def test_schedule_free_slots(self):
+        """
+        Only free slots are given out and only that many candidates are
+        requested per user
+        """
+        database = FakeDatabase(
+            {"alice": [make_candidate("a1"), make_candidate("a2")]}, {"bob": 3}
+        )
+        self.assertEqual(SubmissionScheduler(4).schedule(database), ["a1"])
+        self.assertEqual(database.limit, 1)
+        database.running = {"bob": 4}
+        self.assertEqual(SubmissionScheduler(4).schedule(database), [])
+
+
+if __name__ == "__main__":
+    unittest.main()